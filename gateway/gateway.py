@@ -0,0 +1,523 @@
+#Fleet gateway: a CPython service Booking Companions can use as their API_BASE_URL instead of the members API,
+#speaking the subset of it the device helpers use while cutting down the traffic that reaches Cobot:
+#   - booking fetches from every device are answered from one space-wide fetch, batched over a short window and
+#     reused for a few seconds, then split per resource
+#   - identical requests in flight at the same time share one upstream request (single-flight)
+#   - check_in_tokens lookups are cached
+#   - devices get an ETag for their resource's bookings and an empty 304 while they haven't changed
+#   - devices can subscribe to a stream of changes to their resource's bookings, fed by Cobot's webhooks and by
+#     changes made through the gateway, and only poll as a fallback
+#Creating, moving and deleting bookings goes straight through with the device's own token, and drops the cached
+#bookings so the next fetch sees the change.
+#
+#   python gateway/gateway.py --upstream https://members.motionlab.berlin/api --port 8000
+#then set API_BASE_URL = "http://<gateway-host>:8000/api" (and PUSH_UPDATES = True) in each device's secrets.py,
+#and subscribe http://<gateway-host>:8000/webhooks/cobot?secret=<--webhook-secret> to Cobot's created_booking,
+#updated_booking and deleted_booking webhooks. Without --webhook-secret, webhooks are refused.
+#
+#The change stream is server-sent events on GET /api/resources/<id>/changes?access_token=...: an event whose data
+#is the resource ID for every change, and a comment every PING_S to show the connection is alive.
+#
+#Cached and batched answers are only given to access tokens Cobot has accepted. A device's first request goes
+#through with its own token, and once Cobot answers it with a 2xx or 304 the token counts as accepted for TOKEN_TTL_S. Batched fetches
+#use --upstream-token if one is given (it needs the read_bookings and checkin_tokens scopes), otherwise the
+#requesting device's token, in which case only devices sharing a token share fetches.
+
+import os
+import ssl
+import hmac
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from datetime import datetime
+from urllib.parse import urlsplit
+
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S %z"
+
+BATCH_WINDOW_MS = 20 #How long the first booking fetch waits for others to join it
+BOOKINGS_TTL_S = 10 #How long a space-wide fetch answers later ones
+CHECKIN_TTL_S = 3600
+CHECKIN_MISS_TTL_S = 60 #Unknown badges are remembered for less time, in case they were just issued
+TOKEN_TTL_S = 3600
+PING_S = 25
+MAX_UPSTREAM_CONNECTIONS = 4
+UPSTREAM_TIMEOUT_S = 10
+
+def parse_time(time_string):
+    return datetime.strptime(time_string, TIME_FORMAT)
+
+def overlaps(booking, range_start, range_end):
+    return parse_time(booking["from"]) < range_end and parse_time(booking["to"]) > range_start
+
+def resource_of(booking):
+    if "resource_id" in booking:
+        return booking["resource_id"]
+    return (booking.get("resource") or {}).get("id")
+
+def below_base(path, base_path):
+    return path[len(base_path):] if path.startswith(base_path + "/") else path
+
+#Splits "/api/resources/abc/bookings?access_token=t" below the base path into
+#(["resources", "abc", "bookings"], {"access_token": "t"})
+def split_path(path, base_path):
+    path, _, query_string = below_base(path, base_path).partition("?")
+    query = {}
+    for parameter in query_string.split("&"):
+        name, _, value = parameter.partition("=")
+        if name:
+            query[name] = value
+    return [part for part in path.split("/") if part], query
+
+def created_booking_id(content):
+    try:
+        return json.loads(content).get("id")
+    except (ValueError, AttributeError):
+        return None
+
+class Stats:
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+##### UPSTREAM #####
+
+class UpstreamResponse:
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+class StaleConnectionError(ConnectionError):
+    pass
+
+#Keep-alive connection pool to the members API, with at most max_connections requests in flight
+class Upstream:
+    def __init__(self, base_url, stats, max_connections=MAX_UPSTREAM_CONNECTIONS, timeout_s=UPSTREAM_TIMEOUT_S):
+        parts = urlsplit(base_url)
+        self.use_ssl = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.use_ssl else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.stats = stats
+        self.timeout_s = timeout_s
+        self.slots = asyncio.Semaphore(max_connections)
+        self.idle = []
+
+    async def open(self):
+        self.stats.count("upstream_connections")
+        return await asyncio.open_connection(self.host, self.port, ssl=ssl.create_default_context() if self.use_ssl else None)
+
+    #path is below the base path, e.g. "/bookings?access_token=..."
+    async def request(self, method, path, body=None, headers=None):
+        head = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n".format(method, self.base_path + path, self.host)
+        for name, value in (headers or {}).items():
+            head += "{}: {}\r\n".format(name, value)
+        if body is not None:
+            head += "Content-Type: application/json\r\nContent-Length: {}\r\n".format(len(body))
+        message = head.encode() + b"\r\n" + (body or b"")
+
+        async with self.slots:
+            self.stats.count("upstream_requests")
+            self.stats.count("upstream {} /{}".format(method, path.split("?", 1)[0].strip("/").split("/")[0]))
+            for attempt in range(2):
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await self.open()
+                try:
+                    writer.write(message)
+                    await writer.drain()
+                    response = await asyncio.wait_for(self.read_response(reader), self.timeout_s)
+                except ConnectionError:
+                    #A pooled connection the server has since closed fails on first use, so retry on a fresh one
+                    writer.close()
+                    if not reused or attempt:
+                        raise
+                    continue
+                except BaseException:
+                    writer.close()
+                    raise
+
+                if response.headers.get("connection", "").lower() == "close":
+                    writer.close()
+                else:
+                    self.idle.append((reader, writer))
+                return response
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise StaleConnectionError("connection closed before response")
+        status = int(status_line.split(None, 2)[1])
+        headers = await read_headers(reader)
+
+        if status in (204, 304):
+            content = b""
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b"".join(chunks)
+        else:
+            content = await reader.read(-1)
+            headers["connection"] = "close"
+        return UpstreamResponse(status, headers, content)
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+##### COALESCING #####
+
+#Runs one call per key at a time: callers asking for a key that is already in flight wait for the same result
+class SingleFlight:
+    def __init__(self, stats):
+        self.stats = stats
+        self.calls = {}
+
+    async def do(self, key, call):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda finished: self.calls.pop(key, None))
+        else:
+            self.stats.count("coalesced")
+        #One caller giving up must not cancel the call for the others
+        return await asyncio.shield(task)
+
+#Answers per-resource booking fetches from space-wide ones. The first fetch for a token waits BATCH_WINDOW_MS for
+#others to join, then one upstream fetch covering all of their ranges is split between them and kept for
+#BOOKINGS_TTL_S to answer later fetches within its range.
+class BookingBatcher:
+    def __init__(self, upstream, stats, batch_window_ms=BATCH_WINDOW_MS, ttl_s=BOOKINGS_TTL_S):
+        self.upstream = upstream
+        self.stats = stats
+        self.batch_window_ms = batch_window_ms
+        self.ttl_s = ttl_s
+        self.pending = {} #token -> [(range_start, range_end, future)]
+        self.cached = {} #token -> (fetched_at, range_start, range_end, bookings)
+        self.booking_resources = {} #booking ID -> resource ID of every booking seen, to route change notifications
+
+    #Returns (status, content) for a resource's bookings in [range_start, range_end), given as API time strings
+    async def bookings(self, token, resource_id, range_start, range_end):
+        range_start, range_end = parse_time(range_start), parse_time(range_end)
+
+        cached = self.cached.get(token)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl_s and cached[1] <= range_start and cached[2] >= range_end:
+            self.stats.count("bookings_cache_hits")
+            return 200, self.select(cached[3], resource_id, range_start, range_end)
+
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(token, [])
+        batch.append((range_start, range_end, future))
+        if len(batch) == 1:
+            asyncio.get_running_loop().call_later(self.batch_window_ms / 1000, lambda: asyncio.ensure_future(self.fetch(token)))
+        else:
+            self.stats.count("batched")
+
+        status, bookings = await future
+        if status != 200:
+            return status, bookings
+        return 200, self.select(bookings, resource_id, range_start, range_end)
+
+    async def fetch(self, token):
+        batch = self.pending.pop(token, [])
+        range_start = min(entry[0] for entry in batch)
+        range_end = max(entry[1] for entry in batch)
+        body = json.dumps({"from": range_start.strftime(TIME_FORMAT), "to": range_end.strftime(TIME_FORMAT)}).encode()
+
+        try:
+            response = await self.upstream.request("GET", "/bookings?access_token=" + token, body)
+            if response.status == 200:
+                result = (200, json.loads(response.content))
+                self.cached[token] = (time.monotonic(), range_start, range_end, result[1])
+                for booking in result[1]:
+                    self.booking_resources[booking["id"]] = resource_of(booking)
+            else:
+                result = (response.status, response.content)
+        except Exception as e:
+            result = (502, json.dumps({"error": "upstream unreachable: {}".format(e)}).encode())
+
+        for entry in batch:
+            if not entry[2].done():
+                entry[2].set_result(result)
+
+    def select(self, bookings, resource_id, range_start, range_end):
+        return [booking for booking in bookings if resource_of(booking) == resource_id and overlaps(booking, range_start, range_end)]
+
+    #Drops every cached fetch, after a booking was changed through the gateway
+    def invalidate(self):
+        self.cached.clear()
+
+##### GATEWAY #####
+
+class Gateway:
+    def __init__(self, upstream_url, upstream_token=None, base_path="/api", batch_window_ms=BATCH_WINDOW_MS,
+                 bookings_ttl_s=BOOKINGS_TTL_S, checkin_ttl_s=CHECKIN_TTL_S, max_upstream_connections=MAX_UPSTREAM_CONNECTIONS,
+                 webhook_secret=None):
+        self.stats = Stats()
+        self.upstream = Upstream(upstream_url, self.stats, max_upstream_connections)
+        self.upstream_token = upstream_token
+        self.base_path = base_path
+        self.checkin_ttl_s = checkin_ttl_s
+        self.single_flight = SingleFlight(self.stats)
+        self.batcher = BookingBatcher(self.upstream, self.stats, batch_window_ms, bookings_ttl_s)
+        self.checkins = {} #check-in token -> (stored_at, status, content)
+        self.accepted_tokens = {} #device access token -> when Cobot last accepted it
+        self.subscribers = {} #resource ID -> set of queues, one per open change stream
+        self.webhook_secret = webhook_secret
+        self.server = None
+
+    def is_accepted(self, access_token):
+        accepted_at = self.accepted_tokens.get(access_token)
+        return accepted_at is not None and time.monotonic() - accepted_at < TOKEN_TTL_S
+
+    #Only an answer Cobot actually gave the token data with shows it is valid; errors and 404s show nothing
+    def note_answer(self, access_token, status):
+        if access_token and (200 <= status < 300 or status == 304):
+            self.accepted_tokens[access_token] = time.monotonic()
+
+    #Sends a device's request upstream as it is, sharing it with identical requests in flight
+    async def forward(self, method, path, body, access_token, shared=False):
+        async def send():
+            response = await self.upstream.request(method, below_base(path, self.base_path), body or None)
+            return response.status, response.content
+        if shared:
+            status, content = await self.single_flight.do((method, path, body), send)
+        else:
+            status, content = await send()
+        self.note_answer(access_token, status)
+        return status, content
+
+    #Returns (status, content, etag) for a device request
+    async def handle(self, method, path, body):
+        parts, query = split_path(path, self.base_path)
+        access_token = query.get("access_token")
+
+        if method == "GET" and parts == ["gateway", "stats"]:
+            return 200, json.dumps(self.stats.counts).encode(), None
+
+        #Cobot's webhooks post {"url": ".../bookings/<id>"}; a local stand-in can add "resource_id"
+        if method == "POST" and parts == ["webhooks", "cobot"]:
+            if not self.webhook_secret:
+                return 403, b'{"error": "webhooks need --webhook-secret"}', None
+            if not hmac.compare_digest(query.get("secret", ""), self.webhook_secret):
+                return 403, b'{"error": "wrong webhook secret"}', None
+            self.stats.count("webhooks")
+            data = json.loads(body) if body else {}
+            booking_id = data.get("url", "").rstrip("/").split("/")[-1] or None
+            asyncio.ensure_future(self.booking_changed(booking_id, data.get("resource_id")))
+            return 204, b"", None
+
+        if method == "GET" and len(parts) == 2 and parts[0] == "check_in_tokens":
+            return await self.check_in_token(path, parts[1], access_token) + (None,)
+
+        if method == "GET" and len(parts) == 3 and parts[0] == "resources" and parts[2] == "bookings":
+            data = json.loads(body) if body else {}
+            if self.is_accepted(access_token) and "from" in data and "to" in data:
+                status, bookings = await self.batcher.bookings(self.upstream_token or access_token, parts[1], data["from"], data["to"])
+                if status != 200:
+                    return status, bookings, None
+                content = json.dumps(bookings).encode()
+                return 200, content, '"{}"'.format(hashlib.sha1(content).hexdigest())
+            return await self.forward(method, path, body, access_token, shared=True) + (None,)
+
+        if method != "GET":
+            status, content = await self.forward(method, path, body, access_token)
+            if 200 <= status < 300:
+                self.batcher.invalidate()
+                if parts[:1] == ["resources"] and len(parts) > 1:
+                    asyncio.ensure_future(self.booking_changed(created_booking_id(content), parts[1]))
+                elif parts[:1] == ["bookings"] and len(parts) > 1:
+                    asyncio.ensure_future(self.booking_changed(parts[1]))
+            return status, content, None
+
+        return await self.forward(method, path, body, access_token, shared=True) + (None,)
+
+    async def check_in_token(self, path, checkin_token, access_token):
+        if self.is_accepted(access_token):
+            cached = self.checkins.get(checkin_token)
+            if cached is not None:
+                ttl_s = self.checkin_ttl_s if cached[1] == 200 else CHECKIN_MISS_TTL_S
+                if time.monotonic() - cached[0] < ttl_s:
+                    self.stats.count("checkin_cache_hits")
+                    return cached[1], cached[2]
+
+        if self.upstream_token and self.is_accepted(access_token):
+            path = "{}/check_in_tokens/{}?access_token={}".format(self.base_path, checkin_token, self.upstream_token)
+        status, content = await self.forward("GET", path, None, access_token, shared=True)
+        if status in (200, 404):
+            self.checkins[checkin_token] = (time.monotonic(), status, content)
+        return status, content
+
+    ##### PUSH #####
+
+    #Drops cached fetches and notifies the devices watching the booking's resource, or every device if the
+    #resource can't be found out
+    async def booking_changed(self, booking_id, resource_id=None):
+        self.batcher.invalidate()
+        if resource_id is None:
+            resource_id = self.batcher.booking_resources.get(booking_id)
+        if resource_id is None and booking_id and self.upstream_token:
+            try:
+                response = await self.upstream.request("GET", "/bookings/{}?access_token={}".format(booking_id, self.upstream_token))
+                if response.status == 200:
+                    resource_id = resource_of(json.loads(response.content))
+            except Exception:
+                pass
+        if booking_id and resource_id is not None:
+            self.batcher.booking_resources[booking_id] = resource_id
+
+        if resource_id is None:
+            queues = [queue for queues in self.subscribers.values() for queue in queues]
+        else:
+            queues = self.subscribers.get(resource_id, ())
+        for queue in queues:
+            queue.put_nowait(True)
+
+    #Serves a change stream until the device disconnects
+    async def stream_changes(self, writer, resource_id, access_token):
+        if not self.is_accepted(access_token):
+            path = "{}/resources/{}/bookings?access_token={}".format(self.base_path, resource_id, access_token)
+            await self.forward("GET", path, None, access_token, shared=True)
+            if not self.is_accepted(access_token):
+                writer.write(b"HTTP/1.1 403 Error\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+                return
+
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(resource_id, set()).add(queue)
+        self.stats.count("subscriptions")
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            while True:
+                try:
+                    changed = [await asyncio.wait_for(queue.get(), PING_S)]
+                    #A burst of changes needs only one refresh
+                    while not queue.empty():
+                        changed.append(queue.get_nowait())
+                    if None in changed:
+                        break #The gateway is stopping
+                    writer.write("event: bookings\ndata: {}\n\n".format(resource_id).encode())
+                    self.stats.count("pushed")
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+                await writer.drain()
+        finally:
+            self.subscribers[resource_id].discard(queue)
+
+    ##### HTTP #####
+
+    async def serve_connection(self, reader, writer):
+        self.stats.count("device_connections")
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = await read_headers(reader)
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.stats.count("device_requests")
+
+                parts, query = split_path(path, self.base_path)
+                if method == "GET" and len(parts) == 3 and parts[0] == "resources" and parts[2] == "changes":
+                    await self.stream_changes(writer, parts[1], query.get("access_token"))
+                    break
+
+                try:
+                    status, content, etag = await self.handle(method, path, body)
+                except Exception as e:
+                    self.stats.count("upstream_errors")
+                    status, content, etag = 502, json.dumps({"error": "upstream unreachable: {}".format(e)}).encode(), None
+
+                response_headers = {"Content-Type": "application/json"}
+                if etag is not None:
+                    response_headers["ETag"] = etag
+                    if headers.get("if-none-match") == etag:
+                        self.stats.count("not_modified")
+                        status, content = 304, b""
+                response_headers["Content-Length"] = str(len(content))
+
+                reason = {200: "OK", 201: "Created", 204: "No Content", 304: "Not Modified"}.get(status, "Error")
+                head = "HTTP/1.1 {} {}\r\n".format(status, reason)
+                head += "".join("{}: {}\r\n".format(name, value) for name, value in response_headers.items())
+                writer.write(head.encode() + b"\r\n" + content)
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="0.0.0.0", port=8000):
+        self.server = await asyncio.start_server(self.serve_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for queues in self.subscribers.values():
+                for queue in queues:
+                    queue.put_nowait(None)
+            await self.server.wait_closed()
+        self.upstream.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Coalesce Cobot API traffic for a fleet of Booking Companions")
+    parser.add_argument("--upstream", default="https://members.motionlab.berlin/api", help="members API base URL")
+    parser.add_argument("--upstream-token", default=os.environ.get("GATEWAY_UPSTREAM_TOKEN"),
+                        help="token for batched fetches (default: $GATEWAY_UPSTREAM_TOKEN, else each device's own)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--base-path", default="/api", help="path devices put before the API paths in API_BASE_URL")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW_MS)
+    parser.add_argument("--bookings-ttl-s", type=float, default=BOOKINGS_TTL_S)
+    parser.add_argument("--checkin-ttl-s", type=float, default=CHECKIN_TTL_S)
+    parser.add_argument("--max-upstream-connections", type=int, default=MAX_UPSTREAM_CONNECTIONS)
+    parser.add_argument("--webhook-secret", default=os.environ.get("GATEWAY_WEBHOOK_SECRET"),
+                        help="secret query parameter Cobot's webhooks must carry (default: $GATEWAY_WEBHOOK_SECRET), webhooks are refused without one")
+    args = parser.parse_args()
+
+    async def run():
+        gateway = Gateway(args.upstream, args.upstream_token, args.base_path, args.batch_window_ms,
+                          args.bookings_ttl_s, args.checkin_ttl_s, args.max_upstream_connections, args.webhook_secret)
+        port = await gateway.start(args.host, args.port)
+        print("Gateway for {} listening on port {}".format(args.upstream, port), file=sys.stderr)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await gateway.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#Load test for the fleet gateway. Simulated devices, using the device's own ApiClient, poll their resource's
+#bookings, look up badges and book and unbook against a local FakeCobot: once talking to it directly and once
+#through the gateway. Upstream requests and device-side latency of the two runs are written as JSON, e.g.
+#   python gateway/load_test.py --devices 40 --duration-s 20 --upstream-latency-ms 80
+#Polling and swipes come much more often than on real devices, so a short run covers many refreshes.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+GATEWAY_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(GATEWAY_DIR)
+SIM_DIR = os.path.join(REPO_DIR, "sim")
+sys.path[:0] = [os.path.join(SIM_DIR, "shims"), SIM_DIR, os.path.join(REPO_DIR, "lib"), GATEWAY_DIR]
+
+import api_client
+from fake_cobot import FakeCobot, format_time, checkin_token
+from bench import summarize
+from gateway import Gateway
+
+MEMBERS = 50
+
+def member_uid(i):
+    return (0x04, 0x10, i // 256, i % 256, 0x20, 0x30, 0x40)
+
+def resource_id(i):
+    return "resource-{}".format(i)
+
+def setup_upstream(args, rng):
+    api = FakeCobot()
+    api.latency_ms = args.upstream_latency_ms
+    #Cobot doesn't send ETags, so devices talking to it directly only get the body hash to go on
+    api.send_etags = False
+    for i in range(MEMBERS):
+        api.add_member(member_uid(i), "member-{}".format(i))
+    now = time.time()
+    for i in range(args.devices):
+        for j in range(args.bookings_per_resource):
+            start = now + rng.randrange(-3, 10) * 3600
+            api.add_booking(resource_id(i), "member-{}".format(rng.randrange(MEMBERS)), start, start + 1800)
+    return api
+
+class Device:
+    def __init__(self, i, base_url, args, latencies, errors):
+        self.resource_id = resource_id(i)
+        self.access_token = "device-token-{}".format(i)
+        self.client = api_client.ApiClient(base_url)
+        self.args = args
+        self.latencies = latencies
+        self.errors = errors
+        self.rng = random.Random(i)
+        self.etag = None
+        self.booking_id = None
+
+    async def call(self, kind, method, path, json=None, headers=None):
+        started = time.monotonic()
+        try:
+            response = await self.client.request(method, path, json=json, headers=headers)
+        except Exception:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            return None
+        self.latencies.setdefault(kind, []).append((time.monotonic() - started) * 1000)
+        if response.status_code >= 500:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+        return response
+
+    async def refresh(self):
+        day_start = time.time() // 86400 * 86400
+        headers = {"If-None-Match": self.etag} if self.etag else None
+        response = await self.call("bookings", "GET",
+                                   "/resources/{}/bookings?access_token={}".format(self.resource_id, self.access_token),
+                                   json={"from": format_time(day_start), "to": format_time(day_start + 86400 + 3600)},
+                                   headers=headers)
+        if response is not None and response.status_code == 200:
+            self.etag = response.headers.get("etag")
+
+    async def swipe(self):
+        token = checkin_token(member_uid(self.rng.randrange(MEMBERS)))
+        response = await self.call("check_in_token", "GET", "/check_in_tokens/{}?access_token={}".format(token, self.access_token))
+        if response is None or response.status_code != 200:
+            return
+
+        if self.booking_id is not None:
+            await self.call("delete", "DELETE", "/bookings/{}?access_token={}".format(self.booking_id, self.access_token))
+            self.booking_id = None
+        else:
+            now = time.time()
+            response = await self.call("create", "POST", "/resources/{}/bookings?access_token={}".format(self.resource_id, self.access_token),
+                                       json={"membership_id": response.json()["membership"]["id"],
+                                             "from": format_time(now), "to": format_time(now + 60), "title": "Load test"})
+            if response is not None and response.status_code == 201:
+                self.booking_id = response.json()["id"]
+
+    async def run(self, until):
+        next_refresh = time.monotonic() + self.rng.uniform(0, self.args.refresh_s)
+        next_swipe = time.monotonic() + self.rng.uniform(0, self.args.swipe_s)
+        while True:
+            now = time.monotonic()
+            if now >= until:
+                break
+            if now >= next_refresh:
+                await self.refresh()
+                next_refresh = now + self.rng.uniform(0.5, 1.5) * self.args.refresh_s
+            elif now >= next_swipe:
+                await self.swipe()
+                next_swipe = now + self.rng.uniform(0.5, 1.5) * self.args.swipe_s
+            else:
+                await asyncio.sleep(min(next_refresh, next_swipe, until) - now)
+        await self.client.close()
+
+async def run_devices(base_url, args):
+    latencies = {}
+    errors = {}
+    until = time.monotonic() + args.duration_s
+    devices = [Device(i, base_url, args, latencies, errors) for i in range(args.devices)]
+    await asyncio.gather(*[device.run(until) for device in devices])
+    return latencies, errors
+
+def run_mode(mode, args):
+    api = setup_upstream(args, random.Random(args.seed))
+    upstream_url = api.start_in_thread()
+
+    async def run():
+        gateway = None
+        base_url = upstream_url
+        if mode == "gateway":
+            gateway = Gateway(upstream_url, args.upstream_token, batch_window_ms=args.batch_window_ms, bookings_ttl_s=args.bookings_ttl_s)
+            base_url = "http://127.0.0.1:{}/api".format(await gateway.start("127.0.0.1", 0))
+        try:
+            latencies, errors = await run_devices(base_url, args)
+        finally:
+            if gateway is not None:
+                await gateway.stop()
+        return latencies, errors, gateway.stats.counts if gateway is not None else None
+
+    try:
+        latencies, errors, gateway_stats = asyncio.run(run())
+    finally:
+        api.stop()
+
+    endpoints = {}
+    for method, path, status in api.requests:
+        endpoint = "{} /{}".format(method, path.split("?", 1)[0].strip("/").split("/")[1])
+        endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+    return {
+        "device_requests": sum(len(values) for values in latencies.values()) + sum(errors.values()),
+        "upstream_requests": len(api.requests),
+        "upstream_requests_by_endpoint": endpoints,
+        "latency_ms": {kind: summarize(values) for kind, values in latencies.items()},
+        "errors": errors,
+        "gateway": gateway_stats,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the fleet gateway against a local fake Cobot API")
+    parser.add_argument("--devices", type=int, default=30)
+    parser.add_argument("--duration-s", type=float, default=10.0)
+    parser.add_argument("--refresh-s", type=float, default=1.0, help="mean time between a device's booking fetches")
+    parser.add_argument("--swipe-s", type=float, default=3.0, help="mean time between a device's badge swipes")
+    parser.add_argument("--bookings-per-resource", type=int, default=4)
+    parser.add_argument("--upstream-latency-ms", type=float, default=50)
+    parser.add_argument("--upstream-token", default="gateway-token")
+    parser.add_argument("--batch-window-ms", type=float, default=20)
+    parser.add_argument("--bookings-ttl-s", type=float, default=10)
+    parser.add_argument("--mode", choices=("direct", "gateway", "both"), default="both")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = {"devices": args.devices, "duration_s": args.duration_s, "modes": {}}
+    for mode in ("direct", "gateway") if args.mode == "both" else (args.mode,):
+        print("Running {} ({} devices, {} s)".format(mode, args.devices, args.duration_s), file=sys.stderr)
+        results["modes"][mode] = run_mode(mode, args)
+    if args.mode == "both" and results["modes"]["direct"]["upstream_requests"]:
+        results["upstream_reduction"] = round(1 - results["modes"]["gateway"]["upstream_requests"] / results["modes"]["direct"]["upstream_requests"], 3)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
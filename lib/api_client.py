@@ -0,0 +1,393 @@
+import utime
+import random
+import uasyncio as asyncio
+import ujson
+
+import metrics
+
+#Awaitable stand-in for urequests, so a slow Cobot API call yields to the RFID and feedback tasks
+#instead of blocking the whole device
+
+class Response:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return str(self.content, "utf-8")
+
+    def json(self):
+        return ujson.loads(self.content)
+
+    def close(self):
+        self.content = b""
+
+#Splits e.g. https://members.motionlab.berlin/api/... into (use_ssl, host, port, path)
+def split_url(url):
+    scheme, _, rest = url.partition("://")
+    use_ssl = scheme == "https"
+    host, slash, path = rest.partition("/")
+    path = slash + path if slash else "/"
+
+    port = 443 if use_ssl else 80
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+
+    return use_ssl, host, port, path
+
+class StaleConnectionError(OSError):
+    pass
+
+#The interaction's latency budget ran out before the request could be sent or answered
+class DeadlineExceeded(OSError):
+    pass
+
+#The circuit breaker is open, so the request wasn't sent
+class CircuitOpenError(OSError):
+    pass
+
+#What happened to one request on the wire. Kept per request rather than on the client, which other tasks send
+#requests on at the same time; pass one to ApiClient.request to find out whether a failed request went out.
+class RequestState:
+    def __init__(self):
+        self.sent = False #The request was written, so if it failed its outcome is unknown
+        self.body_started = False #The response's body went to the sink, so it can't be retried
+
+async def read_headers(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise StaleConnectionError("connection closed before response")
+    status_code = int(status_line.split(None, 2)[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line or line == b"\r\n":
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    return status_code, headers
+
+CHUNK_SIZE = 512
+MAX_ERROR_BODY = 256 #Enough of an error response to log, the rest is read and dropped
+
+#Reads the body in chunks of at most CHUNK_SIZE and hands each one to feed(chunk)
+async def stream_body(reader, headers, feed):
+    if "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = await reader.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                raise OSError("connection closed mid-body")
+            remaining -= len(chunk)
+            feed(chunk)
+
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            remaining = int((await reader.readline()).split(b";", 1)[0], 16)
+            if remaining == 0:
+                await reader.readline()
+                break
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise OSError("connection closed mid-body")
+                remaining -= len(chunk)
+                feed(chunk)
+            await reader.readline()
+
+    else:
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            feed(chunk)
+
+#Wraps a sink's feed so the time spent parsing each chunk is traced
+def timed_feed(feed):
+    def feed_and_time(chunk):
+        started = metrics.start()
+        feed(chunk)
+        metrics.stop(metrics.JSON_PARSE, started)
+    return feed_and_time
+
+async def read_body(reader, headers):
+    chunks = []
+    await stream_body(reader, headers, chunks.append)
+    return b"".join(chunks)
+
+#Keeps only the start of a body, for logging error responses without buffering them whole
+class BoundedBody:
+    def __init__(self, limit=MAX_ERROR_BODY):
+        self.limit = limit
+        self.content = b""
+
+    def feed(self, chunk):
+        if len(self.content) < self.limit:
+            self.content += chunk[:self.limit - len(self.content)]
+
+def build_request(method, host, path, body, keep_alive=False, headers=None):
+    head = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: {}\r\n".format(method, path, host, "keep-alive" if keep_alive else "close")
+    if headers:
+        for name in headers:
+            head += "{}: {}\r\n".format(name, headers[name])
+    if body is not None:
+        head += "Content-Type: application/json\r\nContent-Length: {}\r\n".format(len(body))
+    return head.encode() + b"\r\n" + (body or b"")
+
+#Latency budget for one interaction, e.g. a badge swipe or a schedule refresh. While it is active, every request the
+#task makes on the client, retries included, has to finish within what is left of it. Budgets belong to the task
+#that started them, so a swipe and a refresh running side by side each keep their own.
+class Budget:
+    def __init__(self, client, budget_ms):
+        self.client = client
+        self.budget_ms = budget_ms
+        self.task = None
+
+    def __enter__(self):
+        self.task = asyncio.current_task()
+        self.client.deadlines[self.task] = utime.ticks_add(utime.ticks_ms(), self.budget_ms)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.deadlines.pop(self.task, None)
+
+#Stops sending requests to an API that keeps failing, so the device carries on from its local state instead of
+#waiting out timeouts. It opens after FAILURES_TO_OPEN failed requests in a row and then fails requests straight
+#away. Once the cooldown is over, the next request is let through as a trial: if it succeeds the breaker closes,
+#if not it opens again for twice as long.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    FAILURES_TO_OPEN = 3
+    COOLDOWN_MIN_MS = 15000
+    COOLDOWN_MAX_MS = 300000
+
+    def __init__(self, on_change=None):
+        self.state = self.CLOSED
+        self.failures = 0 #In a row
+        self.cooldown_ms = self.COOLDOWN_MIN_MS
+        self.opened_ms = 0
+        self.times_opened = 0
+        self.on_change = on_change #Called with the new state
+
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def set_state(self, state):
+        if state == self.OPEN:
+            self.opened_ms = utime.ticks_ms()
+            self.times_opened += 1
+        self.state = state
+        if self.on_change is not None:
+            self.on_change(state)
+
+    #Whether a request may be sent now
+    def allow(self):
+        if self.state == self.OPEN:
+            if utime.ticks_diff(utime.ticks_ms(), self.opened_ms) < self.cooldown_ms:
+                return False
+            self.set_state(self.HALF_OPEN)
+        return True
+
+    def succeeded(self):
+        self.failures = 0
+        self.cooldown_ms = self.COOLDOWN_MIN_MS
+        if self.state != self.CLOSED:
+            self.set_state(self.CLOSED)
+
+    def failed(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.cooldown_ms = min(self.cooldown_ms * 2, self.COOLDOWN_MAX_MS)
+            self.set_state(self.OPEN)
+        elif self.state == self.CLOSED and self.failures >= self.FAILURES_TO_OPEN:
+            self.set_state(self.OPEN)
+
+#Shared client holding one persistent HTTP/1.1 connection to an API host, so only the first request
+#after boot (or after the server drops the connection) pays for the TCP and TLS handshakes
+class ApiClient:
+    CONNECT_TIMEOUT_S = 5
+    READ_TIMEOUT_S = 10
+    KEEP_ALIVE_IDLE_MS = 50000 #Reconnect rather than reuse a connection the server has likely dropped
+    #Requests that are safe to send twice are retried this many times in all after a failure or a 5xx/429, with
+    #random backoff of up to RETRY_BACKOFF_MS doubling each time. Creating and deleting bookings are sent once and
+    #left to the journal, since a retried POST could book twice and a retried DELETE could look like a rejection.
+    ATTEMPTS = 3
+    RETRY_BACKOFF_MS = 250
+    RETRY_METHODS = ("GET", "PUT")
+
+    def __init__(self, base_url, connect_timeout_s=CONNECT_TIMEOUT_S, read_timeout_s=READ_TIMEOUT_S):
+        self.use_ssl, self.host, self.port, self.base_path = split_url(base_url)
+        self.base_path = self.base_path.rstrip("/")
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+
+        self.reader = None
+        self.writer = None
+        self.last_used_ms = 0
+        self.lock = asyncio.Lock() #Requests on the shared connection must not interleave
+        self.connections_opened = 0
+
+        self.breaker = CircuitBreaker()
+        self.deadlines = {} #Task -> ticks_ms its current Budget runs out at
+        self.retries = 0
+        self.deadlines_exceeded = 0
+        self.short_circuited = 0 #Requests failed straight away by the open breaker
+
+    #Starts a latency budget for the requests of one interaction: with client.budget(ms): ...
+    def budget(self, budget_ms):
+        return Budget(self, budget_ms)
+
+    #ticks_ms the calling task's budget runs out at, None without one
+    def deadline_ms(self):
+        return self.deadlines.get(asyncio.current_task())
+
+    #Seconds a step may take: its own timeout, or less if that's all that is left of the budget
+    def time_left_s(self, timeout_s):
+        deadline_ms = self.deadline_ms()
+        if deadline_ms is None:
+            return timeout_s
+        left_ms = utime.ticks_diff(deadline_ms, utime.ticks_ms())
+        if left_ms <= 0:
+            raise DeadlineExceeded("latency budget used up")
+        return min(timeout_s, left_ms / 1000)
+
+    #Breaker and retry state, for the metrics endpoint
+    def state(self):
+        return {
+            "breaker": self.breaker.state,
+            "failures_in_a_row": self.breaker.failures,
+            "times_opened": self.breaker.times_opened,
+            "cooldown_ms": self.breaker.cooldown_ms,
+            "retries": self.retries,
+            "deadlines_exceeded": self.deadlines_exceeded,
+            "short_circuited": self.short_circuited,
+            "connections_opened": self.connections_opened,
+        }
+
+    async def connect(self):
+        await self.close()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=True if self.use_ssl else None),
+            self.time_left_s(self.connect_timeout_s))
+        self.connections_opened += 1
+
+    async def close(self):
+        if self.writer is not None:
+            writer = self.writer
+            self.reader = None
+            self.writer = None
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def is_connection_fresh(self):
+        return self.writer is not None and utime.ticks_diff(utime.ticks_ms(), self.last_used_ms) < self.KEEP_ALIVE_IDLE_MS
+
+    #With a sink, successful bodies go to sink.feed(chunk) as they arrive and only the start of error bodies is kept
+    async def read_response(self, state, sink=None):
+        status_code, headers = await read_headers(self.reader)
+        if sink is None:
+            content = await read_body(self.reader, headers)
+        elif 200 <= status_code < 300:
+            state.body_started = True
+            await stream_body(self.reader, headers, timed_feed(sink.feed))
+            content = b""
+        else:
+            error_body = BoundedBody()
+            await stream_body(self.reader, headers, error_body.feed)
+            content = error_body.content
+
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return Response(status_code, headers, content)
+
+    #Sends one request on the shared connection, reconnecting once if a reused connection turned out to be stale and
+    #the method is in RETRY_METHODS, and retrying as described at ATTEMPTS. See read_response for sink. Raises CircuitOpenError without sending
+    #anything while the breaker is open. Each attempt, including waiting for the connection, is traced as an API call.
+    #state, a RequestState, is filled in as the request goes out.
+    async def request(self, method, path, json=None, headers=None, sink=None, state=None):
+        if state is None:
+            state = RequestState()
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise CircuitOpenError("API unavailable, circuit breaker open")
+
+        attempts = self.ATTEMPTS if method in self.RETRY_METHODS else 1
+        for attempt in range(attempts):
+            response = None
+            error = None
+            started = metrics.start()
+            try:
+                response = await self.send(method, path, json, headers, sink, state)
+            except DeadlineExceeded:
+                #Out of time for this interaction, which says nothing about the API
+                self.deadlines_exceeded += 1
+                metrics.error(metrics.API_CALL)
+                raise
+            except Exception as e:
+                error = e
+            finally:
+                metrics.stop(metrics.API_CALL, started)
+
+            if error is None and response.status_code < 500 and response.status_code != 429:
+                self.breaker.succeeded()
+                return response
+            metrics.error(metrics.API_CALL)
+            #A body already handed to the sink can't be taken back
+            if attempt + 1 == attempts or state.body_started or not await self.back_off(attempt):
+                break
+            self.retries += 1
+
+        self.breaker.failed()
+        if error is not None:
+            raise error
+        return response
+
+    #Waits a random time before retry number attempt + 1, returns False if the budget doesn't allow for it
+    async def back_off(self, attempt):
+        delay_ms = random.randint(0, self.RETRY_BACKOFF_MS << attempt)
+        deadline_ms = self.deadline_ms()
+        if deadline_ms is not None and utime.ticks_diff(deadline_ms, utime.ticks_ms()) < delay_ms + self.RETRY_BACKOFF_MS:
+            return False
+        await asyncio.sleep_ms(delay_ms)
+        return True
+
+    async def send(self, method, path, json, headers, sink, state):
+        body = ujson.dumps(json).encode() if json is not None else None
+        message = build_request(method, self.host, self.base_path + path, body, keep_alive=True, headers=headers)
+
+        async with self.lock:
+            for attempt in range(2):
+                reused = self.is_connection_fresh()
+                try:
+                    response = await self.exchange(message, sink, reused, state)
+                    self.last_used_ms = utime.ticks_ms()
+                    return response
+                except StaleConnectionError:
+                    #The server may have acted on the request before dropping the connection, so only requests that
+                    #are safe to send twice are sent again; the rest fail as sent, with their outcome unknown
+                    await self.close()
+                    if not reused or attempt or method not in self.RETRY_METHODS:
+                        raise
+                except BaseException:
+                    #A timed out or half-read response leaves the connection unusable
+                    await self.close()
+                    raise
+
+    #One HTTP request and its response, on the open connection if reused and on a new one otherwise
+    async def exchange(self, message, sink, reused, state):
+        if not reused:
+            await self.connect()
+        state.sent = True
+        self.writer.write(message)
+        await asyncio.wait_for(self.writer.drain(), self.time_left_s(self.read_timeout_s))
+        return await asyncio.wait_for(self.read_response(state, sink), self.time_left_s(self.read_timeout_s))
@@ -0,0 +1,98 @@
+import epoch_time
+import metrics
+
+#Strip of pixels showing the day's availability, one pixel per half hour from the strip's start hour: red while
+#the slot has a booking in it, green while it's free, and off once it's over.
+#Core 0 keeps which slots are booked as the bits of one small int (SlotBitmap), built in one pass over the day's
+#schedule and afterwards only rechecked for the slots a booking was created, moved or deleted in. The UI core
+#(StripRenderer) sets only the pixels that differ from what the strip shows and sends them in one write.
+
+SLOT_S = 30 * 60
+SLOTS = 30 #Fits the bitmap in a MicroPython small int, so updating it never allocates
+
+BOOKED = (32, 0, 0)
+FREE = (0, 32, 0)
+OVER = (0, 0, 0)
+
+class SlotBitmap:
+    def __init__(self, start_hour_utc=6):
+        self.start_offset_s = start_hour_utc * 3600
+        self.day_start = None
+        self.booked = 0 #Bit i is set while slot i has a booking in it
+
+    def slot_start(self, i):
+        return self.day_start + self.start_offset_s + i * SLOT_S
+
+    #Bits of the slots overlapping [start, end)
+    def bits_between(self, start, end):
+        strip_start = self.slot_start(0)
+        first = max(0, (start - strip_start) // SLOT_S)
+        last = min(SLOTS, (end - strip_start + SLOT_S - 1) // SLOT_S)
+        if first >= last:
+            return 0
+        return ((1 << (last - first)) - 1) << first
+
+    #Brings the bits in line with the schedule: from scratch on a new day, otherwise only where it changed
+    def update(self, schedule, now):
+        changed = schedule.take_changed()
+        day_start = epoch_time.start_of_day(now)
+        if day_start != self.day_start:
+            self.day_start = day_start
+            booked = 0
+            for i in range(len(schedule)):
+                booked |= self.bits_between(schedule.starts[i], schedule.ends[i])
+            self.booked = booked
+        elif changed is not None:
+            touched = self.bits_between(changed[0], changed[1])
+            i = 0
+            while touched >> i:
+                if touched >> i & 1:
+                    start = self.slot_start(i)
+                    if schedule.first_booking_between(start, start + SLOT_S) is None:
+                        self.booked &= ~(1 << i)
+                    else:
+                        self.booked |= 1 << i
+                i += 1
+
+    #Number of slots that are over at now
+    def slots_over(self, now):
+        return min(SLOTS, max(0, (now - self.slot_start(0)) // SLOT_S))
+
+    #Next time the strip changes without the schedule changing: the end of the current slot, or the next day
+    def next_change(self, now):
+        over = self.slots_over(now)
+        if over < SLOTS:
+            return self.slot_start(over + 1)
+        return self.day_start + 86400
+
+class StripRenderer:
+    #pixels is a NeoPixel with SLOTS pixels
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.booked = 0
+        self.over = 0
+        self.shown = False
+
+    def show(self, booked, slots_over):
+        over = (1 << slots_over) - 1
+        changed = (booked ^ self.booked) | (over ^ self.over)
+        if self.shown and not changed:
+            return
+        if not self.shown:
+            changed = (1 << SLOTS) - 1
+
+        started = metrics.start()
+        for i in range(SLOTS):
+            if changed >> i & 1:
+                if over >> i & 1:
+                    self.pixels[i] = OVER
+                elif booked >> i & 1:
+                    self.pixels[i] = BOOKED
+                else:
+                    self.pixels[i] = FREE
+        self.pixels.write()
+        metrics.stop(metrics.LED, started)
+
+        self.booked = booked
+        self.over = over
+        self.shown = True
@@ -0,0 +1,31 @@
+import epoch_time
+
+#Fixed-layout booking held in the schedule and main loop state in place of the decoded API dict.
+#start and end are parsed to epoch seconds once, when the booking arrives, so the loop only compares integers.
+
+class Booking:
+    __slots__ = ("id", "membership_id", "start", "end")
+
+    def __init__(self, booking_id, membership_id, start, end):
+        self.id = booking_id
+        self.membership_id = membership_id
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other):
+        return (isinstance(other, Booking)
+                and self.id == other.id
+                and self.membership_id == other.membership_id
+                and self.start == other.start
+                and self.end == other.end)
+
+    def __repr__(self):
+        return "Booking({}, membership {}, {} to {})".format(self.id, self.membership_id, epoch_time.format(self.start), epoch_time.format(self.end))
+
+    #Returns a copy with a different start or end, for changes made before the API has confirmed them
+    def with_times(self, start, end):
+        return Booking(self.id, self.membership_id, start, end)
+
+#Builds a Booking from the fields json_stream extracted from an API response
+def from_record(record):
+    return Booking(record["id"], record["membership_id"], epoch_time.parse(record["from"]), epoch_time.parse(record["to"]))
@@ -0,0 +1,30 @@
+import _thread
+
+#Fixed-size FIFO for handing messages between the two cores. Both ends only ever hold the lock for a list
+#append or pop, so neither core can be held up by the other's work.
+
+class BoundedQueue:
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = []
+        self.lock = _thread.allocate_lock()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    #Returns False, dropping the item, if the queue is full
+    def put(self, item):
+        with self.lock:
+            if len(self.items) >= self.max_items:
+                self.dropped += 1
+                return False
+            self.items.append(item)
+            return True
+
+    #Returns the oldest item, or None if the queue is empty
+    def get(self):
+        with self.lock:
+            if self.items:
+                return self.items.pop(0)
+            return None
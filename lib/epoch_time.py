@@ -0,0 +1,102 @@
+import utime
+
+#Integer epoch arithmetic for Cobot timestamps ("YYYY/MM/DD HH:MM:SS +0000"). Times are seconds in the
+#device's own epoch, the same scale as utime.time(), so they can be compared and offset with plain integer
+#maths instead of building 8-tuples for utime.mktime and converting back with utime.localtime.
+
+SECONDS_PER_DAY = 86400
+
+#Days since 1970-01-01 for a proleptic Gregorian date (H. Hinnant's days_from_civil)
+def days_from_civil(year, month, day):
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+#Inverse of days_from_civil, returns (year, month, day)
+def civil_from_days(days):
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + (3 if month_index < 10 else -9)
+    year = year_of_era + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+#Days between 1970-01-01 and the device epoch (2000-01-01 on older rp2 firmware, 1970-01-01 on newer)
+_device_epoch = utime.gmtime(0)
+EPOCH_DAY_OFFSET = days_from_civil(_device_epoch[0], _device_epoch[1], _device_epoch[2])
+del _device_epoch
+
+def from_civil(year, month, day, hours=0, minutes=0, seconds=0):
+    return (days_from_civil(year, month, day) - EPOCH_DAY_OFFSET) * SECONDS_PER_DAY + hours * 3600 + minutes * 60 + seconds
+
+def start_of_day(t):
+    return t - t % SECONDS_PER_DAY
+
+def start_of_minute(t):
+    return t - t % 60
+
+def _read_int(time_string, start, length):
+    value = 0
+    for i in range(start, start + length):
+        value = value * 10 + ord(time_string[i]) - 48
+    return value
+
+#Parsed timestamps by string, so booking bounds compared on every loop iteration are only parsed once
+_parsed = {}
+MAX_PARSED = 32
+
+#Returns the epoch seconds for a Cobot timestamp, e.g. 2022/12/05 09:42:00 +0000
+def parse(time_string):
+    t = _parsed.get(time_string)
+    if t is not None:
+        return t
+
+    t = from_civil(_read_int(time_string, 0, 4),    #year
+                   _read_int(time_string, 5, 2),    #month
+                   _read_int(time_string, 8, 2),    #date
+                   _read_int(time_string, 11, 2),   #hours
+                   _read_int(time_string, 14, 2),   #minutes
+                   _read_int(time_string, 17, 2))   #seconds
+
+    #UTC offset, e.g. +0100 means the wall-clock time is an hour ahead of UTC
+    if len(time_string) >= 25:
+        offset = _read_int(time_string, 21, 2) * 3600 + _read_int(time_string, 23, 2) * 60
+        t += offset if time_string[20] == "-" else -offset
+
+    if len(_parsed) >= MAX_PARSED:
+        _parsed.clear()
+    _parsed[time_string] = t
+    return t
+
+_buffer = bytearray(b"0000/00/00 00:00:00 +0000")
+
+def _write_int(buffer, start, length, value):
+    for i in range(start + length - 1, start - 1, -1):
+        buffer[i] = 48 + value % 10
+        value //= 10
+
+#Writes t into buffer as a Cobot timestamp in UTC, buffer must be laid out like _buffer
+def format_into(buffer, t):
+    days = t // SECONDS_PER_DAY
+    seconds_of_day = t - days * SECONDS_PER_DAY
+    year, month, day = civil_from_days(days + EPOCH_DAY_OFFSET)
+
+    _write_int(buffer, 0, 4, year)
+    _write_int(buffer, 5, 2, month)
+    _write_int(buffer, 8, 2, day)
+    _write_int(buffer, 11, 2, seconds_of_day // 3600)
+    _write_int(buffer, 14, 2, seconds_of_day // 60 % 60)
+    _write_int(buffer, 17, 2, seconds_of_day % 60)
+    return buffer
+
+#Returns t as a Cobot timestamp string in UTC
+def format(t):
+    return str(format_into(_buffer, t), "ascii")
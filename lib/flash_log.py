@@ -0,0 +1,150 @@
+import os
+import utime
+import ustruct
+import _thread
+import uasyncio as asyncio
+
+import epoch_time
+
+#Binary append-only log on flash. Records are fixed-size and carry a message ID from log_messages instead of
+#formatted text, so logging is a pack into a RAM buffer. The buffer is written out in batches: when it fills,
+#when an error is logged, or every FLUSH_S. Only core 0, which loads the log, writes to flash: records logged on
+#the UI core wait in the buffer for flush_task, so a flash write never stalls the UI loop or runs alongside core
+#0's own file writes. The log rotates over SEGMENT_COUNT files, overwriting the oldest, so it survives reboots in
+#bounded space. tools/decode_log.py turns the segments back into text.
+
+SEGMENT_COUNT = 4
+SEGMENT_RECORDS = 256
+BUFFER_RECORDS = 16
+FLUSH_S = 30
+
+INFO = 1
+ERROR = 2
+
+MAGIC = b"MLOG"
+VERSION = 1
+#Segment header: magic, version, record size, segment sequence number (counts up across rotations)
+HEADER_FORMAT = "<4sBBHI"
+HEADER_SIZE = ustruct.calcsize(HEADER_FORMAT)
+#Record: Unix time, ticks_ms, message ID, level, text length, number, text
+RECORD_FORMAT = "<IIHBBi32s"
+RECORD_SIZE = ustruct.calcsize(RECORD_FORMAT)
+TEXT_SIZE = 32
+
+UNIX_OFFSET_S = epoch_time.EPOCH_DAY_OFFSET * epoch_time.SECONDS_PER_DAY
+
+def segment_name(prefix, i):
+    return "{}_{}.bin".format(prefix, i)
+
+class FlashLog:
+    def __init__(self, prefix="log"):
+        self.prefix = prefix
+        self.buffer = bytearray(BUFFER_RECORDS * RECORD_SIZE)
+        self.spare = bytearray(BUFFER_RECORDS * RECORD_SIZE) #Takes new records while the buffer is written out
+        self.buffered = 0
+        self.lock = _thread.allocate_lock() #Both cores log
+        self.writer_thread = _thread.get_ident() #Core 0, the only one that writes to flash
+        self.flush_wanted = asyncio.ThreadSafeFlag() #Set by the UI core when the buffer should be written out
+        self.segment = 0
+        self.sequence = 0
+        self.segment_records = SEGMENT_RECORDS #Full until load() finds the newest segment, so the first write rotates
+        self.dropped = 0
+
+    #Finds the newest segment so logging carries on where the last boot stopped
+    def load(self):
+        for i in range(SEGMENT_COUNT):
+            try:
+                with open(segment_name(self.prefix, i), "rb") as f:
+                    magic, version, record_size, reserved, sequence = ustruct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+                size = os.stat(segment_name(self.prefix, i))[6]
+            except Exception:
+                continue
+            if magic != MAGIC or record_size != RECORD_SIZE or sequence < self.sequence:
+                continue
+            self.segment = i
+            self.sequence = sequence
+            records, partial = divmod(size - HEADER_SIZE, RECORD_SIZE)
+            #A record cut short by a power loss would misalign everything after it, so start a new segment
+            self.segment_records = SEGMENT_RECORDS if partial else records
+
+    def log(self, level, message_id, text=None, number=0):
+        if text is None:
+            text = b""
+        elif not isinstance(text, (bytes, bytearray)):
+            text = str(text).encode()
+        text = text[:TEXT_SIZE]
+
+        is_writer = _thread.get_ident() == self.writer_thread
+        if is_writer and self.buffered == BUFFER_RECORDS:
+            self.flush()
+        with self.lock:
+            if self.buffered == BUFFER_RECORDS:
+                self.dropped += 1
+            else:
+                ustruct.pack_into(RECORD_FORMAT, self.buffer, self.buffered * RECORD_SIZE,
+                                  utime.time() + UNIX_OFFSET_S, utime.ticks_ms(), message_id, level, len(text), number, text)
+                self.buffered += 1
+            due = level == ERROR or self.buffered == BUFFER_RECORDS
+        if not due:
+            return
+        if is_writer:
+            self.flush()
+        else:
+            self.flush_wanted.set()
+
+    def info(self, message_id, text=None, number=0):
+        self.log(INFO, message_id, text, number)
+
+    def error(self, message_id, text=None, number=0):
+        self.log(ERROR, message_id, text, number)
+
+    #Writes the buffered records out. Only called on core 0; the lock is held just to swap buffers, so the UI core
+    #can keep logging during the write.
+    def flush(self):
+        with self.lock:
+            buffer, count = self.buffer, self.buffered
+            self.buffer, self.spare = self.spare, buffer
+            self.buffered = 0
+        if count:
+            self.write(buffer, count)
+
+    #Writes count records from buffer, rotating to the next segment when the current one is full
+    def write(self, buffer, count):
+        written = 0
+        try:
+            while written < count:
+                if self.segment_records >= SEGMENT_RECORDS:
+                    self.segment = (self.segment + 1) % SEGMENT_COUNT
+                    self.sequence += 1
+                    with open(segment_name(self.prefix, self.segment), "wb") as f:
+                        f.write(ustruct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE, 0, self.sequence))
+                    self.segment_records = 0
+
+                batch = min(count - written, SEGMENT_RECORDS - self.segment_records)
+                with open(segment_name(self.prefix, self.segment), "ab") as f:
+                    f.write(memoryview(buffer)[written * RECORD_SIZE:(written + batch) * RECORD_SIZE])
+                self.segment_records += batch
+                written += batch
+        except Exception as e:
+            print("Writing log to flash failed: {}\n".format(e))
+        finally:
+            #Whatever couldn't be written is dropped rather than retried forever on a failing flash
+            if written < count:
+                with self.lock:
+                    self.dropped += count - written
+
+    #Flushes batched records every FLUSH_S, and as soon as the UI core logs an error or fills the buffer
+    async def flush_task(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_wanted.wait(), FLUSH_S)
+            except asyncio.TimeoutError:
+                pass
+            if self.buffered:
+                self.flush()
+
+#The device's log, shared by every module
+log = FlashLog()
+info = log.info
+error = log.error
+flush = log.flush
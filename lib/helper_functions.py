@@ -1,148 +1,234 @@
 import os
 import utime
-import logging
-import urequests
+import uasyncio as asyncio
+import uhashlib
 import ntptime
 import network
 
+import api_client
+import epoch_time
+from json_stream import RecordExtractor, BOOKING_FIELDS
+import booking_record
+import metrics
+import flash_log
+import log_messages
+
 import secrets
   
-logging.basicConfig(filename="log_{}.txt".format(secrets.RESOURCE_ID), filemode='w', format="%(asctime)s:%(levelname)-7s:%(name)s:%(message)s")
-logger = logging.getLogger("api_helper_logger")
+
+#Every members API helper shares this client and its keep-alive connection.
+#API_BASE_URL in secrets.py can point the device at a local fake API for testing.
+cobot_api = api_client.ApiClient(getattr(secrets, "API_BASE_URL", "https://members.motionlab.berlin/api"))
+
+#Length of on-site bookings, set per resource in secrets.py. A booking is cut short to end when the next one starts,
+#and not made at all if that would leave less than the minimum.
+BOOKING_DEFAULT_S = getattr(secrets, "BOOKING_DEFAULT_MINUTES", 30) * 60
+BOOKING_MINIMUM_S = getattr(secrets, "BOOKING_MINIMUM_MINUTES", 10) * 60
+
+BOOKING_UNCONFIRMED = "unconfirmed" #See create_booking
+
+#Tokens come from Cobot itself rather than from behind API_BASE_URL
+OAUTH_BASE_URL = "https://www.cobot.me/oauth"
+TOKEN_BUDGET_MS = 15000
 
 ##### API FUNCTIONS #####
 
 #Returns access token required for interacting with the Cobot API
-def get_access_token(client_id, client_secret, scope, admin_email, admin_password):
+async def get_access_token(client_id, client_secret, scope, admin_email, admin_password):
     access_token = ""
     print("Attempting to retrieve Token with scopes: {}".format(scope))
 
+    oauth_api = api_client.ApiClient(OAUTH_BASE_URL)
+    request = None
     try:
-        request = urequests.post(
-            "https://www.cobot.me/oauth/access_token?scope="
-            + scope
-            + "&grant_type=password&username="
-            + admin_email
-            + "&password="
-            + admin_password
-            + "&client_id="
-            + client_id
-            + "&client_secret="
-            + client_secret
-        ) 
+        with oauth_api.budget(TOKEN_BUDGET_MS):
+            request = await oauth_api.request("POST",
+                "/access_token?scope="
+                + scope
+                + "&grant_type=password&username="
+                + admin_email
+                + "&password="
+                + admin_password
+                + "&client_id="
+                + client_id
+                + "&client_secret="
+                + client_secret
+            )
         if request.status_code == 200:
             access_token = request.json()["access_token"]
             print("Successfully retrieved access token with scopes: {}\n".format(scope))
             return access_token
         else:
-            logging.error("get_oauth_token failed withstatus code %d and response %s" % (request.status_code,request.json()))
+            flash_log.error(log_messages.ACCESS_TOKEN_STATUS, request.content, request.status_code)
     except Exception as e:
-        logging.error("get_oauth_token failed with exception: %s" % e)
-
-#Returns membership id from check-in token 
-def get_membership_id(user_checkin_token, access_token, last_user_token_and_id):
-    membership_id = ""
+        flash_log.error(log_messages.ACCESS_TOKEN_FAILED, e)
+    finally:
+        await oauth_api.close()
+        if request is not None:
+            request.close()
+
+#Returns membership id from check-in token, asking the API only when the membership cache has no fresh entry
+async def get_membership_id(user_checkin_token, access_token, membership_cache):
+    membership_id = membership_cache.get(user_checkin_token)
     
-    if user_checkin_token in last_user_token_and_id:
-        membership_id = last_user_token_and_id[user_checkin_token]
+    if membership_id is not None:
         print("Membership ID was already locally available: {}\n".format(membership_id))
     else:
+        membership_id = ""
+        request = None
         try:
-            request = urequests.get(
-                "https://members.motionlab.berlin/api/check_in_tokens/"
+            extractor = RecordExtractor({("membership", "id"): "id"}, 1)
+            request = await cobot_api.request("GET",
+                "/check_in_tokens/"
                 + user_checkin_token
                 + "?access_token="
-                + access_token
+                + access_token,
+                sink=extractor
             )
 
             if request.status_code == 200:
-                membership_id = request.json()["membership"]["id"]
+                membership_id = extractor.records[0]["id"]
+                membership_cache.put(user_checkin_token, membership_id)
                 print("Associated membership id: {}\n".format(membership_id))
             else:
-                logging.error("get_membership_id returned status code %d and following response: %s" % (request.status_code, request.json()))
+                flash_log.error(log_messages.MEMBERSHIP_STATUS, request.content, request.status_code)
         except Exception as e:
-            logging.error("get_membership_id had following exception: %s" % e)
+            flash_log.error(log_messages.MEMBERSHIP_FAILED, e)
+        finally:
+            if request is not None:
+                request.close()
         
     return membership_id
 
-def get_bookings_in_range(resource_id, access_token, time_range_start, time_range_end):
-    bookings = []
+#Returns the list of Bookings overlapping the given range, or None if they could not be fetched
+async def get_bookings_in_range(resource_id, access_token, time_range_start, time_range_end):
+    bookings = None
     
     data = {"from": time_range_start, "to": time_range_end}
     
+    request = None
     try:
-        request = urequests.get("https://members.motionlab.berlin/api/resources/"
-                                + resource_id
-                                + "/bookings?access_token="
-                                + access_token,
-                                json=data)
+        extractor = RecordExtractor(BOOKING_FIELDS, 2, factory=booking_record.from_record)
+        request = await cobot_api.request("GET",
+                                          "/resources/"
+                                          + resource_id
+                                          + "/bookings?access_token="
+                                          + access_token,
+                                          json=data,
+                                          sink=extractor)
         if request.status_code == 200:
+            bookings = extractor.records
 
-            if request.json():
-                bookings = request.json()
-                print("Resource is booked at some point between {} and {}: {}\n".format(time_range_start, time_range_end, current_booking))
+            if bookings:
+                print("Resource is booked at some point between {} and {}: {}\n".format(time_range_start, time_range_end, bookings))
             else:
                 print("Resource is not booked at any point between {} and {}\n".format(time_range_start, time_range_end))
         else:
-            logging.error("get_booking_in_range failed with the following status code: %d" % request.status_code())
-            logging.error(request.json())
+            flash_log.error(log_messages.BOOKINGS_IN_RANGE_STATUS, request.content, request.status_code)
     except Exception as e:
-            logging.error("get_booking_in_range failed following exception: %s" % e)
+            flash_log.error(log_messages.BOOKINGS_IN_RANGE_FAILED, e)
+    finally:
+        if request is not None:
+            request.close()
 
     return bookings
 
-def get_current_booking(resource_id, access_token):
-    current_booking = {}
-    now = get_now()
-    time_range_start = create_formatted_time_string(now)
-    
-    one_minute_from_now = utime.localtime(utime.mktime((now[0],
-                                                        now[1],
-                                                        now[2],
-                                                        now[3],
-                                                        now[4] + 1,
-                                                        now[5],
-                                                        now[6],
-                                                        now[7])))
-    time_range_end = create_formatted_time_string(one_minute_from_now)
+#Fetches the bookings in a range only if they changed since the last call with the same sync_state.
+#Returns (True, bookings) if they changed, (False, None) if not, or None if they could not be fetched.
+#Servers that send an ETag or Last-Modified header answer unchanged ranges with an empty 304; for the rest a hash
+#of the body, taken while it streams through the parser, catches an unchanged response before it is applied.
+async def get_bookings_if_changed(resource_id, access_token, time_range_start, time_range_end, sync_state):
+    result = None
+    data = {"from": time_range_start, "to": time_range_end}
+
+    if sync_state.get("range") != (time_range_start, time_range_end):
+        sync_state.clear()
+        sync_state["range"] = (time_range_start, time_range_end)
+
+    headers = {}
+    if "etag" in sync_state:
+        headers["If-None-Match"] = sync_state["etag"]
+    if "last-modified" in sync_state:
+        headers["If-Modified-Since"] = sync_state["last-modified"]
+
+    request = None
+    try:
+        extractor = RecordExtractor(BOOKING_FIELDS, 2, factory=booking_record.from_record, hasher=uhashlib.sha256())
+        request = await cobot_api.request("GET",
+                                          "/resources/"
+                                          + resource_id
+                                          + "/bookings?access_token="
+                                          + access_token,
+                                          json=data,
+                                          headers=headers,
+                                          sink=extractor)
+        if request.status_code == 304:
+            result = (False, None)
+        elif request.status_code == 200:
+            for name in ("etag", "last-modified"):
+                if name in request.headers:
+                    sync_state[name] = request.headers[name]
+
+            content_hash = extractor.hasher.digest()
+            if content_hash == sync_state.get("hash"):
+                result = (False, None)
+            else:
+                sync_state["hash"] = content_hash
+                result = (True, extractor.records)
+        else:
+            flash_log.error(log_messages.BOOKINGS_IF_CHANGED_STATUS, request.content, request.status_code)
+    except Exception as e:
+            flash_log.error(log_messages.BOOKINGS_IF_CHANGED_FAILED, e)
+    finally:
+        if request is not None:
+            request.close()
+
+    return result
+
+#Returns the Booking running in the next minute, or None
+async def get_current_booking(resource_id, access_token):
+    current_booking = None
+    now = epoch_time.start_of_minute(utime.time())
+    time_range_start = epoch_time.format(now)
+    time_range_end = epoch_time.format(now + 60)
                 
     data = {"from": time_range_start, "to": time_range_end}
 
+    request = None
     try:
-        request = urequests.get("https://members.motionlab.berlin/api/resources/"
-                                + resource_id
-                                + "/bookings?access_token="
-                                + access_token,
-                                json=data)
+        extractor = RecordExtractor(BOOKING_FIELDS, 2, max_records=1, factory=booking_record.from_record)
+        request = await cobot_api.request("GET",
+                                          "/resources/"
+                                          + resource_id
+                                          + "/bookings?access_token="
+                                          + access_token,
+                                          json=data,
+                                          sink=extractor)
         if request.status_code == 200:
 
-            if request.json():
-                current_booking = request.json()[0]
+            if extractor.records:
+                current_booking = extractor.records[0]
                 print("Resource is booked: {}\n".format(current_booking))
             else:
                 print("Resource is not currently booked\n")
         else:
-            logging.error("get_current_booking failed with the following status code: %d" % request.status_code())
-            logging.error(request.json())
+            flash_log.error(log_messages.CURRENT_BOOKING_STATUS, request.content, request.status_code)
     except Exception as e:
-            logging.error("get_current_booking failed following exception: %s" % e)
+            flash_log.error(log_messages.CURRENT_BOOKING_FAILED, e)
+    finally:
+        if request is not None:
+            request.close()
 
     return current_booking
 
-def create_booking(membership_id, access_token, resource_id):
-    booking = {}
-    now = get_now()
-    booking_starting_time = create_formatted_time_string(now)
-
-    thirty_minutes_from_now = utime.localtime(utime.mktime((now[0],
-                                                            now[1],
-                                                            now[2],
-                                                            now[3],
-                                                            now[4] + 30,
-                                                            now[5],
-                                                            now[6],
-                                                            now[7])))
-    booking_ending_time = create_formatted_time_string(thirty_minutes_from_now)
+#Returns the created Booking, False if the API rejected it, None if the request could not be sent, or
+#BOOKING_UNCONFIRMED if it was sent but no answer came back, so the booking may or may not exist.
+#Start and end default to now and the default booking length from now; on-site bookings pass the times from
+#get_booking_times, replayed operations their original times.
+async def create_booking(membership_id, access_token, resource_id, booking_starting_time=None, booking_ending_time=None):
+    booking = False
+    if booking_starting_time is None:
+        booking_starting_time, booking_ending_time = get_default_booking_times()
     
     data = {
         "membership_id": membership_id,
@@ -150,63 +236,109 @@ def create_booking(membership_id, access_token, resource_id):
         "to": booking_ending_time,
         "title": "On-site Booking",
         "comments": "This booking was made on-site at MotionLab using your badge. "
-            + "If you'd like to end the booking earlier than the default 30 minutes, "
+            + "If you'd like to end the booking earlier, "
             + "swipe your badge at the same location when you're finished in order to "
             + "make it available again to other members."
         }
         
+    request = None
+    state = api_client.RequestState()
     try:
-        request = urequests.post("https://members.motionlab.berlin/api/resources/"
-                                 + resource_id
-                                 + "/bookings?access_token="
-                                 + access_token,
-                                 json=data)
+        extractor = RecordExtractor(BOOKING_FIELDS, 1, factory=booking_record.from_record)
+        request = await cobot_api.request("POST",
+                                          "/resources/"
+                                          + resource_id
+                                          + "/bookings?access_token="
+                                          + access_token,
+                                          json=data,
+                                          sink=extractor,
+                                          state=state)
         if request.status_code == 201:
-            booking = request.json()
+            booking = extractor.records[0]
             print("Successfully created booking: {}\n".format(booking))
+            flash_log.info(log_messages.BOOKING_CREATED, booking.id)
         else:
-            logging.error("create_booking with following status code %d and response: %s" % (request.status_code, request.json()))
+            if request.status_code >= 500:
+                #The API may have made the booking before it failed
+                booking = BOOKING_UNCONFIRMED
+            flash_log.error(log_messages.CREATE_BOOKING_STATUS, request.content, request.status_code)
     except Exception as e:
-            logging.error("create_booking failed with following exception: %s" % e)
+            booking = BOOKING_UNCONFIRMED if state.sent else None
+            flash_log.error(log_messages.CREATE_BOOKING_FAILED, e)
+    finally:
+        if request is not None:
+            request.close()
             
     return booking
 
-def update_booking(booking_id, access_token, start_or_end_time):
-    updated_booking = {}
+#Returns the updated Booking, False if the API rejected it, or None if the API could not be reached.
+#The new time defaults to now; replayed operations pass their original time.
+async def update_booking(booking_id, access_token, start_or_end_time, now=None):
+    updated_booking = False
     
     data = {}
-    now = create_formatted_time_string(get_now())
+    if now is None:
+        now = get_now_string()
     
     if start_or_end_time == "start_time":
         data = {"from": now}
     elif start_or_end_time == "end_time":
         data = {"to": now}
                 
+    request = None
     try:
-        request = urequests.put("https://members.motionlab.berlin/api/bookings/"
-                                + booking_id + "/?access_token="
-                                + access_token,
-                                json=data)
+        extractor = RecordExtractor(BOOKING_FIELDS, 1, factory=booking_record.from_record)
+        request = await cobot_api.request("PUT",
+                                          "/bookings/"
+                                          + booking_id + "/?access_token="
+                                          + access_token,
+                                          json=data,
+                                          sink=extractor)
         if request.status_code == 200:
-            updated_booking = request.json()
+            updated_booking = extractor.records[0]
             print("Successfully updated booking {}: {}\n".format(start_or_end_time, updated_booking))
+            flash_log.info(log_messages.BOOKING_UPDATED, booking_id)
         else:
-            logging.error("update_booking failed with status code %d and response %s\n" % (request.status_code, request.json()))
+            if request.status_code >= 500:
+                updated_booking = None
+            flash_log.error(log_messages.UPDATE_BOOKING_STATUS, request.content, request.status_code)
     except Exception as e:
-            logging.error("update_booking failed with following exception: %s" % e)
+            updated_booking = None
+            flash_log.error(log_messages.UPDATE_BOOKING_FAILED, e)
+    finally:
+        if request is not None:
+            request.close()
     return updated_booking
 
-def delete_booking(booking_id, access_token):
+#Returns True if the booking was deleted, False if the API rejected it, or None if the API could not be reached
+async def delete_booking(booking_id, access_token):
+    deleted = False
+    request = None
     try:
-        request = urequests.delete("https://members.motionlab.berlin/api/bookings/"
-                                + booking_id + "/?access_token="
-                                + access_token)
+        request = await cobot_api.request("DELETE",
+                                          "/bookings/"
+                                          + booking_id + "/?access_token="
+                                          + access_token,
+                                          sink=api_client.BoundedBody())
         if request.status_code == 204:
+            deleted = True
             print("Successfully deleted booking within 5 minutes of creation\n")
+            flash_log.info(log_messages.BOOKING_DELETED, booking_id)
+        elif request.status_code == 404:
+            #Already gone, e.g. deleted by an earlier attempt whose answer was lost
+            deleted = True
         elif request.status_code == 409:
-            logging.error("delete_booking failed with status code 409: cannot delete a booking created by an event through this endpoint\n")
+            flash_log.error(log_messages.DELETE_BOOKING_EVENT)
+        elif request.status_code >= 500:
+            deleted = None
+            flash_log.error(log_messages.DELETE_BOOKING_STATUS, None, request.status_code)
     except Exception as e:
-            logging.error("delete_booking failed with following exception: %s" % e)
+            deleted = None
+            flash_log.error(log_messages.DELETE_BOOKING_FAILED, e)
+    finally:
+        if request is not None:
+            request.close()
+    return deleted
             
 ##### LOCAL FUNCTIONS #####
 
@@ -220,7 +352,7 @@ def get_checkin_token_from_badge(uid):
 
     #String representaiton of the decimal value of the last 4 bytes of a 7 byte MiFare RFID badge
                                                                 #e.g. 2183925508
-    user_checkin_token = str(int(hex(int.from_bytes(bytes(uid), "little", False))[8:], 16))
+    user_checkin_token = str(int(hex(int.from_bytes(bytes(uid), "little"))[8:], 16))
     
     print("Badge read, user's check-in token: {}\n".format(user_checkin_token))
 
@@ -236,48 +368,46 @@ def get_now():
     return utime.localtime()
 
 def create_formatted_time_string(unformatted_time):
-    return "{}/{}/{} {}:{}:00 +0000".format(unformatted_time[0], #year
-                                            unformatted_time[1], #month
-                                            unformatted_time[2], #date
-                                            unformatted_time[3], #hours
-                                            unformatted_time[4]) #minutes
-
+    return epoch_time.format(epoch_time.from_civil(unformatted_time[0], #year
+                                                   unformatted_time[1], #month
+                                                   unformatted_time[2], #date
+                                                   unformatted_time[3], #hours
+                                                   unformatted_time[4])) #minutes
+
+#Returns the current minute as an API time string, e.g. 2022/12/05 09:42:00 +0000
+def get_now_string():
+    return epoch_time.format(epoch_time.start_of_minute(utime.time()))
+
+#Returns (now, the default booking length from now) as API time strings
+def get_default_booking_times():
+    now = epoch_time.start_of_minute(utime.time())
+    return epoch_time.format(now), epoch_time.format(now + BOOKING_DEFAULT_S)
+
+#Returns (start, end) as API time strings for an on-site booking from now, as long as the local schedule leaves
+#free: up to the default length, ending early for a booking that starts sooner. None if less than the minimum is free.
+def get_booking_times(schedule, now):
+    start = epoch_time.start_of_minute(now)
+    end = start + BOOKING_DEFAULT_S
+    next_booking = schedule.first_booking_between(start, end)
+    if next_booking is not None:
+        end = next_booking.start
+    if end - start < BOOKING_MINIMUM_S:
+        return None
+    return epoch_time.format(start), epoch_time.format(end)
+
+#Returns epoch seconds for an API time string, parsed once per distinct string
 def get_time_from_string(time_string):
     #2022/12/05 09:42:00 +0000 <- format of input strings
-    now = get_now()
-    new_time = utime.mktime((int(time_string[0:4]),   #year
-                             int(time_string[5:7]),   #month
-                             int(time_string[8:10]),  #date
-                             int(time_string[11:13]), #hours
-                             int(time_string[14:16]), #minutes
-                             0,                       #seconds
-                             now[6],                  #weekday
-                             now[7]))                 #yearday
-    return new_time
+    return epoch_time.parse(time_string)
 
 def get_time_in_future(difference_in_minutes):
-    now = get_now()
-    time_in_future = utime.mktime((now[0],
-                                    now[1],
-                                    now[2],
-                                    now[3],
-                                    now[4] + difference_in_minutes,
-                                    now[5],
-                                    now[6],
-                                    now[7]))
-    return time_in_future
+    return utime.time() + difference_in_minutes * 60
+
+def get_start_of_day(t):
+    return epoch_time.start_of_day(t)
 
 def get_end_of_day_time():
-    now = get_now()
-    end_of_day = utime.mktime((now[0],
-                                now[1],
-                                now[2],
-                                20,
-                                30,
-                                0,
-                                now[6],
-                                now[7]))
-    return end_of_day
+    return epoch_time.start_of_day(utime.time()) + 20 * 3600 + 30 * 60
 
 #Credit: dhylands at https://forum.micropython.org/viewtopic.php?t=8112#p68368
 def file_or_dir_exists(filename):
@@ -287,28 +417,11 @@ def file_or_dir_exists(filename):
     except OSError:
         return False
 
-#TODO: Finish method, put into program logic
+#TODO: Put into program logic
 def is_booking_less_than_five_minutes_old(created_at):
-    now = get_now()
-    five_minutes_ago = utime.localtime(utime.mktime((now[0],
-                                                     now[1],
-                                                     now[2],
-                                                     now[3],
-                                                     now[4] - 5,
-                                                     now[5],
-                                                     now[6],
-                                                     now[7])))
-    
-    booking_created_time = utime.localtime(utime.mktime((created_at[0,3],
-                                                         created_at[5,6],
-                                                         created_at[8,9],
-                                                         created_at[11,12],
-                                                         created_at[14,15],
-                                                         0,
-                                                         0,
-                                                         0)))
-
-def configure_device():
+    return utime.time() - epoch_time.parse(created_at) < 5 * 60
+
+async def configure_device():
     access_token = ""
     
     if file_or_dir_exists("token.txt"):
@@ -332,7 +445,7 @@ def configure_device():
         admin_password = input()
         print("")
         
-        access_token = get_access_token(
+        access_token = await get_access_token(
             client_id,
             client_secret,
             "checkin_tokens,read_bookings,write_bookings",
@@ -346,72 +459,138 @@ def configure_device():
             token_file.close()
             print("Successfully wrote access token to token.txt\n")
         except Exception as e:
-            logging.error("Writing access token to token.txt failed with exception %s" % e)
+            flash_log.error(log_messages.TOKEN_WRITE_FAILED, e)
     
     return access_token
 
-def connect_to_wifi():
-    print("Connecting to WiFi...")
+WIFI_POLL_MS = 100
 
+#Starts associating with the access point. The radio carries on by itself while the device does other things.
+def start_wifi():
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
-
     wlan.connect(secrets.SSID, secrets.SSID_PASSWORD)
+    return wlan
+
+async def connect_to_wifi(wlan=None):
+    print("Connecting to WiFi...")
+
+    if wlan is None:
+        wlan = start_wifi()
+    polls = 0
     while not wlan.isconnected():
-        utime.sleep_ms(500)
-        print(".")
-        
+        await asyncio.sleep_ms(WIFI_POLL_MS)
+        polls += 1
+        if polls % 10 == 0:
+            print(".")
+
     print("Connected to WiFi\n")
-    
+
+#Returns True if the clock was set
 def set_time_to_UTC():
     try:
         ntptime.settime()
         print("UTC Time：{}\n".format(utime.localtime()))
+        return True
     except Exception as e:
-        logging.error("Error syncing time: %s" % e)
-    
-def update_or_delete_booking(booking_id, access_token, onsite_booking_creation_time, update_time_limit):
-    if (utime.time() - onsite_booking_creation_time) < update_time_limit:
-        delete_booking(booking_id, access_token)
-    else:
-        update_booking(booking_id, access_token, "end_time")
-
-def get_resource_availability(current_booking, resource_id, access_token):
-    if current_booking != {}:
+        flash_log.error(log_messages.TIME_SYNC_FAILED, e)
         return False
+
+#Returns the updated Booking, or None if it was deleted or the update failed
+async def update_or_delete_booking(booking_id, access_token, onsite_booking_creation_time, update_time_limit):
+    if (utime.time() - onsite_booking_creation_time) < update_time_limit:
+        await delete_booking(booking_id, access_token)
+        return None
     else:
-        start_time_range = create_formatted_time_string(utime.localtime(utime.time()))
-        end_time_range = create_formatted_time_string(utime.localtime((utime.time() + (60*30))))
-        booking_in_next_31_minutes = get_bookings_in_range(resource_id, access_token, start_time_range, end_time_range)
-        
-        if booking_in_next_31_minutes != {}:
-            return False
+        return await update_booking(booking_id, access_token, "end_time")
+
+#Answered from the local schedule: available if it is free for at least the shortest on-site booking
+def get_resource_availability(schedule, now):
+    return schedule.first_booking_between(now, now + BOOKING_MINIMUM_S) is None
+
+#Brings the local schedule for [window_start, window_end) up to date, parsing and applying only what changed.
+#Returns the number of bookings that changed, or None, leaving the schedule untouched, if the API could not be reached
+#or the device changed a booking while the fetch was underway. lock is only held while the result is applied.
+async def sync_schedule(schedule, resource_id, access_token, window_start, window_end, lock):
+    local_edits = schedule.local_edits
+    result = await get_bookings_if_changed(resource_id,
+                                           access_token,
+                                           epoch_time.format(window_start),
+                                           epoch_time.format(window_end),
+                                           schedule.sync_state)
+    if result is None:
+        return None
+
+    async with lock:
+        if schedule.local_edits != local_edits:
+            #Fetched before a booking change made here meanwhile, which merging would undo
+            schedule.sync_state.clear()
+            print("Bookings changed on the device during the sync, schedule will be fetched again\n")
+            return None
+
+        changed, bookings = result
+        changes = 0
+        if changed:
+            changes = schedule.merge(bookings, window_start, window_end, utime.time())
+            print("Schedule synced, {} changes, {} bookings known for today\n".format(changes, len(schedule)))
+            if changes:
+                flash_log.info(log_messages.SCHEDULE_SYNCED, None, changes)
         else:
-            return True
+            schedule.mark_synced(window_start, window_end, utime.time())
+            print("Schedule unchanged since last sync\n")
+    return changes
 
 #Buzzer functions
-def play_song(buzzer, song):
-    buzzer.duty_u16(1000)
-
-    for frequency in song:
-        buzzer.freq(frequency)
-        utime.sleep(0.1)
-        
-    buzzer.duty_u16(0)
-    
-def update_availability_display(pixels, resource_id, access_token):
-    time_range_start = create_formatted_time_string(utime.localtime())
-    time_range_end = create_formatted_time_string(utime.localtie(get_end_of_day))
-    
-    bookings = get_bookings_in_range(resource_id, access_token, time_range_start, time_range_end)
-    half_hour_slots_from_6_to_20_30 = [0] * 30
+NOTE_MS = 100
+
+#Plays queued songs note by note from the UI loop, so the RFID reader keeps being polled while a song plays
+class SongPlayer:
+    def __init__(self, buzzer):
+        self.buzzer = buzzer
+        self.songs = []
+        self.song = None
+        self.note = 0
+        self.next_note_ms = 0
+
+    def play(self, song):
+        self.songs.append(song)
+
+    def stop(self):
+        if self.song is not None:
+            self.buzzer.duty_u16(0)
+            self.song = None
+
+    #Call every few milliseconds with utime.ticks_ms()
+    def update(self, now_ms):
+        if self.song is None:
+            if not self.songs:
+                return
+            self.song = self.songs.pop(0)
+            self.note = 0
+            self.next_note_ms = now_ms
+            self.buzzer.duty_u16(1000)
+
+        if utime.ticks_diff(now_ms, self.next_note_ms) < 0:
+            return
+
+        if self.note < len(self.song):
+            started = metrics.start()
+            self.buzzer.freq(self.song[self.note])
+            metrics.stop(metrics.BUZZER, started)
+            self.note += 1
+            self.next_note_ms = utime.ticks_add(self.next_note_ms, NOTE_MS)
+        else:
+            self.buzzer.duty_u16(0)
+            self.song = None
     
 def set_led_lights(new_status, last_status):
     if new_status != last_status:
+        started = metrics.start()
         for led in last_status:
             led.value(0)
         for led in new_status:
             led.value(1)
+        metrics.stop(metrics.LED, started)
         
     return new_status
     
@@ -0,0 +1,183 @@
+#Streaming JSON field extractor. Response bodies are fed in chunks straight off the socket and only the wanted
+#fields of each record are kept, so parsing a busy day of bookings never holds the body or the full decoded
+#dicts in RAM. Memory use is bounded by the depth/length limits below and max_records, not the response size.
+
+MAX_DEPTH = 16
+MAX_KEY_LENGTH = 32
+MAX_VALUE_LENGTH = 64
+
+_QUOTE = 34 #"
+_BACKSLASH = 92 #\
+_OPEN_OBJECT = 123 #{
+_CLOSE_OBJECT = 125 #}
+_OPEN_ARRAY = 91 #[
+_CLOSE_ARRAY = 93 #]
+_COLON = 58 #:
+_COMMA = 44 #,
+_WHITESPACE = b" \t\r\n"
+_ESCAPES = {98: 8, 102: 12, 110: 10, 114: 13, 116: 9} #\b \f \n \r \t
+
+#Fields the device uses from a booking
+BOOKING_FIELDS = {("id",): "id", ("membership_id",): "membership_id", ("from",): "from", ("to",): "to"}
+
+class RecordExtractor:
+    #fields maps key paths inside a record, e.g. ("membership", "id"), to the name they are stored under.
+    #Records are the objects found at record_depth: 1 for a single top-level object, 2 for the objects of a
+    #top-level array. factory, if given, turns each record's dict of fields into the object kept in records.
+    #hasher, if given, is updated with every chunk so the raw body can still be fingerprinted.
+    def __init__(self, fields, record_depth, max_records=64, factory=None, hasher=None):
+        self.fields = fields
+        self.factory = factory
+        self.max_path_length = max(len(path) for path in fields)
+        self.record_depth = record_depth
+        self.max_records = max_records
+        self.hasher = hasher
+
+        self.records = []
+        self.dropped_records = 0
+        self.record = None
+
+        self.depth = 0
+        self.is_object = bytearray(MAX_DEPTH + 1) #Whether each open container is an object or an array
+        self.keys = [None] * (MAX_DEPTH + 1) #Current key of each open object
+
+        self.expect_key = False
+        self.in_string = False
+        self.in_scalar = False
+        self.escape = False
+        self.string_is_key = False
+        self.capture = None #Buffer for the key or wanted value being read, None when skipping
+        self.capture_name = None
+        self.key_buffer = bytearray(MAX_KEY_LENGTH)
+        self.key_length = 0
+        self.value_buffer = bytearray(MAX_VALUE_LENGTH)
+        self.value_length = 0
+
+    def feed(self, chunk):
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+
+        for c in chunk:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.keep(_ESCAPES.get(c, c))
+                elif c == _BACKSLASH:
+                    self.escape = True
+                elif c == _QUOTE:
+                    self.in_string = False
+                    self.end_string()
+                else:
+                    self.keep(c)
+                continue
+
+            if self.in_scalar:
+                if c in _WHITESPACE or c == _COMMA or c == _CLOSE_OBJECT or c == _CLOSE_ARRAY:
+                    self.in_scalar = False
+                    self.end_value(False)
+                else:
+                    self.keep(c)
+                    continue
+
+            if c == _QUOTE:
+                self.in_string = True
+                self.string_is_key = self.expect_key
+                if self.string_is_key:
+                    self.capture = self.key_buffer
+                    self.key_length = 0
+                else:
+                    self.start_value()
+            elif c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                self.open(c == _OPEN_OBJECT)
+            elif c == _CLOSE_OBJECT or c == _CLOSE_ARRAY:
+                self.close()
+            elif c == _COLON:
+                self.expect_key = False
+            elif c == _COMMA:
+                self.expect_key = self.depth > 0 and self.is_object[self.depth] == 1
+            elif c not in _WHITESPACE:
+                self.in_scalar = True
+                self.start_value()
+                self.keep(c)
+
+    def keep(self, c):
+        if self.capture is self.key_buffer:
+            if self.key_length < MAX_KEY_LENGTH:
+                self.key_buffer[self.key_length] = c
+                self.key_length += 1
+        elif self.capture is not None:
+            if self.value_length < MAX_VALUE_LENGTH:
+                self.value_buffer[self.value_length] = c
+                self.value_length += 1
+
+    def open(self, is_object):
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise ValueError("JSON nested deeper than %d levels" % MAX_DEPTH)
+        self.is_object[self.depth] = 1 if is_object else 0
+        self.keys[self.depth] = None
+        self.expect_key = is_object
+
+        if is_object and self.depth == self.record_depth:
+            self.record = {}
+
+    def close(self):
+        if self.depth == self.record_depth and self.record is not None:
+            if len(self.records) < self.max_records:
+                self.records.append(self.record if self.factory is None else self.factory(self.record))
+            else:
+                self.dropped_records += 1
+            self.record = None
+
+        self.depth -= 1
+        self.expect_key = False
+
+    #Decides whether the value starting now is one of the wanted fields
+    def start_value(self):
+        self.capture = None
+        if self.record is None:
+            return
+
+        path_length = self.depth - self.record_depth
+        if path_length >= self.max_path_length:
+            return
+        for d in range(self.record_depth, self.depth + 1):
+            if self.is_object[d] != 1 or self.keys[d] is None:
+                return
+
+        path = tuple(self.keys[self.record_depth:self.depth + 1])
+        name = self.fields.get(path)
+        if name is not None:
+            self.capture = self.value_buffer
+            self.capture_name = name
+            self.value_length = 0
+
+    def end_string(self):
+        if self.string_is_key:
+            self.capture = None
+            #Keys deeper than any wanted path can never match, so they aren't decoded
+            if self.record is not None and self.depth - self.record_depth < self.max_path_length:
+                self.keys[self.depth] = str(self.key_buffer[:self.key_length], "utf-8")
+            else:
+                self.keys[self.depth] = None
+        else:
+            self.end_value(True)
+
+    def end_value(self, is_string):
+        if self.capture is None:
+            return
+        self.capture = None
+
+        text = str(self.value_buffer[:self.value_length], "utf-8")
+        if is_string:
+            value = text
+        elif text == "null":
+            value = None
+        elif text == "true" or text == "false":
+            value = text == "true"
+        else:
+            try:
+                value = int(text)
+            except ValueError:
+                value = text
+        self.record[self.capture_name] = value
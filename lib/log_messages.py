@@ -0,0 +1,89 @@
+#Message IDs for flash_log records, and the text tools/decode_log.py turns them back into.
+#IDs are stored on flash, so never renumber or reuse one; add new messages at the end.
+#In the text, {number} is the record's integer argument (usually a status code) and {text} its short text argument.
+
+BOOT = 1
+UI_QUEUE_FULL = 2
+BADGE_QUEUE_FULL = 3
+UI_LOOP_STOPPED = 4
+JOURNAL_CREATE_REJECTED = 5
+JOURNAL_UPDATE_REJECTED = 6
+JOURNAL_DELETE_REJECTED = 7
+ACCESS_TOKEN_STATUS = 8
+ACCESS_TOKEN_FAILED = 9
+MEMBERSHIP_STATUS = 10
+MEMBERSHIP_FAILED = 11
+BOOKINGS_IN_RANGE_STATUS = 12
+BOOKINGS_IN_RANGE_FAILED = 13
+BOOKINGS_IF_CHANGED_STATUS = 14
+BOOKINGS_IF_CHANGED_FAILED = 15
+CURRENT_BOOKING_STATUS = 16
+CURRENT_BOOKING_FAILED = 17
+CREATE_BOOKING_STATUS = 18
+CREATE_BOOKING_FAILED = 19
+UPDATE_BOOKING_STATUS = 20
+UPDATE_BOOKING_FAILED = 21
+DELETE_BOOKING_EVENT = 22
+DELETE_BOOKING_STATUS = 23
+DELETE_BOOKING_FAILED = 24
+TOKEN_WRITE_FAILED = 25
+TIME_SYNC_FAILED = 26
+MEMBERSHIP_CACHE_RESET = 27
+MEMBERSHIP_CACHE_WRITE_FAILED = 28
+JOURNAL_READ_FAILED = 29
+JOURNAL_WRITE_FAILED = 30
+BOOKING_CREATED = 31
+BOOKING_UPDATED = 32
+BOOKING_DELETED = 33
+SCHEDULE_SYNCED = 34
+CORRECTION_SIGNALLED = 35
+STARTUP_PHASE = 36
+STATE_SNAPSHOT_RESET = 37
+STATE_SNAPSHOT_WRITE_FAILED = 38
+PUSH_CHANNEL_DROPPED = 39
+API_BREAKER_OPENED = 40
+API_BREAKER_CLOSED = 41
+
+MESSAGES = {
+    BOOT: "Device booted",
+    UI_QUEUE_FULL: "UI queue full, dropped song",
+    BADGE_QUEUE_FULL: "Badge queue full, dropped badge read",
+    UI_LOOP_STOPPED: "UI loop stopped with exception: {text}",
+    JOURNAL_CREATE_REJECTED: "Booking {text} made while offline was rejected by the API",
+    JOURNAL_UPDATE_REJECTED: "Change to booking {text} made while offline was rejected by the API",
+    JOURNAL_DELETE_REJECTED: "Deleting booking {text} while offline was rejected by the API",
+    ACCESS_TOKEN_STATUS: "get_oauth_token failed with status code {number} and response {text}",
+    ACCESS_TOKEN_FAILED: "get_oauth_token failed with exception: {text}",
+    MEMBERSHIP_STATUS: "get_membership_id returned status code {number} and following response: {text}",
+    MEMBERSHIP_FAILED: "get_membership_id had following exception: {text}",
+    BOOKINGS_IN_RANGE_STATUS: "get_booking_in_range failed with status code {number} and response: {text}",
+    BOOKINGS_IN_RANGE_FAILED: "get_booking_in_range failed following exception: {text}",
+    BOOKINGS_IF_CHANGED_STATUS: "get_bookings_if_changed failed with status code {number} and response: {text}",
+    BOOKINGS_IF_CHANGED_FAILED: "get_bookings_if_changed failed following exception: {text}",
+    CURRENT_BOOKING_STATUS: "get_current_booking failed with status code {number} and response: {text}",
+    CURRENT_BOOKING_FAILED: "get_current_booking failed following exception: {text}",
+    CREATE_BOOKING_STATUS: "create_booking failed with status code {number} and response: {text}",
+    CREATE_BOOKING_FAILED: "create_booking failed with following exception: {text}",
+    UPDATE_BOOKING_STATUS: "update_booking failed with status code {number} and response {text}",
+    UPDATE_BOOKING_FAILED: "update_booking failed with following exception: {text}",
+    DELETE_BOOKING_EVENT: "delete_booking failed with status code 409: cannot delete a booking created by an event through this endpoint",
+    DELETE_BOOKING_STATUS: "delete_booking failed with status code {number}",
+    DELETE_BOOKING_FAILED: "delete_booking failed with following exception: {text}",
+    TOKEN_WRITE_FAILED: "Writing access token to token.txt failed with exception {text}",
+    TIME_SYNC_FAILED: "Error syncing time: {text}",
+    MEMBERSHIP_CACHE_RESET: "Membership cache was unreadable and has been reset: {text}",
+    MEMBERSHIP_CACHE_WRITE_FAILED: "Writing membership cache failed with exception {text}",
+    JOURNAL_READ_FAILED: "Reading operation journal failed with exception {text}",
+    JOURNAL_WRITE_FAILED: "Writing operation journal failed with exception {text}",
+    BOOKING_CREATED: "Booking {text} created on-site",
+    BOOKING_UPDATED: "Booking {text} updated",
+    BOOKING_DELETED: "Booking {text} deleted",
+    SCHEDULE_SYNCED: "Schedule synced, {number} bookings changed",
+    CORRECTION_SIGNALLED: "Member told that a change to booking {text} was rejected",
+    STARTUP_PHASE: "Startup reached {text} after {number} ms",
+    STATE_SNAPSHOT_RESET: "Saved booking state was unreadable and has been ignored: {text}",
+    STATE_SNAPSHOT_WRITE_FAILED: "Writing booking state failed with exception {text}",
+    PUSH_CHANNEL_DROPPED: "Push channel unavailable, polling until it is back: {text}",
+    API_BREAKER_OPENED: "Cobot API unavailable, circuit breaker open for {number} ms",
+    API_BREAKER_CLOSED: "Cobot API available again, circuit breaker closed",
+}
@@ -0,0 +1,100 @@
+import os
+import utime
+import ujson
+import uhashlib
+import ubinascii
+
+import flash_log
+import log_messages
+
+#Remembers which membership ID belongs to which badge so regular members don't cost a check_in_tokens
+#round trip on every swipe. Only salted hashes of check-in tokens are kept, in RAM and on flash.
+
+class MembershipCache:
+    def __init__(self, filename="membership_cache.json", max_entries=32, ttl_s=7 * 86400):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.salt = b""
+        self.entries = {} #token hash -> [membership_id, stored_at, last_used]
+        self.use_counter = 0 #Orders entries by recency without relying on the clock
+        self.unsaved = False #get() changed the recency order or expired entries since the last save()
+
+    def hash_token(self, user_checkin_token):
+        digest = uhashlib.sha256(self.salt + user_checkin_token.encode()).digest()
+        return ubinascii.hexlify(digest[:16]).decode()
+
+    #Loads cached entries from flash, or starts a fresh cache with a new salt
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = ujson.load(f)
+            self.salt = ubinascii.unhexlify(data["salt"])
+            for i, (token_hash, membership_id, stored_at) in enumerate(data["entries"]):
+                self.entries[token_hash] = [membership_id, stored_at, i]
+            self.use_counter = len(self.entries)
+            print("Loaded {} cached membership IDs\n".format(len(self.entries)))
+        except OSError:
+            self.salt = os.urandom(16)
+            self.entries = {}
+        except Exception as e:
+            flash_log.error(log_messages.MEMBERSHIP_CACHE_RESET, e)
+            self.salt = os.urandom(16)
+            self.entries = {}
+
+    #Writes least recently used entries first so load() restores the LRU order
+    def save(self):
+        ordered = sorted(self.entries.items(), key=lambda item: item[1][2])
+        data = {
+            "salt": ubinascii.hexlify(self.salt).decode(),
+            "entries": [[token_hash, entry[0], entry[1]] for token_hash, entry in ordered],
+        }
+        try:
+            with open(self.filename + ".tmp", "w") as f:
+                ujson.dump(data, f)
+            os.rename(self.filename + ".tmp", self.filename)
+            self.unsaved = False
+        except Exception as e:
+            flash_log.error(log_messages.MEMBERSHIP_CACHE_WRITE_FAILED, e)
+
+    #Saves what get() changed, so regular members keep their place in the LRU order across a reboot. Called
+    #between swipes rather than on every hit, so feedback never waits for the flash write.
+    def save_if_changed(self):
+        if self.unsaved:
+            self.save()
+
+    #Returns the cached membership ID, or None if unknown or older than the TTL
+    def get(self, user_checkin_token):
+        token_hash = self.hash_token(user_checkin_token)
+        entry = self.entries.get(token_hash)
+        if entry is None:
+            return None
+
+        if utime.time() - entry[1] > self.ttl_s:
+            del self.entries[token_hash]
+            self.unsaved = True
+            return None
+
+        if entry[2] != self.use_counter:
+            self.use_counter += 1
+            entry[2] = self.use_counter
+            self.unsaved = True
+        return entry[0]
+
+    def put(self, user_checkin_token, membership_id):
+        token_hash = self.hash_token(user_checkin_token)
+        if token_hash not in self.entries and len(self.entries) >= self.max_entries:
+            self.evict()
+
+        self.use_counter += 1
+        self.entries[token_hash] = [membership_id, utime.time(), self.use_counter]
+        self.save()
+
+    def evict(self):
+        oldest_hash = None
+        oldest_use = 0
+        for token_hash, entry in self.entries.items():
+            if oldest_hash is None or entry[2] < oldest_use:
+                oldest_hash, oldest_use = token_hash, entry[2]
+        if oldest_hash is not None:
+            del self.entries[oldest_hash]
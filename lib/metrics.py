@@ -0,0 +1,173 @@
+import gc
+import utime
+import ujson
+import _thread
+import uasyncio as asyncio
+from array import array
+
+#Hot-path tracing: the last RING_SIZE timed events are kept in preallocated arrays, and every event also updates
+#its counters and duration histogram. Recording an event allocates nothing, so it can sit in the RFID poll loop.
+#Both cores record events, so recording takes a lock.
+#The results can be fetched over HTTP (GET /metrics, GET /trace) or printed on the serial console with report().
+
+RING_SIZE = 128
+
+#Event ids, also the index into NAMES and the counter arrays
+RFID_POLL = 0
+API_CALL = 1
+JSON_PARSE = 2
+GC = 3
+LED = 4
+BUZZER = 5
+BADGE = 6
+SCHEDULE_SYNC = 7
+NAMES = ("rfid_poll", "api_call", "json_parse", "gc", "led", "buzzer", "badge", "schedule_sync")
+
+#Upper bounds of the histogram buckets in microseconds, the last bucket takes everything slower
+BUCKET_BOUNDS_US = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000, 3000000)
+BUCKETS = len(BUCKET_BOUNDS_US) + 1
+
+ring_ticks_ms = array("I", [0] * RING_SIZE)
+ring_events = bytearray(RING_SIZE)
+ring_durations_us = array("I", [0] * RING_SIZE)
+ring_index = 0
+ring_count = 0
+
+counts = array("I", [0] * len(NAMES))
+errors = array("I", [0] * len(NAMES))
+total_us = array("Q", [0] * len(NAMES)) #64 bits, a 32-bit total wraps after 71 minutes of API calls
+max_us = array("I", [0] * len(NAMES))
+histograms = array("I", [0] * (len(NAMES) * BUCKETS))
+
+boot_ticks_ms = utime.ticks_ms()
+startup_phases = [] #(phase, ms after boot) for each milestone startup has reached, in order
+sources = {} #name -> function returning a dict of other state to serve with the metrics, e.g. the API client's
+lock = _thread.allocate_lock()
+
+def start():
+    return utime.ticks_us()
+
+#Records the event started at `started` (from start()) as finished now
+def stop(event, started):
+    record(event, utime.ticks_diff(utime.ticks_us(), started))
+
+def record(event, duration_us):
+    global ring_index, ring_count
+
+    bucket = 0
+    while bucket < BUCKETS - 1 and duration_us > BUCKET_BOUNDS_US[bucket]:
+        bucket += 1
+    ticks_ms = utime.ticks_ms()
+
+    with lock:
+        ring_ticks_ms[ring_index] = ticks_ms
+        ring_events[ring_index] = event
+        ring_durations_us[ring_index] = duration_us
+        ring_index = (ring_index + 1) % RING_SIZE
+        if ring_count < RING_SIZE:
+            ring_count += 1
+
+        counts[event] += 1
+        total_us[event] += duration_us
+        if duration_us > max_us[event]:
+            max_us[event] = duration_us
+        histograms[event * BUCKETS + bucket] += 1
+
+def error(event):
+    with lock:
+        errors[event] += 1
+
+#Runs a garbage collection now, timed, so it happens between swipes rather than in the middle of one
+def collect():
+    started = start()
+    gc.collect()
+    stop(GC, started)
+
+#Oldest first, as (ticks_ms, event name, duration_us)
+def recent_events():
+    events = []
+    with lock:
+        first = (ring_index - ring_count) % RING_SIZE
+        for i in range(ring_count):
+            j = (first + i) % RING_SIZE
+            events.append((ring_ticks_ms[j], NAMES[ring_events[j]], ring_durations_us[j]))
+    return events
+
+#Notes that startup reached a milestone and returns how long after boot it did
+def boot_phase(phase):
+    elapsed_ms = utime.ticks_diff(utime.ticks_ms(), boot_ticks_ms)
+    startup_phases.append((phase, elapsed_ms))
+    print("Startup: {} after {} ms\n".format(phase, elapsed_ms))
+    return elapsed_ms
+
+def snapshot(resource_id=None):
+    events = {}
+    for event in range(len(NAMES)):
+        events[NAMES[event]] = {
+            "count": counts[event],
+            "errors": errors[event],
+            "mean_us": total_us[event] // counts[event] if counts[event] else 0,
+            "max_us": max_us[event],
+            "histogram": list(histograms[event * BUCKETS:(event + 1) * BUCKETS]),
+        }
+    data = {
+        "resource_id": resource_id,
+        "uptime_ms": utime.ticks_diff(utime.ticks_ms(), boot_ticks_ms),
+        "mem_free": gc.mem_free() if hasattr(gc, "mem_free") else None,
+        "startup_ms": [[phase, elapsed_ms] for phase, elapsed_ms in startup_phases],
+        "bucket_bounds_us": list(BUCKET_BOUNDS_US),
+        "events": events,
+    }
+    for name in sources:
+        data[name] = sources[name]()
+    return data
+
+#Prints the counters on the serial console, for use from the REPL
+def report():
+    print("Uptime {} ms".format(utime.ticks_diff(utime.ticks_ms(), boot_ticks_ms)))
+    for phase, elapsed_ms in startup_phases:
+        print("startup {:<14} {:>7} ms".format(phase, elapsed_ms))
+    for event in range(len(NAMES)):
+        if counts[event]:
+            print("{:<14} count {:>7}  errors {:>4}  mean {:>8} us  max {:>8} us".format(
+                NAMES[event], counts[event], errors[event], total_us[event] // counts[event], max_us[event]))
+    for name in sources:
+        print("{:<14} {}".format(name, sources[name]()))
+
+##### HTTP ENDPOINT #####
+
+async def handle_client(reader, writer, resource_id):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if not line or line == b"\r\n":
+                break
+
+        path = request_line.split(b" ")[1] if request_line.count(b" ") >= 2 else b""
+        if path == b"/metrics":
+            status, body = "200 OK", ujson.dumps(snapshot(resource_id))
+        elif path == b"/trace":
+            status, body = "200 OK", ujson.dumps(recent_events())
+        else:
+            status, body = "404 Not Found", '{"error": "try /metrics or /trace"}'
+
+        body = body.encode()
+        writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+    except Exception as e:
+        print("Metrics request failed: {}\n".format(e))
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+#Serves the metrics endpoint on port until the device stops
+async def serve(port, resource_id=None):
+    async def on_connect(reader, writer):
+        await handle_client(reader, writer, resource_id)
+
+    await asyncio.start_server(on_connect, "0.0.0.0", port)
+    print("Metrics available on port {}\n".format(port))
+    while True:
+        await asyncio.sleep(3600)
@@ -0,0 +1,195 @@
+import os
+import ujson
+
+from helper_functions import create_booking, update_booking, delete_booking, get_bookings_in_range, get_now_string, file_or_dir_exists
+from helper_functions import BOOKING_UNCONFIRMED
+from booking_record import Booking
+import epoch_time
+import flash_log
+import log_messages
+
+#Write-ahead journal for booking changes made while the Cobot API is unreachable. Each change is appended to
+#flash as one JSON line, acknowledged to the member straight away, and replayed in order once the API is back.
+#
+#Journal lines are [seq, "create", local_id, membership_id, from, to], [seq, "update", booking_id, start_or_end_time, time]
+#or [seq, "delete", booking_id]. A later line with the same seq replaces the earlier one, and [seq, "ack"] marks it as
+#no longer pending, so the file only ever grows until it is truncated once nothing is pending.
+#
+#A create that was sent but never answered is journaled as [seq, "create", local_id, membership_id, from, to, True].
+#The API may have made that booking, so replay looks for it before sending the create again, and later changes to
+#it are journaled as changes of their own rather than folded into the create.
+
+LOCAL_ID_PREFIX = "local-"
+
+def is_local_id(booking_id):
+    return booking_id.startswith(LOCAL_ID_PREFIX)
+
+#Whether a journaled create may already have been made by the API
+def was_sent(record):
+    return len(record) > 6 and record[6]
+
+class OperationJournal:
+    def __init__(self, filename="op_journal.log"):
+        self.filename = filename
+        self.operations = [] #Pending operations in seq order
+        self.next_seq = 1
+        self.sending = None #Operation replay is waiting on the API for, which later changes must leave as it is
+
+    def __len__(self):
+        return len(self.operations)
+
+    def load(self):
+        if not file_or_dir_exists(self.filename):
+            return
+
+        by_seq = {}
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = ujson.loads(line)
+                    except ValueError:
+                        continue #A line cut short by power loss
+                    if record[1] == "ack":
+                        by_seq.pop(record[0], None)
+                    else:
+                        by_seq[record[0]] = record
+                    self.next_seq = max(self.next_seq, record[0] + 1)
+        except Exception as e:
+            flash_log.error(log_messages.JOURNAL_READ_FAILED, e)
+
+        self.operations = [by_seq[seq] for seq in sorted(by_seq)]
+        print("Loaded {} pending booking operations\n".format(len(self.operations)))
+
+    def write(self, record):
+        try:
+            with open(self.filename, "a") as f:
+                f.write(ujson.dumps(record) + "\n")
+        except Exception as e:
+            flash_log.error(log_messages.JOURNAL_WRITE_FAILED, e)
+
+    def append(self, record):
+        self.operations.append(record)
+        self.write(record)
+
+    def replace(self, record):
+        for i in range(len(self.operations)):
+            if self.operations[i][0] == record[0]:
+                self.operations[i] = record
+        self.write(record)
+
+    def ack(self, record):
+        if record in self.operations:
+            self.operations.remove(record)
+        if self.operations:
+            self.write([record[0], "ack"])
+        else:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+    def new_seq(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        return seq
+
+    def pending_for(self, booking_id):
+        return [record for record in self.operations if record[2] == booking_id]
+
+    #Journals a walk-up booking and returns the provisional booking for the local schedule. sent is True for a
+    #create that went out without an answer.
+    def add_create(self, membership_id, booking_starting_time, booking_ending_time, sent=False):
+        seq = self.new_seq()
+        local_id = LOCAL_ID_PREFIX + str(seq)
+        record = [seq, "create", local_id, membership_id, booking_starting_time, booking_ending_time]
+        self.append(record + [True] if sent else record)
+        return Booking(local_id, membership_id, epoch_time.parse(booking_starting_time), epoch_time.parse(booking_ending_time))
+
+    #Journals a start/end time change, folding it into a pending create or an earlier change of the same time
+    def add_update(self, booking_id, start_or_end_time):
+        now = get_now_string()
+
+        for record in self.pending_for(booking_id):
+            if record is self.sending:
+                continue
+            if record[1] == "create" and not was_sent(record):
+                if start_or_end_time == "start_time":
+                    self.replace(record[:4] + [now, record[5]])
+                else:
+                    self.replace(record[:5] + [now])
+                return
+            if record[1] == "update" and record[3] == start_or_end_time:
+                self.replace([record[0], "update", booking_id, start_or_end_time, now])
+                return
+
+        self.append([self.new_seq(), "update", booking_id, start_or_end_time, now])
+
+    #Journals a deletion, dropping a pending create and any changes to the booking it makes redundant. A create
+    #that was already sent, or is being sent, stays, so the booking it may have made is found and deleted.
+    def add_delete(self, booking_id):
+        unsent_create = False
+        for record in self.pending_for(booking_id):
+            if record is self.sending or record[1] == "create" and was_sent(record):
+                continue
+            unsent_create = unsent_create or record[1] == "create"
+            self.ack(record)
+
+        if not unsent_create:
+            self.append([self.new_seq(), "delete", booking_id])
+
+    #Looks for the booking a sent but unanswered create made: returns it, False if there is none, or None if the
+    #API could not be asked
+    async def find_created(self, record, access_token, resource_id):
+        bookings = await get_bookings_in_range(resource_id, access_token, record[4], record[5])
+        if bookings is None:
+            return None
+        start = epoch_time.parse(record[4])
+        for booking in bookings:
+            if booking.membership_id == record[3] and booking.start == start:
+                return booking
+        return False
+
+    #Sends one journaled operation, returns what the helper returned (None if the API is still unreachable)
+    async def send(self, record, access_token, resource_id):
+        if record[1] == "create":
+            if was_sent(record):
+                booking = await self.find_created(record, access_token, resource_id)
+                if booking is not False:
+                    return booking
+            return await create_booking(record[3], access_token, resource_id, record[4], record[5])
+        if record[1] == "update":
+            return await update_booking(record[2], access_token, record[3], record[4])
+        return await delete_booking(record[2], access_token)
+
+    #Replays pending operations in order until one cannot be sent. on_result(record, result) is awaited for every
+    #operation the API answered, with the created/updated Booking, True for a deletion, or False if it was rejected.
+    #Changes journaled while an operation is on its way are added after it rather than folded into it.
+    async def replay(self, access_token, resource_id, on_result):
+        while self.operations:
+            record = self.operations[0]
+            self.sending = record
+            try:
+                result = await self.send(record, access_token, resource_id)
+            finally:
+                self.sending = None
+            if result == BOOKING_UNCONFIRMED:
+                if not was_sent(record):
+                    self.replace(record + [True])
+                return False
+            if result is None:
+                return False
+
+            self.ack(record)
+            if record[1] == "create":
+                for later in self.pending_for(record[2]):
+                    if result is False:
+                        #Nothing left to change on a booking that was never created
+                        self.ack(later)
+                    else:
+                        #Later operations on the provisional booking now target the real one
+                        self.replace(later[:2] + [result.id] + later[3:])
+
+            await on_result(record, result)
+
+        return True
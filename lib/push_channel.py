@@ -0,0 +1,73 @@
+import uasyncio as asyncio
+
+from api_client import read_headers
+import flash_log
+import log_messages
+
+#Long-lived subscription to the fleet gateway's stream of changes to this resource's bookings (gateway/gateway.py),
+#so bookings made or cancelled online reach the device within a second instead of at its next schedule refresh.
+#The stream is server-sent events: a data line per change, and a comment every 25 s showing the connection is
+#alive. A stream that stays quiet for longer than READ_TIMEOUT_S is taken as dropped, and is opened again with
+#backoff while the device falls back to polling.
+
+CONNECT_TIMEOUT_S = 5
+READ_TIMEOUT_S = 60
+RETRY_MIN_S = 2
+RETRY_MAX_S = 120
+
+class PushChannel:
+    #api is the ApiClient whose host the stream is opened on; it keeps its own connection for requests
+    def __init__(self, api, resource_id, on_change, on_disconnect):
+        self.api = api
+        self.path = api.base_path + "/resources/" + resource_id + "/changes?access_token="
+        self.on_change = on_change
+        self.on_disconnect = on_disconnect
+        self.connected = False
+        self.opened = 0 #Streams opened so far
+
+    async def listen(self, access_token):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.api.host, self.api.port, ssl=True if self.api.use_ssl else None),
+            CONNECT_TIMEOUT_S)
+        try:
+            request = "GET {} HTTP/1.1\r\nHost: {}\r\nAccept: text/event-stream\r\n\r\n".format(self.path + access_token, self.api.host)
+            writer.write(request.encode())
+            await writer.drain()
+
+            status_code, headers = await asyncio.wait_for(read_headers(reader), READ_TIMEOUT_S)
+            if status_code != 200:
+                raise OSError("push channel refused with status {}".format(status_code))
+            self.connected = True
+            self.opened += 1
+            print("Push channel connected, polling only as a fallback\n")
+            #Anything that changed while the stream was down was missed
+            self.on_change()
+
+            while True:
+                line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT_S)
+                if not line:
+                    raise OSError("push channel closed")
+                if line.startswith(b"data:"):
+                    self.on_change()
+        finally:
+            writer.close()
+            if self.connected:
+                self.connected = False
+                self.on_disconnect()
+
+    #Keeps the stream open for as long as the device runs
+    async def run(self, access_token):
+        retry_s = RETRY_MIN_S
+        while True:
+            opened = self.opened
+            try:
+                await self.listen(access_token)
+            except Exception as e:
+                #Logged when a stream that was up drops, and on the first failed attempt, not on every retry
+                if self.opened != opened or retry_s == RETRY_MIN_S:
+                    print("Push channel unavailable, polling until it is back: {}\n".format(e))
+                    flash_log.info(log_messages.PUSH_CHANNEL_DROPPED, e)
+            if self.opened != opened:
+                retry_s = RETRY_MIN_S
+            await asyncio.sleep(retry_s)
+            retry_s = min(retry_s * 2, RETRY_MAX_S)
@@ -0,0 +1,171 @@
+#Local copy of the resource's bookings for the day, kept sorted by start time so "booked now?",
+#"who holds it?" and "when does it free up?" are answered with a binary search instead of an API call.
+#Bookings on one resource never overlap, so the entry starting last at or before a time is the only candidate.
+
+class DaySchedule:
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.bookings = []
+        self.window_start = 0 #Span of time the schedule is known to be complete for
+        self.window_end = 0
+        self.synced_at = 0
+        self.sync_state = {} #Validators of the last fetch, so unchanged bookings aren't downloaded and parsed again
+        self.changed_from = None #Span of time bookings were inserted or deleted in since take_changed()
+        self.changed_to = None
+        self.local_edits = 0 #Counts add() and remove() calls, so a sync can tell the device changed a booking meanwhile
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_known(self, t):
+        return self.window_start <= t < self.window_end
+
+    #Index of the last booking starting at or before t, -1 if there is none
+    def index_at_or_before(self, t):
+        low, high = 0, len(self.starts)
+        while low < high:
+            middle = (low + high) // 2
+            if self.starts[middle] <= t:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+    #Returns the booking running at time t, or None
+    def booking_at(self, t):
+        i = self.index_at_or_before(t)
+        if i >= 0 and self.ends[i] > t:
+            return self.bookings[i]
+        return None
+
+    #Returns the first booking that overlaps [range_start, range_end), or None
+    def first_booking_between(self, range_start, range_end):
+        i = self.index_at_or_before(range_start)
+        if i >= 0 and self.ends[i] > range_start:
+            return self.bookings[i]
+        if i + 1 < len(self.starts) and self.starts[i + 1] < range_end:
+            return self.bookings[i + 1]
+        return None
+
+    #Returns the first booking starting after t, or None
+    def next_booking_after(self, t):
+        i = self.index_at_or_before(t) + 1
+        if i < len(self.starts):
+            return self.bookings[i]
+        return None
+
+    #Returns the first time at or after t when the resource is not booked, following back-to-back bookings
+    def free_at(self, t):
+        i = self.index_at_or_before(t)
+        if i < 0 or self.ends[i] <= t:
+            return t
+        free_time = self.ends[i]
+        i += 1
+        while i < len(self.starts) and self.starts[i] <= free_time:
+            free_time = max(free_time, self.ends[i])
+            i += 1
+        return free_time
+
+    def note_changed(self, start, end):
+        if self.changed_from is None:
+            self.changed_from, self.changed_to = start, end
+        else:
+            self.changed_from = min(self.changed_from, start)
+            self.changed_to = max(self.changed_to, end)
+
+    #Returns the span of time bookings changed in since the last call as (start, end), or None if none did
+    def take_changed(self):
+        if self.changed_from is None:
+            return None
+        changed = (self.changed_from, self.changed_to)
+        self.changed_from = self.changed_to = None
+        return changed
+
+    def index_of(self, booking_id):
+        for i in range(len(self.bookings)):
+            if self.bookings[i].id == booking_id:
+                return i
+        return -1
+
+    def insert(self, booking):
+        i = self.index_at_or_before(booking.start) + 1
+        self.starts.insert(i, booking.start)
+        self.ends.insert(i, booking.end)
+        self.bookings.insert(i, booking)
+        self.note_changed(booking.start, booking.end)
+
+    def delete_at(self, i):
+        self.note_changed(self.starts[i], self.ends[i])
+        del self.starts[i]
+        del self.ends[i]
+        del self.bookings[i]
+
+    #Local changes make the next sync fetch everything again, in case the API ended up disagreeing with them
+    def add(self, booking):
+        self.insert(booking)
+        self.sync_state.clear()
+        self.local_edits += 1
+
+    def remove(self, booking_id):
+        self.local_edits += 1
+        i = self.index_of(booking_id)
+        if i >= 0:
+            self.delete_at(i)
+            self.sync_state.clear()
+        return i >= 0
+
+    def update(self, booking):
+        self.remove(booking.id)
+        self.add(booking)
+
+    #Drops bookings that ended before t so the index stays as small as the rest of the day
+    def prune(self, t):
+        keep_from = 0
+        while keep_from < len(self.ends) and self.ends[keep_from] <= t:
+            keep_from += 1
+        if keep_from:
+            self.note_changed(self.starts[0], self.ends[keep_from - 1])
+            del self.starts[:keep_from]
+            del self.ends[:keep_from]
+            del self.bookings[:keep_from]
+
+    #Makes [window_start, window_end) match freshly fetched Bookings, touching only the bookings that were added,
+    #moved, or removed, and keeping bookings outside that window. Returns the number of changes.
+    def merge(self, bookings, window_start, window_end, synced_at):
+        changes = 0
+        fetched_ids = {}
+        for booking in bookings:
+            fetched_ids[booking.id] = True
+            i = self.index_of(booking.id)
+            if booking.end <= synced_at:
+                #Already over, maybe because it was ended early: a local copy still running must go
+                if i >= 0:
+                    self.delete_at(i)
+                    changes += 1
+                continue
+            if i >= 0:
+                if self.bookings[i] == booking:
+                    continue
+                self.delete_at(i)
+            self.insert(booking)
+            changes += 1
+
+        i = 0
+        while i < len(self.starts):
+            if self.starts[i] < window_end and self.ends[i] > window_start and self.bookings[i].id not in fetched_ids:
+                self.delete_at(i)
+                changes += 1
+            else:
+                i += 1
+
+        self.mark_synced(window_start, window_end, synced_at)
+        return changes
+
+    def mark_synced(self, window_start, window_end, synced_at):
+        if self.window_end == 0 or window_start > self.window_end or window_end < self.window_start:
+            self.window_start, self.window_end = window_start, window_end
+        else:
+            self.window_start = min(self.window_start, window_start)
+            self.window_end = max(self.window_end, window_end)
+        self.synced_at = synced_at
@@ -0,0 +1,82 @@
+import os
+import utime
+import ujson
+import ubinascii
+
+import flash_log
+import log_messages
+from booking_record import Booking
+
+#Last known booking state on flash: the day's schedule, the span it is known for and the validators of its last
+#fetch, plus which booking is current and whether its member has checked in. It is saved whenever it changes and
+#restored at boot, so the LEDs are right and badges are taken before WiFi, NTP and the first sync are done. That
+#first sync then reconciles it with Cobot, usually with a 304 thanks to the saved validators.
+
+VERSION = 1
+
+class StateSnapshot:
+    def __init__(self, filename="state.json"):
+        self.filename = filename
+        self.saved = None #Contents of the last save, so unchanged state isn't written to flash again
+        self.saved_at = 0 #Wall clock at the last save. A clock reading earlier than this after boot hasn't been set.
+
+    #Fills schedule with the saved bookings and returns (current booking ID, checked in, on-site creation time),
+    #or None if nothing usable was saved
+    def load(self, schedule):
+        try:
+            with open(self.filename) as f:
+                data = ujson.load(f)
+            if data["version"] != VERSION:
+                return None
+            bookings = [Booking(booking_id, membership_id, start, end) for booking_id, membership_id, start, end in data["bookings"]]
+            window_start, window_end = data["window"]
+            sync_state = {}
+            for name, value in data["sync"].items():
+                if name == "range":
+                    value = tuple(value)
+                elif name == "hash":
+                    value = ubinascii.unhexlify(value)
+                sync_state[name] = value
+            booking_id, is_checked_in, created_at = data["state"]
+            saved_at = data["saved_at"]
+        except OSError:
+            return None
+        except Exception as e:
+            flash_log.error(log_messages.STATE_SNAPSHOT_RESET, e)
+            return None
+
+        for booking in bookings:
+            schedule.insert(booking)
+        schedule.window_start, schedule.window_end = window_start, window_end
+        schedule.sync_state.update(sync_state)
+        self.saved_at = saved_at
+        print("Restored {} bookings saved at {}\n".format(len(bookings), saved_at))
+        return booking_id, is_checked_in, created_at
+
+    #Writes the state out if it differs from the last save
+    def save(self, schedule, booking_id, is_checked_in, created_at):
+        sync = {}
+        for name, value in schedule.sync_state.items():
+            if name == "hash":
+                value = ubinascii.hexlify(value).decode()
+            sync[name] = value
+        contents = {
+            "version": VERSION,
+            "bookings": [[booking.id, booking.membership_id, booking.start, booking.end] for booking in schedule.bookings],
+            "window": [schedule.window_start, schedule.window_end],
+            "sync": sync,
+            "state": [booking_id, is_checked_in, created_at],
+        }
+        if contents == self.saved:
+            return
+
+        data = dict(contents)
+        data["saved_at"] = utime.time()
+        try:
+            with open(self.filename + ".tmp", "w") as f:
+                ujson.dump(data, f)
+            os.rename(self.filename + ".tmp", self.filename)
+            self.saved = contents
+            self.saved_at = data["saved_at"]
+        except Exception as e:
+            flash_log.error(log_messages.STATE_SNAPSHOT_WRITE_FAILED, e)
@@ -0,0 +1,64 @@
+import utime
+import uasyncio as asyncio
+
+#Plans when the device next has something to do, so tasks sleep until then instead of polling on a fixed timer.
+#Each kind of wakeup (a schedule refresh, a booking boundary, ...) has at most one planned time, kept sorted so the
+#next one is always first. There are only ever a handful, so a sorted list does the job of a timer wheel.
+
+MAX_SLEEP_S = 60 #Re-check at least this often, in case the wall clock was stepped
+
+class WakeupScheduler:
+    def __init__(self):
+        self.times = []
+        self.kinds = []
+        self.changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.times)
+
+    #Plans kind for time t (epoch seconds), replacing any earlier plan for it
+    def at(self, t, kind):
+        self.cancel(kind)
+        low, high = 0, len(self.times)
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle] <= t:
+                low = middle + 1
+            else:
+                high = middle
+        self.times.insert(low, t)
+        self.kinds.insert(low, kind)
+        if low == 0:
+            self.changed.set()
+
+    def cancel(self, kind):
+        for i in range(len(self.kinds)):
+            if self.kinds[i] == kind:
+                del self.times[i]
+                del self.kinds[i]
+                return
+
+    #Removes and returns the kinds planned at or before now
+    def pop_due(self, now):
+        due = []
+        while self.times and self.times[0] <= now:
+            del self.times[0]
+            due.append(self.kinds.pop(0))
+        return due
+
+    #Sleeps until at least one wakeup is due and returns their kinds. Planning an earlier wakeup wakes it early.
+    async def wait_due(self):
+        while True:
+            now = utime.time()
+            due = self.pop_due(now)
+            if due:
+                return due
+
+            delay = MAX_SLEEP_S
+            if self.times:
+                delay = min(delay, self.times[0] - now)
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -1,23 +1,44 @@
 #Built-in modules
 import utime
+import _thread
+import uasyncio as asyncio
 from machine import Pin, PWM
+from neopixel import NeoPixel
 
 #External modules, sources noted in each module
-import logging
 from mfrc522 import MFRC522
 
 #API functions
 from helper_functions import get_membership_id,get_current_booking,create_booking,update_booking,delete_booking,get_checkin_token_from_badge,get_bookings_in_range
 #Local functions
-from helper_functions import get_now,create_formatted_time_string,get_time_from_string,file_or_dir_exists,is_booking_less_than_five_minutes_old,configure_device,set_time_to_UTC,connect_to_wifi,update_or_delete_booking,get_resource_availability,play_song,set_led_lights
+from helper_functions import get_now,create_formatted_time_string,get_time_from_string,file_or_dir_exists,is_booking_less_than_five_minutes_old,configure_device,set_time_to_UTC,start_wifi,connect_to_wifi,update_or_delete_booking,get_resource_availability,SongPlayer,set_led_lights
+from helper_functions import sync_schedule,get_start_of_day,get_booking_times,cobot_api,BOOKING_MINIMUM_S,BOOKING_UNCONFIRMED
+from booking_record import Booking
+from schedule import DaySchedule
+from membership_cache import MembershipCache
+from op_journal import OperationJournal
+from core_queue import BoundedQueue
+from wakeup import WakeupScheduler
+from state_snapshot import StateSnapshot
+from push_channel import PushChannel
+from availability_strip import SlotBitmap, StripRenderer, SLOTS
+import epoch_time
+import metrics
+import flash_log
+import log_messages
 #WiFi info, resource ID
 import secrets
 
 ##### STARTUP #####
 
-#Logging
-logging.basicConfig(filename="log_{}.txt".format(secrets.RESOURCE_ID), filemode='w', format="%(asctime)s:%(levelname)-7s:%(name)s:%(message)s")
-logger = logging.getLogger("main_logger")
+#Notes how far startup has got, for the startup time breakdown in /metrics and the flash log
+def startup_reached(phase):
+    flash_log.info(log_messages.STARTUP_PHASE, phase, metrics.boot_phase(phase))
+
+#Logging, carrying on in the newest log segment on flash
+flash_log.log.load()
+flash_log.info(log_messages.BOOT)
+startup_reached("imported")
 
 #Hardware
 reader = MFRC522(spi_id=0, sck=2, miso=4, mosi=3, cs=1, rst=0)
@@ -35,138 +56,731 @@ for led in led_booked:
 
 last_led_status = led_error
 
-#Wifi and time
-connect_to_wifi()
-set_time_to_UTC()
+#While the Cobot API is unavailable, led_error stays on next to the status LEDs
+led_available_degraded = led_available + led_error
+led_booked_degraded = led_booked + led_error
+led_checked_in_degraded = led_checked_in + led_error
 
-#Cobot access token and current availability
-OAUTH_TOKEN = configure_device()
-current_booking = get_current_booking(secrets.RESOURCE_ID, OAUTH_TOKEN)
-is_resource_available = get_resource_availability(current_booking, secrets.RESOURCE_ID, OAUTH_TOKEN)
+#Optional strip of SLOTS pixels showing the day's availability by half hour, from AVAILABILITY_STRIP_FROM_UTC
+STRIP_PIN = getattr(secrets, "AVAILABILITY_STRIP_PIN", None)
+strip_renderer = StripRenderer(NeoPixel(Pin(STRIP_PIN, Pin.OUT), SLOTS)) if STRIP_PIN is not None else None
 
-booking_end_time = 0
-if current_booking != {}:
-    booking_end_time = get_time_from_string(current_booking["to"])
-    
+OAUTH_TOKEN = ""
+schedule = DaySchedule() #Today's bookings, the source of truth for current_booking
+current_booking = None #Booking record running now or within the next minute
+PENDING_BOOKING_ID = "pending" #current_booking's ID while an on-site booking is being created
+is_resource_available = False
 
 previous_card = [0] #Limits rapid re-reading of RFID badges
 is_user_checked_in_to_booking = False #Tracks whether user with active booking has badged in
-last_user_token_and_id = {} #Limits unecessary API calls when same user badges concurrently
-membership_id = ""
 
 #Timer-related
 
-onsite_booking_creation_time = utime.time() #For checking whether enough time has passed for API ping or booking cancellation                
-availability_update_time = utime.time() #For spacing out API calls to check resource availability
+onsite_booking_creation_time = utime.time() #For checking whether enough time has passed for API ping or booking cancellation
+availability_update_time = utime.time() #When the schedule was last refreshed
 TIMER_S = 300 #5 minutes in seconds
+MEMBERSHIP_CACHE_SIZE = 32
+MEMBERSHIP_CACHE_TTL_S = 7 * 86400 #Re-check badges weekly so lost or reassigned badges don't stay valid forever
+SCHEDULE_LOOKAHEAD_S = 3600 #Also know the start of tomorrow, so late bookings don't run past the known window
+#The reader is polled quickly while a card is on it or was just used, and more slowly once nobody is around
+RFID_POLL_FAST_MS = 20
+RFID_POLL_MS = 50
+RFID_POLL_IDLE_MS = 100
+RFID_FAST_FOR_MS = 2000 #After a card arrives or leaves
+RFID_IDLE_AFTER_MS = 10000
+RFID_REINIT_MS = 30000 #Re-initialise the reader this often even when idle, in case it reset or browned out
+UI_TICK_MS = 10 #How often the UI core steps the buzzer while a song plays
+CORRECTION_SHOW_S = 5 #How long led_error stays on after a rejected change
+JOURNAL_RETRY_S = 30 #How often to retry sending booking changes made while offline
+BADGE_BUDGET_MS = 4000 #Longest the API calls of one swipe may take, retries included
+SYNC_BUDGET_MS = 15000 #Same for a schedule refresh or journal replay
+
+#Schedule refreshes come quickly while bookings are changing and back off while they aren't, further outside
+#the hours the space is busy. Another refresh happens shortly before each known booking starts, to catch
+#last-minute changes to it.
+REFRESH_MIN_S = 60
+REFRESH_MAX_S = 900
+REFRESH_QUIET_MAX_S = 3600
+REFRESH_LEAD_S = 120
+BUSY_HOURS_UTC = getattr(secrets, "BUSY_HOURS_UTC", (5, 21)) #[start, end) hours, UTC
+refresh_interval_s = REFRESH_MIN_S
+next_refresh_time = utime.time()
+
+#Kinds of wakeup planned on the wakeup scheduler
+REFRESH = "refresh"
+JOURNAL = "journal"
+STATUS = "status"
+wakeups = WakeupScheduler()
+METRICS_PORT = getattr(secrets, "METRICS_PORT", 8080) #0 turns the metrics endpoint off
+
+#Behind the fleet gateway, booking changes are pushed to the device as they happen. Refreshes then only follow a
+#push, and polling stays as a slow fallback while the push channel is up.
+PUSH_UPDATES = getattr(secrets, "PUSH_UPDATES", False)
+PUSH_REFRESH_MAX_S = 3600
+
+membership_cache = MembershipCache(max_entries=MEMBERSHIP_CACHE_SIZE, ttl_s=MEMBERSHIP_CACHE_TTL_S) #Limits unecessary API calls for returning members
+journal = OperationJournal() #Booking changes waiting for the API to come back
+journal_retry_time = utime.time()
+state_snapshot = StateSnapshot() #Last known booking state, so a reboot can carry on before the network is up
+
+#Startup brings the UI up from the state on flash first and the network behind it. Badges are handled once the
+#clock can be trusted: straight away if it kept running through a reset, after NTP if the power was cut.
+clock_ready = asyncio.Event()
+network_ready = asyncio.Event() #Set once WiFi, the clock and the API token are there and the first sync has begun
+CLOCK_VALID_AFTER = epoch_time.from_civil(2024, 1, 1) #The RTC restarts in 2021 after a power cut
+NTP_RETRY_MAX_S = 60
+STARTUP_BADGE_WAIT_S = 10 #How long a badge the membership cache doesn't know waits for the network after boot
 
 #Frequencies for buzzer feedback
 card_read_song = [784, 784, 784]
 success_song = [440, 523, 698, 698, 698]
 error_song = [440, 196, 175, 175, 175]
+checkout_song = [698, 523, 440]
+correction_song = [698, 175, 698, 175, 698, 175] #Cobot rejected a change the member already heard succeed
 
-##### BEGINNING OF INTERACTABLE PROGRAM #####
+#Core communication. Core 1 runs the UI loop: it polls the reader and drives the buzzer and LEDs, and never
+#touches the network. Core 0 runs the asyncio tasks that talk to the Cobot API and own the booking state.
+#They only share these queues: badges go from the UI core to core 0, songs and LED changes go the other way.
+MAX_QUEUED_BADGES = 4
+MAX_QUEUED_UI_MESSAGES = 8
+badge_queue = BoundedQueue(MAX_QUEUED_BADGES)
+badge_flag = asyncio.ThreadSafeFlag() #Wakes badge_task on core 0 when the UI core queues a badge
+ui_queue = BoundedQueue(MAX_QUEUED_UI_MESSAGES)
+SONG = 0
+LEDS = 1
+STRIP = 2
 
-try:
-    print("RFID reader active\n")
+ui_running = False
+ui_stopped = True
 
-    #This section updates constantly until a card is detected
-    while True:        
-        #if is_resource_available:
-        if current_booking == {}:
-            last_led_status = set_led_lights(led_available, last_led_status)
-
-            if (utime.time() - availability_update_time) > TIMER_S:
-                print("Checking for booking (every {} seconds)\n".format(TIMER_S))
-                #is_resource_available = get_resource_availability(current_booking, secrets.RESOURCE_ID, OAUTH_TOKEN)
-                current_booking = get_current_booking(secrets.RESOURCE_ID, OAUTH_TOKEN)
-                availability_update_time = utime.time()
-                
-                if current_booking != {}:
-                    booking_end_time = get_time_from_string(current_booking["to"])
-                    
-        else:
-            if not is_user_checked_in_to_booking:
-                last_led_status = set_led_lights(led_booked, last_led_status)
-            if utime.time() > booking_end_time:
-                print("Booking cleared because its end time had been reached\n")
-                current_booking = {}
+song_player = SongPlayer(buzzer)
+shown_led_status = last_led_status #Last LED status core 0 asked for, so it only sends changes
+slot_bitmap = SlotBitmap(getattr(secrets, "AVAILABILITY_STRIP_FROM_UTC", 6)) if strip_renderer is not None else None
+shown_strip = None #Last (booked slots, slots over) core 0 sent to the strip
+
+#Only one task at a time may read or replace current_booking across an await. A swipe holds it from deciding its
+#outcome until its booking call is answered; refreshes and replays only take it to apply what the API said, so a
+#swipe never waits for their requests.
+booking_lock = asyncio.Lock()
+sync_lock = asyncio.Lock() #One schedule refresh or journal replay at a time
+
+def queue_song(song):
+    if not ui_queue.put((SONG, song)):
+        flash_log.error(log_messages.UI_QUEUE_FULL)
+
+correction_until = 0
+
+#Tells the member that a change they already got success feedback for was rejected by the API
+def signal_correction(booking_id):
+    global correction_until
+
+    queue_song(correction_song)
+    show_leds(led_error)
+    flash_log.info(log_messages.CORRECTION_SIGNALLED, booking_id)
+    correction_until = utime.time() + CORRECTION_SHOW_S
+
+def show_leds(new_status):
+    global shown_led_status
 
+    if new_status is not shown_led_status and ui_queue.put((LEDS, new_status)):
+        shown_led_status = new_status
+
+#Brings the availability strip in line with the local schedule, sending the UI core only what changed
+def show_strip(now):
+    global shown_strip
+
+    if slot_bitmap is None:
+        return
+    slot_bitmap.update(schedule, now)
+    strip = (slot_bitmap.booked, slot_bitmap.slots_over(now))
+    if strip != shown_strip and ui_queue.put((STRIP, strip)):
+        shown_strip = strip
+
+##### UI CORE #####
+
+#Reads a badge if one is presented and hands it to core 0
+last_card_activity_ms = utime.ticks_add(utime.ticks_ms(), -RFID_FAST_FOR_MS) #Booting isn't card activity
+last_reader_init_ms = utime.ticks_ms()
+
+def poll_rfid():
+    global previous_card, last_card_activity_ms, last_reader_init_ms
+
+    started = metrics.start()
+    now_ms = utime.ticks_ms()
+
+    #A card that has been read ignores REQIDL until the reader resets its field, so the reader is re-initialised
+    #while a card is tracked to keep seeing it there (which is what previous_card's debounce relies on).
+    #With no card around, the request alone is enough to spot a new one.
+    if previous_card != [0] or utime.ticks_diff(now_ms, last_reader_init_ms) >= RFID_REINIT_MS:
         reader.init()
-        (stat, tag_type) = reader.request(reader.REQIDL)
-         
+        last_reader_init_ms = now_ms
+    (stat, tag_type) = reader.request(reader.REQIDL)
+
+    #request() reports an empty field as ERR too, so it says nothing about the reader's state
+    if stat != reader.OK:
+        if previous_card != [0]:
+            last_card_activity_ms = now_ms
+        previous_card = [0]
+    else:
+        (stat, uid) = reader.SelectTagSN()
+
+        #A card left half-selected in READY ignores REQIDL, so reset the reader on the next poll
         if stat != reader.OK:
-            previous_card = [0]
-        else:
-            (stat, uid) = reader.SelectTagSN()
-            
-            #Prevents immediate re-read on same card
-            if uid == previous_card:
-                continue
-            
-            if stat != reader.OK:
-                pass
+            last_reader_init_ms = utime.ticks_add(now_ms, -RFID_REINIT_MS)
+
+        #Prevents immediate re-read on same card
+        if stat == reader.OK and uid != previous_card:
+            #This section will only run when an acceptable RFID card is detected
+            song_player.play(card_read_song)
+
+            if badge_queue.put(uid):
+                badge_flag.set()
             else:
-                #This section will only run when an acceptable RFID card is detected
-                play_song(buzzer, card_read_song)
-
-                user_checkin_token = get_checkin_token_from_badge(uid)
-                membership_id = get_membership_id(user_checkin_token, OAUTH_TOKEN, last_user_token_and_id)
-                last_user_token_and_id = {user_checkin_token: membership_id}
-                
-                if membership_id is "":
-                    print("Membership ID is invalid, cannot book resource\n")
-                    play_song(buzzer, error_song)
+                flash_log.error(log_messages.BADGE_QUEUE_FULL)
+
+            previous_card = uid
+            last_card_activity_ms = now_ms
+
+    metrics.stop(metrics.RFID_POLL, started)
+
+def rfid_poll_interval(now_ms):
+    quiet_ms = utime.ticks_diff(now_ms, last_card_activity_ms)
+    if previous_card != [0] or 0 <= quiet_ms < RFID_FAST_FOR_MS:
+        return RFID_POLL_FAST_MS
+    if 0 <= quiet_ms < RFID_IDLE_AFTER_MS:
+        return RFID_POLL_MS
+    return RFID_POLL_IDLE_MS
+
+#Runs on core 1 until ui_running is cleared
+def ui_loop():
+    global last_led_status, ui_stopped
+
+    next_poll_ms = utime.ticks_ms()
+    try:
+        while ui_running:
+            now_ms = utime.ticks_ms()
+            if utime.ticks_diff(now_ms, next_poll_ms) >= 0:
+                poll_rfid()
+                next_poll_ms = utime.ticks_add(now_ms, rfid_poll_interval(now_ms))
+
+            message = ui_queue.get()
+            while message is not None:
+                if message[0] == SONG:
+                    #The outcome is worth more than the rest of the acknowledgement beep
+                    if song_player.song is card_read_song:
+                        song_player.stop()
+                    song_player.play(message[1])
+                elif message[0] == STRIP:
+                    strip_renderer.show(message[1][0], message[1][1])
                 else:
-                    #if is_resource_available:
-                    if current_booking == {}:
-                        current_booking = create_booking(
-                            membership_id,
-                            OAUTH_TOKEN,
-                            secrets.RESOURCE_ID,
-                        )
-                        
-                        booking_end_time = get_time_from_string(current_booking["to"])
-                        
-                        if current_booking == {}:
-                            print("Booking creation failed\n")
-                            play_song(buzzer, error_song)
-                        else:
-                            print("User is checked in for the booking they just created\n")
-                            play_song(buzzer, success_song)
-                            is_user_checked_in_to_booking = True
-                            onsite_booking_creation_time = utime.time()
-                            is_resource_available = False
-                            last_led_status = set_led_lights(led_checked_in, last_led_status)
-                    else:
-                        print("Resource is currently booked\n")
-                        
-                        if membership_id == current_booking["membership_id"]:
-                            print("User who swiped badge has the current booking\n")
-                            
-                            if is_user_checked_in_to_booking == False:
-                                print("User is now checked in for their booking\n")
-                                play_song(buzzer, success_song)
-                                is_user_checked_in_to_booking = True
-                                last_led_status = set_led_lights(led_checked_in, last_led_status)
-                                
-                                if(utime.time() - get_time_from_string(current_booking["from"])) > TIMER_S:
-                                    update_booking(current_booking["id"], OAUTH_TOKEN, "start_time")
-
-                                #TODO: Show something to confirm the user has started their booking
+                    last_led_status = set_led_lights(message[1], last_led_status)
+                message = ui_queue.get()
+
+            song_player.update(now_ms)
+
+            #Without a song to step through, nothing needs doing before the next poll
+            sleep_ms = utime.ticks_diff(next_poll_ms, utime.ticks_ms())
+            if song_player.song is not None or song_player.songs:
+                sleep_ms = min(sleep_ms, UI_TICK_MS)
+            if sleep_ms > 0:
+                utime.sleep_ms(sleep_ms)
+    except Exception as e:
+        flash_log.error(log_messages.UI_LOOP_STOPPED, e)
+    finally:
+        buzzer.duty_u16(0)
+        ui_stopped = True
+
+def start_ui_core():
+    global ui_running, ui_stopped
+
+    ui_running = True
+    ui_stopped = False
+    _thread.start_new_thread(ui_loop, ())
+
+def stop_ui_core():
+    global ui_running
+
+    ui_running = False
+    for i in range(100):
+        if ui_stopped:
+            break
+        utime.sleep_ms(UI_TICK_MS)
+
+##### NETWORK CORE TASKS #####
+
+def booking_id_of(booking):
+    return booking.id if booking is not None else None
+
+#Points current_booking at whatever the local schedule has booked within the next minute
+def update_current_booking():
+    global current_booking, is_user_checked_in_to_booking
+
+    now = utime.time()
+    booking = schedule.first_booking_between(now, now + 60)
+
+    if booking is not current_booking:
+        if booking_id_of(booking) != booking_id_of(current_booking):
+            if booking is None:
+                print("Booking cleared because its end time had been reached\n")
+            else:
+                print("Resource is booked: {}\n".format(booking))
+            is_user_checked_in_to_booking = False
+        current_booking = booking
+
+#Brings current_booking and the status LEDs in line with the local schedule, then plans the next time either
+#could change on their own: the next booking boundary or the end of a correction signal
+def update_status():
+    update_current_booking()
+
+    now = utime.time()
+    degraded = cobot_api.breaker.is_open()
+    if now < correction_until:
+        pass #Leave led_error on for a while
+    elif current_booking is None:
+        show_leds(led_available_degraded if degraded else led_available)
+    elif not is_user_checked_in_to_booking:
+        show_leds(led_booked_degraded if degraded else led_booked)
+    else:
+        show_leds(led_checked_in_degraded if degraded else led_checked_in)
+    show_strip(now)
+
+    plan_wakeups(now)
+    save_state()
+
+#Next time (epoch seconds) update_current_booking could give a different answer without the schedule changing
+def next_booking_boundary(now):
+    boundary = schedule.window_end
+    if boundary <= now:
+        boundary = now + REFRESH_MIN_S #Nothing changes past the known window until a refresh moves it on
+    if current_booking is not None and current_booking.end > now:
+        boundary = min(boundary, current_booking.end)
+    next_booking = schedule.next_booking_after(now)
+    if next_booking is not None:
+        #current_booking picks bookings up once they start less than a minute from now
+        boundary = min(boundary, max(now + 1, next_booking.start - 59))
+    return boundary
+
+#Longest refresh interval for the time of day
+def max_refresh_interval(now):
+    if push_channel is not None and push_channel.connected:
+        return PUSH_REFRESH_MAX_S
+    hour = (now % 86400) // 3600
+    if BUSY_HOURS_UTC[0] <= hour < BUSY_HOURS_UTC[1]:
+        return REFRESH_MAX_S
+    return REFRESH_QUIET_MAX_S
+
+#Sets the interval to the next refresh from how many bookings the last one changed (None if it failed)
+def plan_refresh(now, changes):
+    global refresh_interval_s, next_refresh_time
+
+    if changes == 0:
+        refresh_interval_s = min(refresh_interval_s * 2, max_refresh_interval(now))
+    else:
+        refresh_interval_s = REFRESH_MIN_S
+    next_refresh_time = now + refresh_interval_s
+
+def plan_wakeups(now):
+    if now < correction_until:
+        status_time = correction_until
+    else:
+        status_time = next_booking_boundary(now)
+    if slot_bitmap is not None and slot_bitmap.day_start is not None:
+        status_time = min(status_time, slot_bitmap.next_change(now))
+    wakeups.at(status_time, STATUS)
+
+    if not network_ready.is_set():
+        return #start_network() does the first refresh and journal replay
+
+    refresh_time = min(next_refresh_time, get_start_of_day(now) + 86400) #Move the window on at midnight
+    next_booking = schedule.next_booking_after(now)
+    if next_booking is not None and next_booking.start - REFRESH_LEAD_S > availability_update_time:
+        refresh_time = min(refresh_time, max(now, next_booking.start - REFRESH_LEAD_S))
+    wakeups.at(refresh_time, REFRESH)
+
+    if len(journal):
+        wakeups.at(journal_retry_time + JOURNAL_RETRY_S, JOURNAL)
+    else:
+        wakeups.cancel(JOURNAL)
+
+#A booking on this resource changed: refresh straight away
+def on_push_change():
+    global next_refresh_time
+
+    next_refresh_time = utime.time()
+    plan_wakeups(next_refresh_time)
+
+#Polling is the only way to see changes again, so go back to its usual interval
+def on_push_disconnect():
+    global refresh_interval_s, next_refresh_time
+
+    now = utime.time()
+    refresh_interval_s = min(refresh_interval_s, max_refresh_interval(now))
+    next_refresh_time = min(next_refresh_time, availability_update_time + refresh_interval_s)
+    plan_wakeups(now)
+
+push_channel = PushChannel(cobot_api, secrets.RESOURCE_ID, on_push_change, on_push_disconnect) if PUSH_UPDATES else None
+
+#Booking changes go to the journal and badges are only known from the membership cache while the breaker is open
+def on_breaker_change(state):
+    if state == cobot_api.breaker.OPEN:
+        print("Cobot API unavailable, carrying on locally for {} seconds\n".format(cobot_api.breaker.cooldown_ms // 1000))
+        flash_log.error(log_messages.API_BREAKER_OPENED, None, cobot_api.breaker.cooldown_ms)
+    elif state == cobot_api.breaker.CLOSED:
+        print("Cobot API available again\n")
+        flash_log.info(log_messages.API_BREAKER_CLOSED)
+
+cobot_api.breaker.on_change = on_breaker_change
+metrics.sources["api"] = cobot_api.state
+
+def save_state():
+    state_snapshot.save(schedule, booking_id_of(current_booking), is_user_checked_in_to_booking, onsite_booking_creation_time)
+
+#Picks up the booking state saved before the last reset
+def restore_state():
+    global current_booking, is_user_checked_in_to_booking, onsite_booking_creation_time
+
+    state = state_snapshot.load(schedule)
+    if state is None:
+        return
+    booking_id, is_checked_in, onsite_booking_creation_time = state
+    i = schedule.index_of(booking_id)
+    if i >= 0:
+        #update_current_booking() keeps the checked-in flag as long as this booking stays current
+        current_booking = schedule.bookings[i]
+        is_user_checked_in_to_booking = is_checked_in
+
+def clock_is_set():
+    return utime.time() >= max(CLOCK_VALID_AFTER, state_snapshot.saved_at)
+
+#Applies the API's answer to a replayed booking change to the local schedule
+async def on_journal_result(record, result):
+    async with booking_lock:
+        apply_journal_result(record, result)
+
+def apply_journal_result(record, result):
+    global current_booking, is_user_checked_in_to_booking
+
+    if record[1] == "create":
+        #Without the local copy, the booking was deleted here while the create was on its way and the delete follows
+        was_kept = schedule.remove(record[2])
+        if result is False:
+            flash_log.error(log_messages.JOURNAL_CREATE_REJECTED, record[2])
+        elif was_kept:
+            schedule.add(result)
+        if booking_id_of(current_booking) == record[2]:
+            current_booking = result or None
+            if result is False:
+                #The member may still be at the machine, believing they have it
+                is_user_checked_in_to_booking = False
+                signal_correction(record[2])
+    elif record[1] == "update":
+        if result is False:
+            flash_log.error(log_messages.JOURNAL_UPDATE_REJECTED, record[2])
+        elif schedule.index_of(result.id) >= 0:
+            schedule.update(result)
+            if booking_id_of(current_booking) == result.id:
+                current_booking = result
+    elif result is False:
+        flash_log.error(log_messages.JOURNAL_DELETE_REJECTED, record[2])
+    else:
+        schedule.remove(record[2])
+        if booking_id_of(current_booking) == record[2]:
+            current_booking = None
+            is_user_checked_in_to_booking = False
+
+#Sends journaled booking changes in order, returns True once none are pending
+async def replay_journal():
+    global journal_retry_time
+
+    journal_retry_time = utime.time()
+    if len(journal):
+        print("Replaying {} booking changes made while offline\n".format(len(journal)))
+        await journal.replay(OAUTH_TOKEN, secrets.RESOURCE_ID, on_journal_result)
+    return len(journal) == 0
+
+#Re-fetches the rest of the day into the local schedule
+async def refresh_schedule():
+    global availability_update_time
+
+    now = utime.time()
+    availability_update_time = now
+
+    #Fetched bookings would overwrite the provisional ones of changes that haven't been sent yet
+    if not await replay_journal():
+        plan_refresh(now, None)
+        return
+
+    schedule.prune(now)
+    #The window stays the same all day so the API can answer unchanged bookings with a 304
+    window_start = get_start_of_day(now)
+    started = metrics.start()
+    changes = await sync_schedule(schedule, secrets.RESOURCE_ID, OAUTH_TOKEN, window_start, window_start + 86400 + SCHEDULE_LOOKAHEAD_S, booking_lock)
+    if changes is None:
+        metrics.error(metrics.SCHEDULE_SYNC)
+    metrics.stop(metrics.SCHEDULE_SYNC, started)
+    plan_refresh(now, changes)
+
+#Sleeps until the next planned wakeup: a schedule refresh, a journal retry, or a booking starting or ending
+async def wakeup_task():
+    await clock_ready.wait()
+    while True:
+        due = await wakeups.wait_due()
+
+        async with sync_lock:
+            with cobot_api.budget(SYNC_BUDGET_MS):
+                if REFRESH in due:
+                    print("Refreshing schedule (next in up to {} seconds)\n".format(refresh_interval_s))
+                    await refresh_schedule()
+                elif JOURNAL in due:
+                    await replay_journal()
+        async with booking_lock:
+            update_status()
+
+        if REFRESH in due:
+            metrics.collect()
+
+#The booking make_booking will most likely return, held as current_booking while the API is asked
+def expected_booking(membership_id, booking_times):
+    booking_starting_time, booking_ending_time = booking_times
+    return Booking(PENDING_BOOKING_ID, membership_id, epoch_time.parse(booking_starting_time), epoch_time.parse(booking_ending_time))
+
+#Changes go straight to the API unless it isn't up yet after boot, or earlier changes are still waiting to be sent
+def can_send_now():
+    return network_ready.is_set() and not len(journal)
+
+#Creates a booking, or journals it if the API is unreachable, didn't answer, or earlier changes are still waiting to
+#be sent.
+#booking_times are the (start, end) from get_booking_times. Returns the Booking (provisional if journaled), or False
+#if the API rejected it.
+async def make_booking(membership_id, booking_times):
+    booking_starting_time, booking_ending_time = booking_times
+    booking = None
+    if can_send_now():
+        booking = await create_booking(membership_id, OAUTH_TOKEN, secrets.RESOURCE_ID, booking_starting_time, booking_ending_time)
+
+    if booking == BOOKING_UNCONFIRMED:
+        print("No answer from the Cobot API, the booking will be looked for before it is sent again\n")
+        booking = journal.add_create(membership_id, booking_starting_time, booking_ending_time, sent=True)
+    elif booking is None:
+        print("Cobot API unreachable, booking will be created once it is back\n")
+        booking = journal.add_create(membership_id, booking_starting_time, booking_ending_time)
+
+    if booking is not False:
+        schedule.add(booking)
+    return booking
+
+#Moves a booking's start or end to now, journaling the change if it cannot be sent yet
+async def change_booking_time(booking, start_or_end_time):
+    updated_booking = None
+    if can_send_now():
+        updated_booking = await update_booking(booking.id, OAUTH_TOKEN, start_or_end_time)
+
+    if updated_booking is None:
+        print("Cobot API unreachable, booking will be updated once it is back\n")
+        journal.add_update(booking.id, start_or_end_time)
+        now = epoch_time.start_of_minute(utime.time())
+        if start_or_end_time == "start_time":
+            updated_booking = booking.with_times(now, booking.end)
+        else:
+            updated_booking = booking.with_times(booking.start, now)
+
+    if updated_booking is not False:
+        schedule.update(updated_booking)
+    return updated_booking
+
+#Deletes a booking, journaling the deletion if it cannot be sent yet. Returns False if the API rejected it.
+async def remove_booking(booking):
+    deleted = None
+    if can_send_now():
+        deleted = await delete_booking(booking.id, OAUTH_TOKEN)
+
+    if deleted is None:
+        print("Cobot API unreachable, booking will be deleted once it is back\n")
+        journal.add_delete(booking.id)
+    schedule.remove(booking.id)
+    return deleted
+
+#Right after boot, a badge the membership cache doesn't know waits a while for the API to come up
+async def wait_for_network_if_needed(uid):
+    if network_ready.is_set() or membership_cache.get(get_checkin_token_from_badge(uid)) is not None:
+        return
+    try:
+        await asyncio.wait_for(network_ready.wait(), STARTUP_BADGE_WAIT_S)
+    except asyncio.TimeoutError:
+        pass
+
+#Resolves queued badges against the Cobot API and updates the booking state
+async def badge_task():
+    await clock_ready.wait()
+    while True:
+        await badge_flag.wait()
+
+        uid = badge_queue.get()
+        while uid is not None:
+            await wait_for_network_if_needed(uid)
+            started = metrics.start()
+            with cobot_api.budget(BADGE_BUDGET_MS):
+                await handle_badge(uid)
+            metrics.stop(metrics.BADGE, started)
+            uid = badge_queue.get()
+
+        #Collect and save now, while nobody is waiting on the device, instead of in the middle of the next swipe
+        membership_cache.save_if_changed()
+        metrics.collect()
+
+#Outcomes are decided from the membership cache and the local schedule, and the member gets feedback straight
+#away. The API call that makes it real follows, and signal_correction() tells them if Cobot turns it down.
+#Only looking up a member the cache doesn't know happens before that; a refresh or replay underway never holds
+#booking_lock while it waits on the API, so it doesn't hold the feedback up.
+async def handle_badge(uid):
+    global current_booking, is_user_checked_in_to_booking
+    global onsite_booking_creation_time, is_resource_available
+
+    user_checkin_token = get_checkin_token_from_badge(uid)
+    membership_id = await get_membership_id(user_checkin_token, OAUTH_TOKEN, membership_cache)
+
+    async with booking_lock:
+        if membership_id == "":
+            print("Membership ID is invalid, cannot book resource\n")
+            queue_song(error_song)
+        else:
+            #if is_resource_available:
+            #The booking is fitted in before the next one from the local schedule, so it isn't turned down for a conflict
+            booking_times = get_booking_times(schedule, utime.time()) if current_booking is None else None
+            if current_booking is None and booking_times is None:
+                print("Resource is booked again in less than {} minutes, too soon for an on-site booking\n".format(BOOKING_MINIMUM_S // 60))
+                queue_song(error_song)
+            elif current_booking is None:
+                print("User is checked in for the booking they are creating\n")
+                queue_song(success_song)
+                show_leds(led_checked_in)
+                current_booking = expected_booking(membership_id, booking_times)
+                is_user_checked_in_to_booking = True
+                onsite_booking_creation_time = utime.time()
+                is_resource_available = False
+
+                booking = await make_booking(membership_id, booking_times)
+
+                if booking is False:
+                    print("Booking creation failed\n")
+                    current_booking = None
+                    is_user_checked_in_to_booking = False
+                    signal_correction(PENDING_BOOKING_ID)
+                else:
+                    current_booking = booking
+            else:
+                print("Resource is currently booked\n")
+
+                if membership_id == current_booking.membership_id:
+                    print("User who swiped badge has the current booking\n")
+
+                    if is_user_checked_in_to_booking == False:
+                        print("User is now checked in for their booking\n")
+                        queue_song(success_song)
+                        is_user_checked_in_to_booking = True
+                        show_leds(led_checked_in)
+
+                        if(utime.time() - current_booking.start) > TIMER_S:
+                            updated_booking = await change_booking_time(current_booking, "start_time")
+                            if updated_booking is False:
+                                signal_correction(current_booking.id)
                             else:
-                                print("User was already checked in for their booking, booking will be updated or deleted\n")
-                                update_or_delete_booking(current_booking["id"], OAUTH_TOKEN, onsite_booking_creation_time, TIMER_S)
-                                current_booking = {}
-                                is_user_checked_in_to_booking = False
-                                
-                                #TODO: Show something to confirm the user has ended their booking
+                                current_booking = updated_booking
+                    else:
+                        print("User was already checked in for their booking, booking will be updated or deleted\n")
+                        booking = current_booking
+                        queue_song(checkout_song)
+                        current_booking = None
+                        is_user_checked_in_to_booking = False
+
+                        if (utime.time() - onsite_booking_creation_time) < TIMER_S:
+                            if await remove_booking(booking) is False:
+                                signal_correction(booking.id)
                         else:
-                            print("This member ID does not match the member ID of the current booking\n")
+                            updated_booking = await change_booking_time(booking, "end_time")
+                            if updated_booking is False:
+                                schedule.remove(booking.id)
+                                signal_correction(booking.id)
+                else:
+                    print("This member ID does not match the member ID of the current booking\n")
+        update_status()
 
-                previous_card = uid
-        utime.sleep_ms(50)
+#Sets the clock from NTP. A clock that kept running through the reset is good enough if NTP doesn't answer, but an
+#unset one is retried with backoff for as long as it takes: badges and the API both need the right time.
+async def sync_clock():
+    retry_s = 1
+    while not set_time_to_UTC():
+        if clock_ready.is_set():
+            return
+        await asyncio.sleep(retry_s)
+        retry_s = min(retry_s * 2, NTP_RETRY_MAX_S)
 
+    if not clock_ready.is_set():
+        #The restored state is enough for the LEDs, the API can confirm it afterwards
+        clock_ready.set()
+        async with booking_lock:
+            update_status()
+
+#Brings the network up behind the UI: WiFi, then the clock, then the API token, then a sync that reconciles the
+#restored state with Cobot and sends anything journaled in the meantime
+async def start_network(wlan):
+    global OAUTH_TOKEN, is_resource_available
+
+    await connect_to_wifi(wlan)
+    startup_reached("wifi")
+
+    await sync_clock()
+    startup_reached("clock")
+
+    if not OAUTH_TOKEN:
+        OAUTH_TOKEN = await configure_device()
+
+    async with sync_lock:
+        network_ready.set()
+        with cobot_api.budget(SYNC_BUDGET_MS):
+            await refresh_schedule()
+    async with booking_lock:
+        update_status()
+        is_resource_available = get_resource_availability(schedule, utime.time())
+    startup_reached("synced")
+
+async def push_task():
+    await network_ready.wait()
+    await push_channel.run(OAUTH_TOKEN)
+
+async def main():
+    global OAUTH_TOKEN
+
+    #The radio associates while everything the UI needs comes off flash
+    wlan = start_wifi()
+    membership_cache.load()
+    journal.load()
+    restore_state()
+    if file_or_dir_exists("token.txt"):
+        OAUTH_TOKEN = await configure_device()
+    startup_reached("restored")
+
+    ##### BEGINNING OF INTERACTABLE PROGRAM #####
+
+    start_ui_core()
+    print("RFID reader active\n")
+    if clock_is_set():
+        clock_ready.set()
+        update_status()
+    startup_reached("ui_ready")
+
+    tasks = [start_network(wlan), wakeup_task(), badge_task(), flash_log.log.flush_task()]
+    if push_channel is not None:
+        tasks.append(push_task())
+    if METRICS_PORT:
+        tasks.append(metrics.serve(METRICS_PORT, secrets.RESOURCE_ID))
+    await asyncio.gather(*tasks)
+
+try:
+    asyncio.run(main())
 except KeyboardInterrupt:
     pass
-
+finally:
+    stop_ui_core()
+    flash_log.flush()
+    asyncio.new_event_loop()
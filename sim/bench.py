@@ -0,0 +1,278 @@
+#Badge-to-feedback latency benchmark. Runs scripted swipes through the simulated device, times each phase of
+#every swipe, and writes p50/p95/p99 per phase and API calls (HTTP requests sent) per swipe as JSON, e.g.
+#   python sim/bench.py --runs 20 --output bench.json
+#   python sim/bench.py --runs 20 --compare bench.json     exits 1 if a phase got slower than --threshold
+#
+#Phases of a swipe:
+#   read        reader.SelectTagSN for the first read of the held card
+#   queue       read finished -> badge_task picks the badge up
+#   token       get_checkin_token_from_badge
+#   membership  get_membership_id
+#   booking     create_booking / update_booking / delete_booking, all calls made for the swipe
+#   feedback    last API call finished -> result song starts playing or status LEDs change
+#   total       read started -> result song starts playing or status LEDs change
+#Times are host times, so compare results from the same machine; API call counts are exact and include every
+#retry and every request resent after a stale connection.
+
+import sys
+import json
+import time
+import argparse
+import functools
+import subprocess
+
+import sim_control
+from harness import run_device, at, RESOURCE_ID
+from scenarios import add_members, MEMBER_UID, MEMBER_ID
+
+PHASES = ("read", "queue", "token", "membership", "booking", "feedback", "total")
+BOOKING_CALLS = ("create_booking", "update_booking", "delete_booking")
+CARD_READ_FREQUENCY = 784 #First tone of main.card_read_song, which only acknowledges the read
+
+##### INSTRUMENTATION #####
+
+def now_ms():
+    return sim_control.elapsed_s() * 1000
+
+def timed(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = now_ms()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sim_control.record("phase", (name, start, now_ms()))
+    return wrapper
+
+def timed_async(name, fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = now_ms()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            sim_control.record("phase", (name, start, now_ms()))
+    return wrapper
+
+#Wraps the device functions each phase is made of; main.py imports them afterwards and gets the wrapped ones
+def instrument():
+    import mfrc522
+    import api_client
+    import helper_functions
+
+    mfrc522.MFRC522.SelectTagSN = timed("read", mfrc522.MFRC522.SelectTagSN)
+    api_client.ApiClient.request = timed_async("api", api_client.ApiClient.request)
+    api_client.ApiClient.exchange = timed_async("http", api_client.ApiClient.exchange)
+    helper_functions.get_checkin_token_from_badge = timed("token", helper_functions.get_checkin_token_from_badge)
+    helper_functions.get_membership_id = timed_async("membership", helper_functions.get_membership_id)
+    for name in BOOKING_CALLS:
+        setattr(helper_functions, name, timed_async("booking", getattr(helper_functions, name)))
+
+    update = helper_functions.SongPlayer.update
+    def recorded_update(player, now_ms):
+        song = player.song
+        update(player, now_ms)
+        if player.song is not song and player.song and player.song[0] != CARD_READ_FREQUENCY:
+            sim_control.record("feedback", "song")
+    helper_functions.SongPlayer.update = recorded_update
+
+    set_led_lights = helper_functions.set_led_lights
+    def recorded_set_led_lights(new_status, last_status):
+        if new_status != last_status:
+            sim_control.record("feedback", "led")
+        return set_led_lights(new_status, last_status)
+    helper_functions.set_led_lights = recorded_set_led_lights
+
+##### SCENARIOS #####
+
+#Swipes start this long after boot, once the first schedule sync is done
+FIRST_SWIPE_S = 1.0
+SWIPE_GAP_S = 1.0
+
+def walk_up(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=FIRST_SWIPE_S)
+
+def prebooked_check_in(api, control):
+    add_members(api)
+    now = time.time()
+    api.add_booking(RESOURCE_ID, MEMBER_ID, now - 600, now + 1800)
+    control.hold_card(MEMBER_UID, at_s=FIRST_SWIPE_S)
+
+#Books on-site, then ends the booking once the undo window has passed
+def early_end(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=FIRST_SWIPE_S)
+    control.hold_card(MEMBER_UID, at_s=FIRST_SWIPE_S + SWIPE_GAP_S)
+    def ten_minutes_pass():
+        control.set_clock(control.now() + 600)
+    at(control, FIRST_SWIPE_S + SWIPE_GAP_S / 2, ten_minutes_pass)
+
+def undo(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=FIRST_SWIPE_S)
+    control.hold_card(MEMBER_UID, at_s=FIRST_SWIPE_S + SWIPE_GAP_S)
+
+def api_slow(api, control):
+    walk_up(api, control)
+    def api_slows_down():
+        api.latency_ms = 400
+    at(control, FIRST_SWIPE_S / 2, api_slows_down)
+
+def api_down(api, control):
+    walk_up(api, control)
+    def api_goes_down():
+        api.down = True
+    at(control, FIRST_SWIPE_S / 2, api_goes_down)
+
+#name: (setup, duration in seconds)
+BENCHMARKS = {
+    "walk_up": (walk_up, 2.5),
+    "prebooked_check_in": (prebooked_check_in, 2.5),
+    "early_end": (early_end, 3.5),
+    "undo": (undo, 3.5),
+    "api_slow": (api_slow, 3.5),
+    "api_down": (api_down, 2.5),
+}
+
+##### ANALYSIS #####
+
+def during(events, start, end):
+    return [event for event in events if start <= event[0] < end]
+
+#Splits a run's trace into swipes, one per scripted card hold, and times each phase
+def measure_swipes(result, card_script):
+    phases = [detail for t, detail in result.events("phase")]
+    feedback = result.events("feedback")
+    swipes = []
+
+    hold_starts_ms = [start * 1000 for start, end, uid in card_script] + [float("inf")]
+    for i in range(len(card_script)):
+        window = (hold_starts_ms[i], hold_starts_ms[i + 1])
+        calls = {}
+        for name, start, end in phases:
+            if window[0] <= start < window[1]:
+                calls.setdefault(name, []).append((start, end))
+        if "read" not in calls or "token" not in calls:
+            continue #The swipe was never picked up, e.g. the run ended first
+
+        read_start, read_end = calls["read"][0]
+        token_start, token_end = calls["token"][0]
+        last_call_end = max(end for name in ("token", "membership", "booking", "api") for start, end in calls.get(name, []))
+        feedback_times = [t for t, detail in during(feedback, token_start, window[1])]
+
+        swipe = {
+            "read": read_end - read_start,
+            "queue": token_start - read_end,
+            "token": token_end - token_start,
+            "membership": sum(end - start for start, end in calls.get("membership", [])),
+            "booking": sum(end - start for start, end in calls.get("booking", [])),
+            "api_calls": len(calls.get("http", [])),
+        }
+        if feedback_times:
+            swipe["feedback"] = max(0.0, feedback_times[0] - last_call_end)
+            swipe["total"] = feedback_times[0] - read_start
+        swipes.append(swipe)
+    return swipes
+
+#Nearest-rank percentile
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "n": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(max(values), 3),
+    }
+
+def run_benchmark(name, runs):
+    setup, duration_s = BENCHMARKS[name]
+    swipes = []
+    endpoints = {}
+    for i in range(runs):
+        result = run_device(setup, duration_s, name=name, before_boot=instrument)
+        swipes += measure_swipes(result, sorted(sim_control.card_script))
+        for method, path, status in result.api.requests:
+            endpoint = "{} /{}".format(method, path.split("?", 1)[0].strip("/").split("/")[1])
+            endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+
+    api_calls = [swipe["api_calls"] for swipe in swipes]
+    return {
+        "runs": runs,
+        "swipes": len(swipes),
+        "phases_ms": {phase: summarize([swipe[phase] for swipe in swipes if phase in swipe]) for phase in PHASES},
+        "api_calls_per_swipe": {
+            "mean": round(sum(api_calls) / len(api_calls), 3) if api_calls else None,
+            "max": max(api_calls) if api_calls else None,
+        },
+        "api_requests_by_endpoint": endpoints,
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+#Returns a line per phase whose p95 grew more than threshold (a fraction) and at least min_ms over the baseline,
+#or whose API calls per swipe grew at all
+def find_regressions(baseline, results, threshold, min_ms):
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if before is None:
+            continue
+        for phase, stats in result["phases_ms"].items():
+            old = before["phases_ms"].get(phase)
+            if stats is None or old is None:
+                continue
+            if stats["p95"] > old["p95"] * (1 + threshold) and stats["p95"] - old["p95"] >= min_ms:
+                regressions.append("{} {}: p95 {} ms -> {} ms".format(name, phase, old["p95"], stats["p95"]))
+        old_calls = before["api_calls_per_swipe"]["mean"]
+        new_calls = result["api_calls_per_swipe"]["mean"]
+        if old_calls is not None and new_calls is not None and new_calls > old_calls:
+            regressions.append("{} API calls per swipe: {} -> {}".format(name, old_calls, new_calls))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Badge-to-feedback latency benchmark")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--runs", type=int, default=10, help="device runs per benchmark")
+    parser.add_argument("--output", help="write results as JSON to this file instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed p95 growth as a fraction")
+    parser.add_argument("--min-ms", type=float, default=5.0, help="ignore p95 growth smaller than this")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}, choose from {}".format(name, ", ".join(BENCHMARKS)))
+
+    results = {"version": 1, "revision": git_revision(), "python": sys.version.split()[0], "benchmarks": {}}
+    for name in args.benchmarks or list(BENCHMARKS):
+        print("Running {} ({} runs)".format(name, args.runs), file=sys.stderr)
+        results["benchmarks"][name] = run_benchmark(name, args.runs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(json.load(f), results, args.threshold, args.min_ms)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#Local stand-in for the members.motionlab.berlin API, speaking just enough HTTP/1.1 (keep-alive, Content-Length,
+#conditional GETs) for the device's ApiClient. Latency, failures and outages can be changed while it runs.
+
+import json
+import asyncio
+import hashlib
+import threading
+import itertools
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S %z"
+
+def parse_time(time_string):
+    return datetime.strptime(time_string, TIME_FORMAT).timestamp()
+
+def format_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(TIME_FORMAT)
+
+#Check-in token for a 7-byte badge UID, the way helper_functions.get_checkin_token_from_badge derives it
+def checkin_token(uid):
+    return str(int(hex(int.from_bytes(bytes(uid), "little"))[8:], 16))
+
+class FakeCobot:
+    def __init__(self):
+        self.latency_ms = 0 #Added before every response
+        self.failure_rate = 0.0 #Share of requests answered with 503, decided by a fixed pseudo-random sequence
+        self.down = False #Drop connections without answering, like an unreachable API
+        self.hanging = False #Take requests but never answer them, like an API stuck behind a dead proxy
+        self.answers_lost = None #Method, e.g. "POST", whose requests are carried out but never answered
+        self.send_etags = True
+        self.webhook_url = None #Posted {"url": ...} on every booking change, like Cobot's booking webhooks
+
+        self.members = {} #check-in token -> membership id
+        self.bookings = {} #booking id -> booking dict
+        self.booking_ids = itertools.count(1000)
+        self.failure_sequence = itertools.cycle([(i * 37) % 100 for i in range(100)])
+
+        self.requests = [] #(method, path, status) for every request answered
+        self.connections = 0
+        self.writers = set()
+        self.loop = None
+        self.server = None
+        self.port = None
+        self.thread = None
+
+    ##### STATE #####
+
+    def add_member(self, uid, membership_id):
+        self.members[checkin_token(uid)] = membership_id
+
+    def add_booking(self, resource_id, membership_id, start, end, title="Online booking"):
+        booking_id = "b{}".format(next(self.booking_ids))
+        self.bookings[booking_id] = {
+            "id": booking_id,
+            "resource_id": resource_id,
+            "membership_id": membership_id,
+            "from": format_time(start),
+            "to": format_time(end),
+            "title": title,
+            "comments": "",
+            "can_change": True,
+        }
+        self.booking_changed(booking_id)
+        return booking_id
+
+    #Posts the change to webhook_url from the server's loop; safe to call from any thread
+    def booking_changed(self, booking_id):
+        if self.webhook_url is None or self.loop is None:
+            return
+        body = json.dumps({"url": "https://sim.cobot.me/api/bookings/" + booking_id}).encode()
+
+        async def post():
+            url = urlsplit(self.webhook_url)
+            path = url.path + ("?" + url.query if url.query else "")
+            try:
+                reader, writer = await asyncio.open_connection(url.hostname, url.port)
+                head = "POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                writer.write(head.format(path, url.hostname, len(body)).encode() + body)
+                await writer.drain()
+                await reader.read()
+                writer.close()
+            except OSError:
+                pass #Cobot doesn't retry failed webhooks either
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(post()))
+
+    #Carries members and bookings over from the API of an earlier run, for a device rebooting into the same day
+    def take_over(self, other):
+        self.members = dict(other.members)
+        self.bookings = {booking_id: dict(booking) for booking_id, booking in other.bookings.items()}
+        self.booking_ids = itertools.count(next(other.booking_ids))
+
+    def count_requests(self, method=None, path_prefix=""):
+        return sum(1 for request_method, path, status in self.requests
+                   if (method is None or request_method == method) and path.startswith(path_prefix))
+
+    ##### ROUTES #####
+
+    def bookings_in_range(self, resource_id, data):
+        range_start = parse_time(data["from"]) if "from" in data else float("-inf")
+        range_end = parse_time(data["to"]) if "to" in data else float("inf")
+        found = [booking for booking in self.bookings.values()
+                 if resource_id is None or booking["resource_id"] == resource_id
+                 and parse_time(booking["from"]) < range_end
+                 and parse_time(booking["to"]) > range_start]
+        return sorted(found, key=lambda booking: parse_time(booking["from"]))
+
+    def overlaps_other(self, resource_id, start, end, booking_id=None):
+        return any(booking["resource_id"] == resource_id
+                   and booking["id"] != booking_id
+                   and parse_time(booking["from"]) < end
+                   and parse_time(booking["to"]) > start
+                   for booking in self.bookings.values())
+
+    def handle(self, method, path, data):
+        parts = [part for part in path.split("?", 1)[0].split("/") if part]
+        if parts[:1] == ["api"]:
+            parts = parts[1:]
+
+        if method == "GET" and len(parts) == 2 and parts[0] == "check_in_tokens":
+            if parts[1] not in self.members:
+                return 404, {"error": "not found"}
+            return 200, {"id": parts[1], "membership": {"id": self.members[parts[1]], "name": "Simulated Member"}}
+
+        if len(parts) == 3 and parts[0] == "resources" and parts[2] == "bookings":
+            if method == "GET":
+                return 200, self.bookings_in_range(parts[1], data or {})
+            if method == "POST":
+                start, end = parse_time(data["from"]), parse_time(data["to"])
+                if end <= start or self.overlaps_other(parts[1], start, end):
+                    return 422, {"errors": {"from": ["resource is already booked"]}}
+                booking_id = self.add_booking(parts[1], data["membership_id"], start, end, data.get("title", ""))
+                return 201, self.bookings[booking_id]
+
+        #Space-wide list, which the fleet gateway fetches in place of one list per resource
+        if method == "GET" and parts == ["bookings"]:
+            return 200, self.bookings_in_range(None, data or {})
+
+        if len(parts) == 2 and parts[0] == "bookings":
+            booking = self.bookings.get(parts[1])
+            if booking is None:
+                return 404, {"error": "not found"}
+            if method == "GET":
+                return 200, booking
+            if method == "PUT":
+                start = parse_time(data.get("from", booking["from"]))
+                end = parse_time(data.get("to", booking["to"]))
+                if end < start or self.overlaps_other(booking["resource_id"], start, end, booking["id"]):
+                    return 422, {"errors": {"to": ["invalid booking time"]}}
+                booking["from"], booking["to"] = format_time(start), format_time(end)
+                self.booking_changed(booking["id"])
+                return 200, booking
+            if method == "DELETE":
+                del self.bookings[parts[1]]
+                self.booking_changed(parts[1])
+                return 204, None
+
+        return 404, {"error": "no route"}
+
+    ##### HTTP #####
+
+    async def serve_connection(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if self.down:
+                    self.requests.append((method, path, None))
+                    break
+                if self.hanging:
+                    self.requests.append((method, path, None))
+                    await reader.read() #Until the client gives up on it
+                    break
+                if self.latency_ms:
+                    await asyncio.sleep(self.latency_ms / 1000)
+
+                if self.failure_rate and next(self.failure_sequence) < self.failure_rate * 100:
+                    status, payload = 503, {"error": "simulated failure"}
+                else:
+                    status, payload = self.handle(method, path, json.loads(body) if body else None)
+                if method == self.answers_lost:
+                    self.requests.append((method, path, None))
+                    await reader.read()
+                    break
+
+                content = json.dumps(payload).encode() if payload is not None else b""
+                response_headers = {"Content-Type": "application/json", "Content-Length": str(len(content))}
+                if status == 200 and method == "GET" and self.send_etags:
+                    etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+                    response_headers["ETag"] = etag
+                    if headers.get("if-none-match") == etag:
+                        status, content = 304, b""
+                        response_headers["Content-Length"] = "0"
+
+                self.requests.append((method, path, status))
+                reason = {200: "OK", 201: "Created", 204: "No Content", 304: "Not Modified"}.get(status, "Error")
+                head = "HTTP/1.1 {} {}\r\n".format(status, reason)
+                head += "".join("{}: {}\r\n".format(name, value) for name, value in response_headers.items())
+                writer.write(head.encode() + b"\r\n" + content)
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    #Starts the server on its own thread and event loop, so the device's loop only ever sees network latency
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.serve_connection, host, port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            self.server.close()
+            #Closing the sockets lets every connection handler see EOF and return on its own
+            for writer in list(self.writers):
+                writer.close()
+            self.loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self.loop), return_exceptions=True))
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return "http://{}:{}/api".format(host, self.port)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
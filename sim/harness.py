@@ -0,0 +1,150 @@
+#Runs the unmodified device code (main.py and lib/) under CPython, with the MicroPython modules replaced by the
+#shims in sim/shims and the Cobot API replaced by a local FakeCobot
+
+import os
+import sys
+import time
+import types
+import runpy
+import shutil
+import socket
+import asyncio
+import logging
+import tempfile
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SIM_DIR)
+SHIMS_DIR = os.path.join(SIM_DIR, "shims")
+LIB_DIR = os.path.join(REPO_DIR, "lib")
+GATEWAY_DIR = os.path.join(REPO_DIR, "gateway")
+
+sys.path[:0] = [p for p in (SHIMS_DIR, SIM_DIR, LIB_DIR) if p not in sys.path]
+
+import sim_control
+from fake_cobot import FakeCobot
+
+RESOURCE_ID = "sim-resource"
+ACCESS_TOKEN = "sim-access-token"
+GATEWAY_TOKEN = "sim-gateway-token"
+WEBHOOK_SECRET = "sim-webhook-secret"
+
+class SimResult:
+    def __init__(self, name, trace, counters, api, output, workdir_files, secrets, gateway=None):
+        self.name = name
+        self.trace = trace
+        self.counters = counters
+        self.api = api
+        self.output = output
+        self.files = workdir_files
+        self.secrets = secrets
+        self.gateway = gateway
+
+    def events(self, kind):
+        return [(t, detail) for t, event_kind, detail in self.trace if event_kind == kind]
+
+class Tee:
+    def __init__(self, stream, echo):
+        self.stream = stream
+        self.echo = echo
+        self.lines = []
+
+    def write(self, text):
+        self.lines.append(text)
+        if self.echo:
+            self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+#Runs main.py for duration_s seconds. setup(api, control) scripts the scenario before the device boots, and
+#before_boot(), if given, runs in the device's working directory just before main.py, e.g. to instrument modules.
+#Files left in the device's working directory (journal, caches, logs) are returned in result.files.
+def run_device(setup, duration_s, name="scenario", echo=False, keep_files=None, before_boot=None):
+    sim_control.reset()
+    sim_control.duration_s = duration_s
+    sim_control.set_clock(time.time())
+
+    api = FakeCobot()
+    base_url = api.start_in_thread()
+
+    workdir = tempfile.mkdtemp(prefix="motionlab-sim-")
+    with open(os.path.join(workdir, "token.txt"), "w") as token_file:
+        token_file.write(ACCESS_TOKEN)
+    for filename, content in (keep_files or {}).items():
+        with open(os.path.join(workdir, filename), "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+
+    secrets = types.ModuleType("secrets")
+    secrets.RESOURCE_ID = RESOURCE_ID
+    secrets.SSID = "sim-wlan"
+    secrets.SSID_PASSWORD = "sim-password"
+    secrets.API_BASE_URL = base_url
+    secrets.METRICS_PORT = free_port()
+    secrets.AVAILABILITY_STRIP_PIN = 16
+
+    setup(api, sim_control)
+
+    #The gateway runs on the fake API's event loop, and the fake sends it webhooks like Cobot would
+    gateway = None
+    if sim_control.use_gateway:
+        if GATEWAY_DIR not in sys.path:
+            sys.path.append(GATEWAY_DIR)
+        from gateway import Gateway
+        gateway = Gateway(base_url, GATEWAY_TOKEN, webhook_secret=WEBHOOK_SECRET)
+        gateway_port = asyncio.run_coroutine_threadsafe(gateway.start("127.0.0.1", 0), api.loop).result()
+        secrets.API_BASE_URL = "http://127.0.0.1:{}/api".format(gateway_port)
+        secrets.PUSH_UPDATES = True
+        api.webhook_url = "http://127.0.0.1:{}/webhooks/cobot?secret={}".format(gateway_port, WEBHOOK_SECRET)
+
+    #Every run starts the device from a cold boot, so modules loaded by the previous run are dropped
+    loaded_before = set(sys.modules)
+    saved_secrets = sys.modules.get("secrets")
+    sys.modules["secrets"] = secrets
+    saved_cwd = os.getcwd()
+    saved_stdout = sys.stdout
+    output = Tee(saved_stdout, echo)
+
+    os.chdir(workdir)
+    sys.stdout = output
+    try:
+        if before_boot is not None:
+            before_boot()
+        runpy.run_path(os.path.join(REPO_DIR, "main.py"), run_name="__main__")
+    finally:
+        sys.stdout = saved_stdout
+        os.chdir(saved_cwd)
+        for handler in logging.root.handlers[:]:
+            handler.close()
+            logging.root.removeHandler(handler)
+        for module_name in set(sys.modules) - loaded_before:
+            del sys.modules[module_name]
+        if saved_secrets is not None:
+            sys.modules["secrets"] = saved_secrets
+        else:
+            sys.modules.pop("secrets", None)
+        if gateway is not None:
+            asyncio.run_coroutine_threadsafe(gateway.stop(), api.loop).result(timeout=5)
+        api.stop()
+
+    files = {}
+    for filename in os.listdir(workdir):
+        with open(os.path.join(workdir, filename), "rb") as f:
+            data = f.read()
+        #Text files (token, caches, journal) as str, the binary flash log as bytes
+        files[filename] = data if filename.endswith(".bin") else data.decode()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return SimResult(name, list(sim_control.trace), dict(sim_control.counters), api, "".join(output.lines), files, secrets, gateway)
+
+#Schedules fn(api) to run `at_s` seconds into the run, for API changes in the middle of a scenario
+def at(control, at_s, fn):
+    async def timeline():
+        await asyncio.sleep(at_s)
+        control.record("scenario", fn.__name__)
+        fn()
+    control.background.append(timeline)
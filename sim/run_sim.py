@@ -0,0 +1,40 @@
+#Runs simulated walk-ups against the device code on the host, e.g.
+#   python sim/run_sim.py              run every scenario
+#   python sim/run_sim.py undo -v      run one, echoing the device's output and printing its trace
+
+import sys
+import argparse
+
+from scenarios import SCENARIOS, run_scenario
+
+def print_trace(result):
+    for t, kind, detail in result.trace:
+        print("{:>10.1f} ms  {:<10} {}".format(t, kind, "" if detail is None else detail))
+    print("API requests:")
+    for method, path, status in result.api.requests:
+        print("    {} {} -> {}".format(method, path.split("?", 1)[0], status))
+    print("API connections opened: {}".format(result.api.connections))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the booking companion against a fake Cobot API")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run (default: all)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="echo device output and print the trace")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario {}, choose from {}".format(name, ", ".join(SCENARIOS)))
+
+    failed = 0
+    for name in args.scenarios or list(SCENARIOS):
+        result, failures = run_scenario(name, echo=args.verbose)
+        if args.verbose:
+            print_trace(result)
+        print("{:<14} {}".format(name, "ok" if not failures else "FAILED"))
+        for failure in failures:
+            print("    " + failure)
+        failed += bool(failures)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+#Scripted walk-ups. Each scenario sets up the fake API and the badge swipes, runs the device, and checks what it
+#did from the API's point of view and from the trace of LEDs and buzzer tones.
+
+import sys
+import json
+import time
+import asyncio
+
+from harness import run_device, at, RESOURCE_ID
+
+MEMBER_UID = (0x04, 0x0F, 0x2C, 0x82, 0xDC, 0x72, 0x80)
+OTHER_UID = (0x04, 0x11, 0x22, 0x33, 0x44, 0x55, 0x66)
+UNKNOWN_UID = (0x04, 0x99, 0x88, 0x77, 0x66, 0x55, 0x44)
+MEMBER_ID = "member-1"
+OTHER_ID = "member-2"
+
+LED_CHECKED_IN = 22
+LED_BOOKED = 6
+LED_AVAILABLE = 11
+LED_ERROR = 20
+
+STRIP_BOOKED = (32, 0, 0)
+STRIP_FREE = (0, 32, 0)
+STRIP_OVER = (0, 0, 0)
+
+def add_members(api):
+    api.add_member(MEMBER_UID, MEMBER_ID)
+    api.add_member(OTHER_UID, OTHER_ID)
+
+def led_turned_on(result, pin):
+    return any(detail == (pin, 1) for t, detail in result.events("pin"))
+
+#Each check returns an error message, or None if the device behaved
+def expect(condition, message):
+    return None if condition else message
+
+def walk_up_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def walk_up_check(result):
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 1, "expected one booking to be created"),
+        expect(len(result.api.bookings) == 1, "expected the new booking to exist"),
+        expect(led_turned_on(result, LED_CHECKED_IN), "expected the checked-in LED"),
+    ]
+
+def prebooked_setup(api, control):
+    add_members(api)
+    now = time.time()
+    api.add_booking(RESOURCE_ID, MEMBER_ID, now - 600, now + 1800)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def prebooked_check(result):
+    booking = list(result.api.bookings.values())[0]
+    return [
+        expect(result.api.count_requests("PUT") == 1, "expected a late check-in to move the start time"),
+        expect(result.api.count_requests("POST", "/api/resources/") == 0, "expected no new booking"),
+        expect(booking["from"] != booking["to"], "expected the booking to keep running"),
+        expect(led_turned_on(result, LED_CHECKED_IN), "expected the checked-in LED"),
+    ]
+
+def undo_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+    control.hold_card(MEMBER_UID, at_s=2.5)
+
+def undo_check(result):
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 1, "expected one booking to be created"),
+        expect(result.api.count_requests("DELETE") == 1, "expected the second swipe to delete it"),
+        expect(len(result.api.bookings) == 0, "expected no bookings left"),
+    ]
+
+def someone_else_setup(api, control):
+    add_members(api)
+    now = time.time()
+    api.add_booking(RESOURCE_ID, OTHER_ID, now - 60, now + 1800)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def someone_else_check(result):
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 0, "expected no booking over someone else's"),
+        expect(result.api.count_requests("PUT") + result.api.count_requests("DELETE") == 0, "expected the booking untouched"),
+        expect(led_turned_on(result, LED_BOOKED), "expected the booked LEDs"),
+    ]
+
+def unknown_badge_setup(api, control):
+    add_members(api)
+    control.hold_card(UNKNOWN_UID, at_s=1.0)
+
+def unknown_badge_check(result):
+    return [
+        expect(result.api.count_requests("GET", "/api/check_in_tokens/") == 1, "expected one membership lookup"),
+        expect(len(result.api.bookings) == 0, "expected no booking for an unknown badge"),
+    ]
+
+#A booking made before boot comes up a couple of seconds into the run (API times are whole seconds and the device
+#clock ticks in seconds, so give or take two); the LEDs follow without another API call
+def booking_starts_setup(api, control):
+    add_members(api)
+    now = time.time()
+    api.add_booking(RESOURCE_ID, OTHER_ID, now + 62, now + 1800)
+
+def booking_starts_check(result):
+    booked_at = [t for t, detail in result.events("pin") if detail == (LED_BOOKED, 1)]
+    return [
+        expect(booked_at and 1500 <= booked_at[0] <= 4500, "expected the booked LEDs a minute before the start"),
+        expect(result.api.count_requests("GET", "/api/resources/") == 1, "expected no schedule polling"),
+    ]
+
+#Nobody comes near the reader: it should only be initialised at boot and polled at the normal rate or slower
+def idle_reader_setup(api, control):
+    add_members(api)
+
+def idle_reader_check(result):
+    return [
+        expect(result.counters.get("rfid_init", 0) <= 1, "expected no reader re-initialisation while idle"),
+        expect(result.counters.get("rfid_request", 0) <= 3000 / 50 + 5, "expected no faster than normal polling"),
+    ]
+
+#The member books, someone else is turned away, and the member checks out from the cache: the saved cache must
+#list the member as most recently used, so a reboot doesn't evict them first
+def cache_order_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+    control.hold_card(OTHER_UID, at_s=2.0)
+    control.hold_card(MEMBER_UID, at_s=3.0)
+
+def cache_order_check(result):
+    saved = json.loads(result.files.get("membership_cache.json", "{}"))
+    entries = saved.get("entries", [])
+    return [
+        expect(len(entries) == 2, "expected both members to be cached"),
+        expect(entries and entries[-1][1] == MEMBER_ID, "expected the member's cache hit to be saved as the latest use"),
+    ]
+
+#Someone books online after the device's last sync, so the walk-up booking it already signalled is rejected
+def rejected_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+    def booked_online():
+        now = time.time()
+        api.add_booking(RESOURCE_ID, OTHER_ID, now - 60, now + 1800)
+    at(control, 0.8, booked_online)
+
+def rejected_check(result):
+    tones = [detail for t, detail in result.events("tone")]
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 1, "expected the booking to be attempted"),
+        expect(tones[1:2] == [440], "expected the success song to cut the read beep short"),
+        expect(led_turned_on(result, LED_ERROR), "expected led_error after the rejection"),
+        expect(tones[-6:] == [698, 175, 698, 175, 698, 175], "expected the correction song last"),
+    ]
+
+#The member books online, the API drops out, and the undo swipe is journaled and sent once it returns
+def offline_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+    control.hold_card(MEMBER_UID, at_s=3.0)
+
+    def api_goes_down():
+        api.down = True
+    def api_comes_back():
+        api.down = False
+    at(control, 2.0, api_goes_down)
+    at(control, 5.0, api_comes_back)
+
+def offline_check(result):
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 1, "expected one booking to be created"),
+        expect(len(result.api.bookings) == 0, "expected the journaled delete to be replayed"),
+        expect("op_journal.log" not in result.files, "expected the journal to be empty after replay"),
+    ]
+
+#The walk-up booking is made but its answer never arrives. The device doesn't know whether it exists, so once the
+#API answers again it finds the booking instead of creating it a second time.
+def answer_lost_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+    def answers_get_lost():
+        api.answers_lost = "POST"
+    def answers_come_back():
+        api.answers_lost = None
+    at(control, 0.9, answers_get_lost)
+    at(control, 6.0, answers_come_back)
+
+def answer_lost_check(result):
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 1, "expected the create to be sent once"),
+        expect(len(result.api.bookings) == 1, "expected a single booking"),
+        expect("op_journal.log" not in result.files, "expected the journal to be empty after the booking was found"),
+        expect(not led_turned_on(result, LED_ERROR), "expected no correction"),
+    ]
+
+#Reboots after undo with the API down, so the walk-up booking is journaled. The member checks out while the replayed
+#create is still waiting for its answer, and the resource is free again once the delete behind it is replayed.
+def slow_replay_setup(api, control):
+    api.down = True
+    control.hold_card(MEMBER_UID, at_s=1.0)
+    control.hold_card(MEMBER_UID, at_s=32.0)
+
+    def api_comes_back_slow():
+        api.down = False
+        api.latency_ms = 2000
+    at(control, 20.0, api_comes_back_slow)
+
+def slow_replay_check(result):
+    pins_on = [detail[0] for t, detail in result.events("pin") if detail[1] == 1]
+    return [
+        expect([status for method, path, status in result.api.requests if method == "POST"].count(201) == 1, "expected the booking to be created once"),
+        expect(result.api.count_requests("DELETE") == 1, "expected the checkout to be replayed as a delete"),
+        expect(len(result.api.bookings) == 0, "expected no bookings left"),
+        expect(pins_on and pins_on[-1] == LED_AVAILABLE, "expected the resource to be shown as available at the end"),
+        expect("op_journal.log" not in result.files, "expected the journal to be empty after replay"),
+    ]
+
+#Fetches the metrics endpoint from inside the run, after a swipe
+def metrics_setup(api, control):
+    add_members(api)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+    async def fetch_metrics():
+        await asyncio.sleep(2.0)
+        port = sys.modules["secrets"].METRICS_PORT
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: device\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        control.record("metrics", json.loads(response.split(b"\r\n\r\n", 1)[1]))
+    control.background.append(fetch_metrics)
+
+def metrics_check(result):
+    fetched = result.events("metrics")
+    events = fetched[0][1]["events"] if fetched else {}
+    return [
+        expect(fetched, "expected the metrics endpoint to answer"),
+        expect(events.get("rfid_poll", {}).get("count", 0) > 0, "expected RFID polls to be traced"),
+        expect(events.get("api_call", {}).get("count", 0) >= 3, "expected the sync, lookup and booking calls to be traced"),
+        expect(events.get("badge", {}).get("count", 0) == 1, "expected one badge to be traced"),
+        expect(fetched and fetched[0][1].get("api", {}).get("breaker") == "closed", "expected the API breaker state to be served"),
+    ]
+
+#Reboots after walk_up, with the RTC still running and WiFi slow to come back: the member who just booked is
+#shown as checked in and can end the booking before the network is up
+def warm_boot_setup(api, control):
+    control.WIFI_CONNECT_S = 2.0
+    control.hold_card(MEMBER_UID, at_s=0.5)
+
+def warm_boot_check(result):
+    pins_on = [t for t, detail in result.events("pin") if detail == (LED_CHECKED_IN, 1)]
+    checkout_at = [t for t, detail in result.events("tone") if detail == 698]
+    return [
+        expect(pins_on and pins_on[0] < 500, "expected the checked-in LED straight after boot"),
+        expect(checkout_at and checkout_at[0] < 2000, "expected the checkout song before WiFi was up"),
+        expect(result.api.count_requests("DELETE") == 1, "expected the booking to be deleted once the API was up"),
+        expect(len(result.api.bookings) == 0, "expected no bookings left"),
+    ]
+
+#Reboots after walk_up into a slow API: the member ends their booking while the first sync is still waiting for its
+#answer, and hears the checkout song straight away instead of after the sync
+def slow_sync_setup(api, control):
+    api.latency_ms = 1500
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def slow_sync_check(result):
+    checkout_at = [t for t, detail in result.events("tone") if detail == 698]
+    return [
+        expect(checkout_at and checkout_at[0] < 1300, "expected the checkout song before the sync was answered"),
+        expect(result.api.count_requests("DELETE") == 1, "expected the booking to be deleted"),
+        expect(len(result.api.bookings) == 0, "expected no bookings left"),
+    ]
+
+#Reboots after prebooked from a power cut, so the clock is wrong until NTP, and the API is unreachable: the LEDs
+#come from the saved state once the clock is set
+def cold_boot_setup(api, control):
+    control.clock_set = False
+    api.down = True
+
+def cold_boot_check(result):
+    pins_on = [(t, detail[0]) for t, detail in result.events("pin") if detail[1] == 1]
+    return [
+        expect(pins_on and pins_on[0][0] >= 200, "expected no LEDs before the clock was set"),
+        expect(led_turned_on(result, LED_CHECKED_IN), "expected the checked-in LED from the saved state"),
+        expect(not led_turned_on(result, LED_AVAILABLE), "expected the resource never to be shown as available"),
+    ]
+
+#Through the gateway, someone books online and the device hears of it from the push channel instead of polling
+def push_update_setup(api, control):
+    add_members(api)
+    control.use_gateway = True
+
+    def booked_online():
+        now = time.time()
+        api.add_booking(RESOURCE_ID, OTHER_ID, now - 60, now + 1800)
+    at(control, 1.5, booked_online)
+
+def push_update_check(result):
+    booked_at = [t for t, detail in result.events("pin") if detail == (LED_BOOKED, 1)]
+    stats = result.gateway.stats.counts
+    return [
+        expect(booked_at and booked_at[0] < 2500, "expected the booked LED within a second of the online booking"),
+        expect(stats.get("webhooks", 0) == 1, "expected the gateway to get the webhook"),
+        expect(stats.get("pushed", 0) >= 1, "expected the change to be pushed to the device"),
+        #At most one refresh as the channel connects (none if the first sync covers it) and one for the push
+        expect(1 <= result.output.count("Refreshing schedule") <= 2, "expected refreshes only when pushed"),
+    ]
+
+#At 09:10 UTC with a booking from 10:00 to 11:00, a walk-up booking fills the strip's 09:00 and 09:30 slots
+def strip_setup(api, control):
+    add_members(api)
+    day_start = time.time() // 86400 * 86400
+    control.set_clock(day_start + 9 * 3600 + 600)
+    api.add_booking(RESOURCE_ID, OTHER_ID, day_start + 10 * 3600, day_start + 11 * 3600)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def strip_check(result):
+    writes = [detail for t, detail in result.events("strip")]
+    before = [STRIP_OVER] * 6 + [STRIP_FREE] * 2 + [STRIP_BOOKED] * 2 + [STRIP_FREE] * 20
+    after = [STRIP_OVER] * 6 + [STRIP_BOOKED] * 4 + [STRIP_FREE] * 20
+    return [
+        expect(tuple(before) in writes, "expected the strip to show the online booking after the first sync"),
+        expect(writes and list(writes[-1]) == after, "expected the walk-up booking on the strip"),
+        expect(len(writes) <= 3, "expected the strip to be written only when it changed"),
+    ]
+
+#The API stops answering after the first sync. Every swipe gets its answer within the latency budget, and after
+#three failed lookups the breaker opens, led_error comes on and the next swipe is answered without asking the API.
+def api_hangs_setup(api, control):
+    add_members(api)
+    for at_s in (1.0, 6.0, 11.0, 16.0):
+        control.hold_card(MEMBER_UID, at_s=at_s)
+
+    def api_hangs():
+        api.hanging = True
+    at(control, 0.5, api_hangs)
+
+def api_hangs_check(result):
+    error_songs = [t for t, detail in result.events("tone") if detail == 196]
+    return [
+        expect(len(error_songs) == 4, "expected every swipe to be answered with the error song"),
+        expect(all(t - swipe_ms < 5000 for t, swipe_ms in zip(error_songs, (1000, 6000, 11000, 16000))), "expected answers within the budget"),
+        expect(error_songs[3:] and error_songs[3] - 16000 < 500, "expected the swipe after the breaker opened to be answered straight away"),
+        expect(led_turned_on(result, LED_ERROR), "expected led_error while the API is unavailable"),
+        expect(result.api.count_requests("GET", "/api/check_in_tokens/") == 3, "expected no lookups sent while the breaker was open"),
+    ]
+
+#Half the API's answers are 503s, and retries still get the schedule and the member's lookup through
+def flaky_setup(api, control):
+    add_members(api)
+    api.failure_rate = 0.5
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def flaky_check(result):
+    statuses = [status for method, path, status in result.api.requests if method == "GET"]
+    return [
+        expect(503 in statuses, "expected some requests to fail"),
+        expect("Schedule synced" in result.output, "expected the first sync to get through"),
+        expect("Associated membership id" in result.output, "expected the lookup to get through"),
+        expect(any(detail == 440 for t, detail in result.events("tone")), "expected the success song"),
+    ]
+
+#Someone has the resource booked from 15 minutes from now, so the walk-up booking is made to end then
+def fit_before_setup(api, control):
+    add_members(api)
+    start = time.time() // 60 * 60 + 15 * 60
+    api.add_booking(RESOURCE_ID, OTHER_ID, start, start + 3600)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def fit_before_check(result):
+    bookings = sorted(result.api.bookings.values(), key=lambda booking: booking["from"])
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 1, "expected a single create request"),
+        expect(len(bookings) == 2 and bookings[0]["to"] == bookings[1]["from"], "expected the walk-up booking to end as the next one starts"),
+        expect(not led_turned_on(result, LED_ERROR), "expected no correction"),
+    ]
+
+#The next booking starts in 5 minutes, less than the shortest on-site booking, so nothing is sent
+def too_soon_setup(api, control):
+    add_members(api)
+    start = time.time() // 60 * 60 + 5 * 60
+    api.add_booking(RESOURCE_ID, OTHER_ID, start, start + 3600)
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def too_soon_check(result):
+    return [
+        expect(result.api.count_requests("POST", "/api/resources/") == 0, "expected no create request"),
+        expect(any(detail == 196 for t, detail in result.events("tone")), "expected the error song"),
+    ]
+
+#Reboots after prebooked from a power cut, and NTP takes three tries: the checkout swipe waits for the clock, so
+#the booking isn't ended in 2021
+def late_ntp_setup(api, control):
+    control.clock_set = False
+    control.ntp_failures = 3
+    control.hold_card(MEMBER_UID, at_s=1.0)
+
+def late_ntp_check(result):
+    checkout_at = [t for t, detail in result.events("tone") if detail == 698]
+    year = time.strftime("%Y", time.gmtime())
+    return [
+        expect(checkout_at and checkout_at[0] > 7000, "expected the swipe to wait for NTP (1 + 2 + 4 s of retries)"),
+        expect(all(booking["to"].startswith(year) for booking in result.api.bookings.values()), "expected the booking to end this year"),
+        expect(result.api.count_requests("PUT") + result.api.count_requests("DELETE") == 1, "expected the checkout to be sent"),
+    ]
+
+#name: (setup, check, duration in seconds)
+SCENARIOS = {
+    "walk_up": (walk_up_setup, walk_up_check, 3),
+    "prebooked": (prebooked_setup, prebooked_check, 3),
+    "undo": (undo_setup, undo_check, 4),
+    "someone_else": (someone_else_setup, someone_else_check, 3),
+    "unknown_badge": (unknown_badge_setup, unknown_badge_check, 3),
+    "booking_starts": (booking_starts_setup, booking_starts_check, 5),
+    "idle_reader": (idle_reader_setup, idle_reader_check, 3),
+    "cache_order": (cache_order_setup, cache_order_check, 5),
+    "rejected": (rejected_setup, rejected_check, 3),
+    "metrics": (metrics_setup, metrics_check, 3),
+    "offline": (offline_setup, offline_check, 40),
+    "answer_lost": (answer_lost_setup, answer_lost_check, 35),
+    "slow_replay": (slow_replay_setup, slow_replay_check, 42),
+    "warm_boot": (warm_boot_setup, warm_boot_check, 4),
+    "cold_boot": (cold_boot_setup, cold_boot_check, 3),
+    "slow_sync": (slow_sync_setup, slow_sync_check, 5),
+    "late_ntp": (late_ntp_setup, late_ntp_check, 9),
+    "push_update": (push_update_setup, push_update_check, 3),
+    "strip": (strip_setup, strip_check, 3),
+    "api_hangs": (api_hangs_setup, api_hangs_check, 18),
+    "flaky": (flaky_setup, flaky_check, 3),
+    "fit_before": (fit_before_setup, fit_before_check, 3),
+    "too_soon": (too_soon_setup, too_soon_check, 3),
+}
+
+#Scenarios that boot into what another one left behind: its files on flash and the bookings in its API
+BOOT_AFTER = {
+    "warm_boot": "walk_up",
+    "slow_sync": "walk_up",
+    "slow_replay": "undo",
+    "cold_boot": "prebooked",
+    "late_ntp": "prebooked",
+}
+
+#Runs a scenario and returns (result, failures)
+def run_scenario(name, echo=False):
+    setup, check, duration_s = SCENARIOS[name]
+    keep_files = None
+    if name in BOOT_AFTER:
+        first_setup, first_check, first_duration_s = SCENARIOS[BOOT_AFTER[name]]
+        first = run_device(first_setup, first_duration_s, name=BOOT_AFTER[name])
+        keep_files = first.files
+        scenario_setup = setup
+        def setup(api, control):
+            api.take_over(first.api)
+            scenario_setup(api, control)
+    result = run_device(setup, duration_s, name=name, echo=echo, keep_files=keep_files)
+    return result, [failure for failure in check(result) if failure is not None]
@@ -0,0 +1,60 @@
+#machine stand-in: pin and PWM changes are recorded in the sim_control trace instead of driving hardware
+import sim_control
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, pin_id, mode=IN, pull=None, value=None):
+        self.pin_id = pin_id
+        self.mode = mode
+        self.level = 0
+        if value is not None:
+            self.value(value)
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        if level != self.level:
+            self.level = level
+            sim_control.record("pin", (self.pin_id, level))
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin
+        self.frequency = 0
+        self.duty = 0
+
+    def freq(self, frequency=None):
+        if frequency is None:
+            return self.frequency
+        self.frequency = frequency
+        if self.duty:
+            sim_control.record("tone", frequency)
+
+    def duty_u16(self, duty=None):
+        if duty is None:
+            return self.duty
+        if bool(duty) != bool(self.duty):
+            sim_control.record("buzzer", 1 if duty else 0)
+        self.duty = duty
+
+    def deinit(self):
+        self.duty_u16(0)
+
+def freq():
+    return 125000000
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+def idle():
+    pass
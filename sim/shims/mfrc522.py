@@ -0,0 +1,38 @@
+#MFRC522 stand-in: a card is "on the reader" whenever the scenario script says one is being held there
+import sim_control
+
+class MFRC522:
+    OK = 0
+    NOTAGERR = 1
+    ERR = 2
+
+    REQIDL = 0x26
+    REQALL = 0x52
+    AUTHENT1A = 0x60
+    AUTHENT1B = 0x61
+
+    def __init__(self, spi_id=0, sck=2, miso=4, mosi=3, cs=1, rst=0):
+        self.selected = None
+
+    def init(self):
+        sim_control.count("rfid_init")
+
+    def request(self, mode):
+        sim_control.count("rfid_request")
+        if sim_control.card_present() is None:
+            #Like the driver, which reports every failed request as ERR, an empty field included
+            return (self.ERR, None)
+        return (self.OK, 0x10)
+
+    def SelectTagSN(self):
+        uid = sim_control.card_present()
+        if uid is None:
+            return (self.ERR, [])
+        sim_control.record("card_read", uid)
+        return (self.OK, list(uid))
+
+    def tohexstring(self, uid):
+        return "[" + ", ".join("0x%02X" % b for b in uid) + "]"
+
+    def stop_crypto1(self):
+        pass
@@ -0,0 +1,23 @@
+#neopixel stand-in: each write of the strip is recorded in the sim_control trace as the tuple of pixel colours
+import sim_control
+
+class NeoPixel:
+    def __init__(self, pin, n, bpp=3, timing=1):
+        self.pin = pin
+        self.n = n
+        self.pixels = [(0, 0, 0)] * n
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, i, colour):
+        self.pixels[i] = tuple(colour)
+
+    def __getitem__(self, i):
+        return self.pixels[i]
+
+    def fill(self, colour):
+        self.pixels = [tuple(colour)] * self.n
+
+    def write(self):
+        sim_control.record("strip", tuple(self.pixels))
@@ -0,0 +1,34 @@
+#network stand-in: the WLAN connects after sim_control.WIFI_CONNECT_S seconds
+import time as _time
+
+import sim_control
+
+STA_IF = 0
+AP_IF = 1
+
+class WLAN:
+    def __init__(self, interface_id=STA_IF):
+        self.is_active = False
+        self.connect_started = None
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self.is_active
+        self.is_active = is_active
+
+    def connect(self, ssid=None, password=None):
+        self.connect_started = _time.monotonic()
+
+    def disconnect(self):
+        self.connect_started = None
+
+    def isconnected(self):
+        return (self.connect_started is not None
+                and sim_control.wifi_up
+                and _time.monotonic() - self.connect_started >= sim_control.WIFI_CONNECT_S)
+
+    def status(self, param=None):
+        return 3 if self.isconnected() else 1
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
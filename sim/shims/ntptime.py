@@ -0,0 +1,14 @@
+#ntptime stand-in: the simulated clock is already in UTC, settime() only marks it set after a simulated power cut
+import sim_control
+
+host = "pool.ntp.org"
+
+def time():
+    import utime
+    return utime.time()
+
+def settime():
+    if not sim_control.wifi_up or sim_control.ntp_failures:
+        sim_control.ntp_failures = max(0, sim_control.ntp_failures - 1)
+        raise OSError(110) #ETIMEDOUT, like an NTP request that got no answer
+    sim_control.clock_set = True
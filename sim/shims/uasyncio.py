@@ -0,0 +1,44 @@
+#uasyncio stand-in on top of CPython's asyncio, adding MicroPython's millisecond helpers
+from asyncio import *
+import asyncio as _asyncio
+
+import sim_control
+
+def sleep_ms(ms):
+    return _asyncio.sleep(ms / 1000)
+
+def wait_for_ms(awaitable, timeout_ms):
+    return _asyncio.wait_for(awaitable, timeout_ms / 1000)
+
+#Runs the device's main coroutine until the scenario ends, then stops it the way Ctrl-C would on the device
+def run(coro):
+    return _asyncio.run(sim_control.supervise(coro))
+
+#Flag that another thread can set to wake a task on this loop, like MicroPython's ThreadSafeFlag
+class ThreadSafeFlag:
+    def __init__(self):
+        self.loop = None
+        self.event = None
+        self.is_set = False
+
+    def set(self):
+        loop = self.loop
+        if loop is None:
+            self.is_set = True
+        else:
+            loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.is_set = False
+        if self.event is not None:
+            self.event.clear()
+
+    async def wait(self):
+        if self.event is None:
+            self.event = Event()
+            self.loop = _asyncio.get_running_loop()
+            if self.is_set:
+                self.event.set()
+        await self.event.wait()
+        self.event.clear()
+        self.is_set = False
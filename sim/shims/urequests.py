@@ -0,0 +1,48 @@
+#urequests stand-in on http.client, for scripts that still call the blocking API directly
+import json as _json
+import http.client as _http_client
+from urllib.parse import urlsplit as _urlsplit
+
+class Response:
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return _json.loads(self.content)
+
+    def close(self):
+        pass
+
+def request(method, url, data=None, json=None, headers=None):
+    parts = _urlsplit(url)
+    connection_class = _http_client.HTTPSConnection if parts.scheme == "https" else _http_client.HTTPConnection
+    connection = connection_class(parts.hostname, parts.port, timeout=30)
+    headers = dict(headers or {})
+    if json is not None:
+        data = _json.dumps(json)
+        headers["Content-Type"] = "application/json"
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    try:
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        return Response(response.status, response.read(), dict(response.getheaders()))
+    finally:
+        connection.close()
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
@@ -0,0 +1,42 @@
+#utime stand-in: wall clock comes from sim_control so scenarios can start at any date and time of day
+import time as _time
+import calendar as _calendar
+
+import sim_control
+
+def time():
+    return int(sim_control.now())
+
+def time_ns():
+    return int(sim_control.now() * 1000000000)
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000) & 0x3fffffff
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000) & 0x3fffffff
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & 0x3fffffff
+
+def ticks_diff(end, start):
+    return ((end - start + 0x20000000) & 0x3fffffff) - 0x20000000
+
+def sleep(seconds):
+    _time.sleep(seconds)
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+#The device runs in UTC, so localtime and gmtime agree; tuples use MicroPython's 8-field layout
+def gmtime(secs=None):
+    t = _time.gmtime(time() if secs is None else secs)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+localtime = gmtime
+
+def mktime(t):
+    return _calendar.timegm((t[0], t[1], t[2], t[3], t[4], t[5], 0, 0, 0))
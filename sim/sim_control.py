@@ -0,0 +1,83 @@
+#Shared state between the harness and the hardware shims: the simulated wall clock, the scripted badge swipes,
+#and a trace of everything the device did, timestamped in milliseconds since the run started
+
+import time
+import asyncio
+
+WIFI_CONNECT_S = 0.2 #How long the simulated WLAN takes to associate
+wifi_up = True
+clock_set = True #False boots like after a power cut: the RTC counts from UNSET_CLOCK until NTP sets it
+UNSET_CLOCK = 1609459200 #2021-01-01, where the RP2040's RTC starts
+ntp_failures = 0 #How many NTP requests go unanswered before one gets through
+use_gateway = False #True puts the fleet gateway between the device and the API, with push updates on
+
+duration_s = None #The device's main coroutine is stopped after this long, None runs until interrupted
+background = [] #Coroutine functions run alongside the device, e.g. scenario timelines
+
+trace = []
+counters = {}
+card_script = [] #(start_s, end_s, uid) windows during which a card is held on the reader
+
+_clock_offset = 0.0
+_started = time.monotonic()
+
+def reset():
+    global WIFI_CONNECT_S, wifi_up, clock_set, ntp_failures, use_gateway, duration_s, _clock_offset, _started
+    WIFI_CONNECT_S = 0.2
+    wifi_up = True
+    clock_set = True
+    ntp_failures = 0
+    use_gateway = False
+    duration_s = None
+    _clock_offset = 0.0
+    _started = time.monotonic()
+    del background[:]
+    del trace[:]
+    counters.clear()
+    del card_script[:]
+
+#Makes the device's clock read `epoch` (Unix seconds, UTC) right now
+def set_clock(epoch):
+    global _clock_offset
+    _clock_offset = epoch - time.time()
+
+def now():
+    if not clock_set:
+        return UNSET_CLOCK + elapsed_s()
+    return time.time() + _clock_offset
+
+def elapsed_s():
+    return time.monotonic() - _started
+
+def record(kind, detail=None):
+    trace.append((round(elapsed_s() * 1000, 3), kind, detail))
+
+def count(name, amount=1):
+    counters[name] = counters.get(name, 0) + amount
+
+def hold_card(uid, at_s, for_s=0.5):
+    card_script.append((at_s, at_s + for_s, tuple(uid)))
+
+def card_present():
+    t = elapsed_s()
+    for start, end, uid in card_script:
+        if start <= t < end:
+            return uid
+    return None
+
+def events(kind):
+    return [(t, detail) for t, event_kind, detail in trace if event_kind == kind]
+
+#Runs the device's main coroutine next to the background coroutines, stopping everything after duration_s
+async def supervise(coro):
+    tasks = [asyncio.create_task(function()) for function in background]
+    try:
+        if duration_s is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, duration_s)
+        except asyncio.TimeoutError:
+            record("stopped")
+    finally:
+        for task in tasks:
+            task.cancel()
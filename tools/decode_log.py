@@ -0,0 +1,80 @@
+#Turns the device's binary flash log (log_0.bin ... log_3.bin, copied off with e.g. `mpremote cp :log_0.bin .`)
+#back into text, oldest record first:
+#   python tools/decode_log.py log_*.bin
+#   python tools/decode_log.py --errors-only path/to/copied/files/
+
+import os
+import sys
+import struct
+import argparse
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
+from log_messages import MESSAGES
+
+#Must match lib/flash_log.py
+MAGIC = b"MLOG"
+HEADER_FORMAT = "<4sBBHI"
+RECORD_FORMAT = "<IIHBBi32s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+LEVELS = {1: "INFO", 2: "ERROR"}
+
+#Returns (sequence, records) for one segment file, or None if it isn't one
+def read_segment(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER_SIZE:
+        return None
+    magic, version, record_size, reserved, sequence = struct.unpack_from(HEADER_FORMAT, data)
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        return None
+
+    records = []
+    #A trailing partial record is what a power loss mid-write leaves behind, and is skipped
+    for offset in range(HEADER_SIZE, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+        records.append(struct.unpack_from(RECORD_FORMAT, data, offset))
+    return sequence, records
+
+def format_record(record):
+    unix_time, ticks_ms, message_id, level, text_length, number, text = record
+    text = text[:text_length].decode("utf-8", "replace")
+    template = MESSAGES.get(message_id)
+    if template is None:
+        message = "Unknown message {} (number={}, text={!r})".format(message_id, number, text)
+    else:
+        message = template.format(number=number, text=text)
+    timestamp = datetime.fromtimestamp(unix_time, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return "{} {:>9} ms  {:<5} {}".format(timestamp, ticks_ms, LEVELS.get(level, level), message)
+
+def find_segments(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".bin")]
+        else:
+            found.append(path)
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode the booking companion's binary flash log")
+    parser.add_argument("paths", nargs="+", help="segment files, or directories holding them")
+    parser.add_argument("--errors-only", action="store_true")
+    args = parser.parse_args()
+
+    segments = []
+    for path in find_segments(args.paths):
+        segment = read_segment(path)
+        if segment is None:
+            print("Skipping {}, not a log segment".format(path), file=sys.stderr)
+        else:
+            segments.append(segment)
+
+    for sequence, records in sorted(segments, key=lambda segment: segment[0]):
+        for record in records:
+            if args.errors_only and record[3] != 2:
+                continue
+            print(format_record(record))
+
+if __name__ == "__main__":
+    main()